@@ -3,24 +3,57 @@
 #
 # SPDX-License-Identifier: MIT
 
+import numpy as np
+
 
 class Node:
     """Each Node corresponds to a PF tag in the experiment.xml file, and can be
     referenced by any calling_context_id directly under it
+
+    Nodes are lightweight views of a node of a Graph, which stores the
+    structure of all of its nodes in arrays. Nodes are created with
+    Graph.add_node, which adds them under their parent:
+
+        graph = Graph()
+        root = graph.add_node()
+        child = graph.add_node(root)
+        graph.add_root(root)
+
+    This replaces the Node(id, parent, level) constructor and Node.add_child
+    of earlier versions, which are no longer supported, since the parent and
+    children of a node are now stored by its graph.
     """
 
-    def __init__(self, id, parent, level=None) -> None:
+    __slots__ = ("_graph", "_pipit_nid")
+
+    def __init__(self, graph, id) -> None:
+        if not isinstance(graph, Graph):
+            raise TypeError(
+                "Node(id, parent, level) is no longer supported, nodes are "
+                "created with Graph.add_node(parent)."
+            )
+
+        self._graph = graph
         self._pipit_nid = id
-        self.children = []
-        self.parent = parent
 
-        if level is None:
-            self.level = self._calculate_level()
-        else:
-            self.level = level
+    @property
+    def parent(self):
+        parent = self._graph._parents[self._pipit_nid]
+        return None if parent < 0 else Node(self._graph, parent)
+
+    @property
+    def level(self):
+        return self._graph._levels[self._pipit_nid]
+
+    @property
+    def children(self):
+        return [Node(self._graph, child) for child in self._graph.get_children(self)]
 
     def add_child(self, child_node):
-        self.children.append(child_node)
+        raise TypeError(
+            "Node.add_child is no longer supported, children are added with "
+            "Graph.add_node(parent)."
+        )
 
     def get_level(self):
         """This function returns the depth of the current node
@@ -38,21 +71,11 @@ class Node:
         if node is None:
             return None
 
-        if self.get_level() > node.get_level():
-            node1 = self
-            node2 = node
-        else:
-            node1 = node
-            node2 = self
-
-        while node1.get_level() > node2.get_level():
-            node1 = node1.parent
-
-        while node1 != node2:
-            node1 = node1.parent
-            node2 = node2.parent
+        ancestor = self._graph.get_lowest_common_ancestors(
+            np.array([self._pipit_nid]), np.array([node._pipit_nid])
+        )[0]
 
-        return node1
+        return None if ancestor < 0 else Node(self._graph, ancestor)
 
     def get_node_list(self, min_level):
         """creates list from current node to node with level min_level
@@ -71,28 +94,172 @@ class Node:
     def __str__(self) -> str:
         return "ID: " + str(self._pipit_nid) + " -- Level: " + str(self.level)
 
-    def _calculate_level(self):
-        """private function to get depth of node"""
-        if self.parent is None:
-            return 0
-        else:
-            return 1 + self.parent._calculate_level()
-
     def __eq__(self, obj) -> bool:
         if isinstance(obj, Node):
             return self._pipit_nid == obj._pipit_nid
         else:
             return False
 
+    def __hash__(self) -> int:
+        return hash(self._pipit_nid)
+
 
 class Graph:
-    """Represents the calling context tree / call graph"""
+    """Represents the calling context tree / call graph
+
+    The nodes are numbered in the order they are added, and the parent, level,
+    first child and next sibling of every node are stored in arrays (-1 if a
+    node has none).
+    """
 
     def __init__(self) -> None:
         self.roots = []
 
+        # the arrays are appended to while the graph is built, and converted
+        # to numpy arrays when they are first used
+        self._parents = []
+        self._levels = []
+        self._first_children = []
+        self._last_children = []
+        self._next_siblings = []
+
+        self._arrays = None
+
     def add_root(self, node):
         self.roots.append(node)
 
+    def add_node(self, parent=None):
+        """Adds a new node under parent (or a new root node if parent is None)
+        and returns it"""
+        nid = len(self._parents)
+
+        if parent is None:
+            self._parents.append(-1)
+            self._levels.append(0)
+        else:
+            parent_nid = parent._pipit_nid
+            self._parents.append(parent_nid)
+            self._levels.append(self._levels[parent_nid] + 1)
+
+            # append the node to the children of the parent
+            if self._first_children[parent_nid] < 0:
+                self._first_children[parent_nid] = nid
+            else:
+                self._next_siblings[self._last_children[parent_nid]] = nid
+            self._last_children[parent_nid] = nid
+
+        self._first_children.append(-1)
+        self._last_children.append(-1)
+        self._next_siblings.append(-1)
+
+        self._arrays = None
+
+        return Node(self, nid)
+
+    def get_children(self, node):
+        """Returns the ids of the children of a node, in the order they were
+        added"""
+        children = []
+
+        child = self._first_children[node._pipit_nid]
+        while child >= 0:
+            children.append(child)
+            child = self._next_siblings[child]
+
+        return children
+
+    def __len__(self) -> int:
+        return len(self._parents)
+
+    def get_arrays(self):
+        """Returns a dict of the parent, level, first_child and next_sibling
+        arrays of the nodes, and the ancestor table (see get_ancestor_table)"""
+        if self._arrays is None:
+            parents = np.array(self._parents, dtype=np.int64)
+            levels = np.array(self._levels, dtype=np.int64)
+
+            self._arrays = {
+                "parent": parents,
+                "level": levels,
+                "first_child": np.array(self._first_children, dtype=np.int64),
+                "next_sibling": np.array(self._next_siblings, dtype=np.int64),
+                "ancestor_table": get_ancestor_table(parents, levels),
+            }
+
+        return self._arrays
+
+    def get_lowest_common_ancestors(self, nodes1, nodes2):
+        """Returns the lowest common ancestor of each pair of node ids (see
+        get_lowest_common_ancestors)"""
+        arrays = self.get_arrays()
+
+        return get_lowest_common_ancestors(
+            arrays["ancestor_table"], arrays["level"], nodes1, nodes2
+        )
+
     def __str__(self) -> str:
         return "Roots: " + str([str(curr_root) for curr_root in self.roots])
+
+
+def get_ancestor_table(parents, levels):
+    """Builds the table for binary lifting, whose row k holds the ancestor
+    that is 2^k levels above each node (or -1 if there is none)"""
+    max_level = int(levels.max()) if len(levels) else 0
+
+    table = [parents]
+    for _ in range(max_level.bit_length() - 1):
+        above = table[-1]
+        table.append(np.where(above >= 0, above[above], -1))
+
+    # the -1 column lets -1 (no node) be used as an index into the table
+    table = np.array(table, dtype=np.int64).reshape(len(table), len(parents))
+    return np.hstack([table, np.full((len(table), 1), -1, dtype=np.int64)])
+
+
+def get_ancestors(ancestor_table, nodes, steps):
+    """Returns the ancestors that are the given number of steps above each of
+    the node ids (or -1 if there is none), using O(log depth) array lookups"""
+    nodes = np.asarray(nodes, dtype=np.int64).copy()
+    steps = np.asarray(steps, dtype=np.int64)
+
+    for k in range(len(ancestor_table)):
+        climbing = (steps >> k) & 1 == 1
+        nodes[climbing] = ancestor_table[k][nodes[climbing]]
+
+    # steps beyond the ancestors that the table covers lead above the roots
+    nodes[steps >= (1 << len(ancestor_table))] = -1
+
+    return nodes
+
+
+def get_lowest_common_ancestors(ancestor_table, levels, nodes1, nodes2):
+    """Returns the lowest common ancestor of each pair of node ids, which is -1
+    if the nodes have different roots or either of them is -1, using binary
+    lifting with O(log depth) array lookups"""
+    nodes1 = np.asarray(nodes1, dtype=np.int64)
+    nodes2 = np.asarray(nodes2, dtype=np.int64)
+    ancestors = np.full(len(nodes1), -1, dtype=np.int64)
+
+    is_pair = (nodes1 >= 0) & (nodes2 >= 0)
+    nodes1, nodes2 = nodes1[is_pair], nodes2[is_pair]
+
+    # climb up from the deeper node to the level of the other one
+    levels1, levels2 = levels[nodes1], levels[nodes2]
+    min_levels = np.minimum(levels1, levels2)
+    nodes1 = get_ancestors(ancestor_table, nodes1, levels1 - min_levels)
+    nodes2 = get_ancestors(ancestor_table, nodes2, levels2 - min_levels)
+
+    # then climb up from both by the largest steps that keep them apart, which
+    # leaves them right below their lowest common ancestor
+    differ = nodes1 != nodes2
+    for k in reversed(range(len(ancestor_table))):
+        above1 = ancestor_table[k][nodes1]
+        above2 = ancestor_table[k][nodes2]
+        climbing = differ & (above1 != above2)
+        nodes1[climbing] = above1[climbing]
+        nodes2[climbing] = above2[climbing]
+
+    # (the parent of a root is -1, for nodes with different roots)
+    ancestors[is_pair] = np.where(differ, ancestor_table[0][nodes1], nodes1)
+
+    return ancestors
@@ -0,0 +1,623 @@
+# Copyright 2022-2023 Parallel Software and Systems Group, University of
+# Maryland. See the top-level LICENSE file for details.
+#
+# SPDX-License-Identifier: MIT
+
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import pickle
+import uuid
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # shared memory is only available in Python 3.8+, so older versions
+    # run the shards serially
+    shared_memory = None
+
+# number of tasks per process that dynamically scheduled items are split into,
+# so that the workers that get lighter tasks can pick up more of them
+TASKS_PER_PROCESS = 4
+
+
+def split_shards(group_starts, num_rows, num_shards):
+    """
+    Splits rows that are grouped into contiguous groups (such as the events of
+    a location) into at most num_shards contiguous shards with roughly equal
+    numbers of rows, without splitting any group across shards.
+
+    Arguments:
+    group_starts: sorted array of the first row of each group
+    num_rows: total number of rows
+    num_shards: number of shards to split the rows into
+
+    Returns:
+    a list of (start, end) row ranges
+    """
+
+    group_ends = np.append(group_starts[1:], num_rows)
+    targets = np.linspace(0, num_rows, num_shards + 1)[1:-1]
+
+    bounds = np.unique(
+        np.concatenate(
+            [[0], group_ends[np.searchsorted(group_ends, targets)], [num_rows]]
+        )
+    )
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def split_weighted(weights, num_tasks):
+    """
+    Splits items with the given weights (such as the sizes of the log files
+    of the PEs of a trace) into at most num_tasks contiguous ranges of items,
+    with roughly equal total weights.
+
+    Arguments:
+    weights: array of the (non-negative) weight of each item
+    num_tasks: number of ranges to split the items into
+
+    Returns:
+    a list of (start, end) item ranges
+    """
+
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) == 0:
+        return []
+    if weights.sum() <= 0:
+        weights = np.ones(len(weights))
+
+    ends = np.cumsum(weights)
+    targets = np.linspace(0, ends[-1], num_tasks + 1)[1:-1]
+
+    bounds = np.unique(
+        np.concatenate(
+            [[0], np.searchsorted(ends, targets, side="right"), [len(weights)]]
+        )
+    )
+
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def schedule_items(weights, num_processes, schedule="dynamic"):
+    """
+    Splits items with the given weights (such as the PEs or locations of a
+    trace) into contiguous tasks for run_dynamic.
+
+    Arguments:
+    weights: array of the expected cost of each item (such as its file size
+    or number of events)
+    num_processes: number of processes that will run the tasks
+    schedule: "static" for one task per process with equal numbers of items,
+    or "dynamic" for several tasks per process with roughly equal weights
+
+    Returns:
+    a list of (start, end) item ranges, and a list of the weight of each
+    """
+
+    weights = np.asarray(weights, dtype=np.float64)
+
+    if schedule == "static":
+        tasks = split_weighted(np.ones(len(weights)), num_processes)
+    elif schedule == "dynamic":
+        tasks = split_weighted(weights, num_processes * TASKS_PER_PROCESS)
+    else:
+        raise ValueError('schedule must be "static" or "dynamic".')
+
+    return tasks, [weights[start:end].sum() for start, end in tasks]
+
+
+def run_dynamic(
+    function, tasks, num_processes=1, weights=None, executor=None, share_results=False
+):
+    """
+    Runs function(task) for each task, across a process pool if
+    num_processes > 1, and returns the results in the order of the tasks.
+
+    The tasks are handed out one at a time to the workers as they become
+    free (heaviest first, if the weights of the tasks are given), so that a
+    worker that gets a slow task doesn't hold up the others. The function is
+    only unpickled once by each worker, so any data that it holds (such as
+    the reader it is a method of) isn't unpickled for every task.
+
+    Arguments:
+    function: a module-level function or a method of a picklable object, so
+    that it can be sent to the workers
+    tasks: list of the arguments of each call
+    num_processes: number of processes to use
+    weights: optional list of the expected cost of each task
+    executor: optional Executor whose workers run the tasks, instead of a new
+    pool of num_processes workers
+    share_results: whether the results are dicts of columns that the workers
+    should return through shared memory (see share_columns), which are then
+    passed to concat_columns
+    """
+
+    if num_processes <= 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+
+    # the shared memory buffers that the workers create are registered with
+    # the resource tracker of this process, which the workers inherit, so
+    # that the tracker doesn't report them as leaked when the workers exit
+    _start_resource_tracker()
+
+    order = range(len(tasks))
+    if weights is not None:
+        order = sorted(order, key=lambda index: weights[index], reverse=True)
+
+    results = [None] * len(tasks)
+
+    if executor is None:
+        # the function is sent to the workers of a new pool when they start
+        pool = mp.Pool(
+            min(num_processes, len(tasks)),
+            initializer=_init_task_worker,
+            initargs=(function,),
+        )
+        key, payload = None, None
+    else:
+        # the workers of an executor outlive this call, so the function is
+        # sent (pickled once) with every task, and the workers keep the
+        # unpickled function of the last key they saw
+        pool = executor.pool
+        key, payload = uuid.uuid4().hex, pickle.dumps(function)
+
+    try:
+        for index, result in pool.imap_unordered(
+            _run_task,
+            [(key, payload, share_results, index, tasks[index]) for index in order],
+        ):
+            results[index] = result
+    except BaseException:
+        # the workers of a private pool are stopped, and the shared memory
+        # buffers of the results that already arrived are released, since
+        # they won't be passed to concat_columns
+        if executor is None:
+            pool.terminate()
+            pool.join()
+        if share_results:
+            for result in results:
+                if result is not None:
+                    _release_columns(result)
+        raise
+
+    if executor is None:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+class Executor:
+    """
+    A pool of worker processes that is kept alive across trace reads, so that
+    reading many traces doesn't pay for starting the workers (and importing
+    numpy, pandas and the readers in them) every time. For example:
+
+        with Executor(8) as executor:
+            for dirname in dirnames:
+                trace = Trace.from_otf2(dirname, executor=executor)
+
+    Arguments:
+    num_processes: number of worker processes (all the CPUs by default)
+    """
+
+    def __init__(self, num_processes=None):
+        if num_processes is None or num_processes < 1:
+            num_processes = mp.cpu_count()
+        self.num_processes = num_processes
+
+        # the workers are started (and warmed up) right away
+        _start_resource_tracker()
+        self._pool = mp.Pool(num_processes, initializer=_init_executor_worker)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            raise ValueError("Executor is closed.")
+        return self._pool
+
+    def close(self):
+        """Stops the worker processes once they finish their tasks"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        # readers that hold an executor are sent to its workers, which don't
+        # need (and can't receive) the pool itself
+        return {"num_processes": self.num_processes, "_pool": None}
+
+
+class SharedColumn:
+    """
+    A column of a task result that share_columns moved into shared memory.
+
+    Arguments:
+    kind: "array", "categorical" (codes and categories) or "masked" (values
+    and mask of a nullable pandas array)
+    descriptors: descriptors of the shared arrays, see _to_shared_memory
+    extra: the categories of a categorical, or the type of a masked array
+    """
+
+    __slots__ = ("kind", "descriptors", "extra")
+
+    def __init__(self, kind, descriptors, extra=None):
+        self.kind = kind
+        self.descriptors = descriptors
+        self.extra = extra
+
+
+def share_columns(columns):
+    """
+    Moves the typed columns of a dict of columns into shared memory buffers,
+    so that a worker process returns only their descriptors instead of
+    pickling the data. Numpy arrays, pd.Categorical and masked arrays (such
+    as Int64 arrays) are shared, and object columns are left as they are.
+
+    The parent process takes over the buffers, see concat_columns.
+    """
+    if shared_memory is None:
+        return columns
+
+    shared = {}
+    for name, column in columns.items():
+        buffers = []
+
+        if isinstance(column, pd.Categorical):
+            shared[name] = SharedColumn(
+                "categorical",
+                [_to_shared_memory(column.codes, buffers)],
+                column.categories,
+            )
+        elif _is_masked(column):
+            shared[name] = SharedColumn(
+                "masked",
+                [
+                    _to_shared_memory(column._data, buffers),
+                    _to_shared_memory(column._mask, buffers),
+                ],
+                type(column),
+            )
+        elif isinstance(column, np.ndarray) and column.dtype != object:
+            shared[name] = SharedColumn("array", [_to_shared_memory(column, buffers)])
+        else:
+            shared[name] = column
+
+        # the buffers stay alive until the parent process unlinks them
+        for buffer in buffers:
+            buffer.close()
+
+    return shared
+
+
+def concat_columns(parts):
+    """
+    Concatenates dicts of columns with the same keys (such as the results of
+    run_dynamic with share_results=True), and returns a dict of columns that
+    a DataFrame can be created from without copying them again.
+
+    Each column is allocated once and the parts are copied straight into it,
+    from the shared memory buffers of the workers (which are then released)
+    or from the columns themselves. Categoricals are merged by the union of
+    their categories, which is sorted (like the categories of astype
+    ("category")).
+    """
+    columns = {}
+    for name in parts[0]:
+        if len(parts) == 1 and _is_concatenated(parts[0][name]):
+            # the column of a single part (such as the result of a serial
+            # read) is used as it is
+            columns[name] = parts[0][name]
+            continue
+
+        buffers = []
+        try:
+            columns[name] = _concat_column(
+                [_attach_column(part[name], buffers) for part in parts]
+            )
+        finally:
+            for buffer in buffers:
+                buffer.close()
+                buffer.unlink()
+
+    return columns
+
+
+def sort_columns(columns, key):
+    """
+    Sorts a dict of columns (such as the result of concat_columns) by one of
+    them, whose values are made of consecutive sorted runs, such as the
+    time-ordered events of each location or task.
+
+    The runs are merged by a stable sort, which keeps equal keys in the order
+    of the runs (and within each run). It finds the sorted runs and merges
+    them (in O(n log k) time for k runs), and if the keys are already sorted
+    the columns are returned as they are.
+    """
+    keys = np.asarray(columns[key])
+    if np.all(keys[1:] >= keys[:-1]):
+        return columns
+
+    order = np.argsort(keys, kind="stable")
+    return {name: column[order] for name, column in columns.items()}
+
+
+def _attach_column(column, buffers):
+    """Returns the (kind, arrays, extra) of a column of concat_columns,
+    attaching to its shared memory buffers if it was shared"""
+    if isinstance(column, SharedColumn):
+        arrays = []
+        for descriptor in column.descriptors:
+            buffer, array = _from_shared_memory(descriptor)
+            buffers.append(buffer)
+            arrays.append(array)
+        return column.kind, arrays, column.extra
+
+    if isinstance(column, pd.Categorical):
+        return "categorical", [column.codes], column.categories
+    elif _is_masked(column):
+        return "masked", [column._data, column._mask], type(column)
+    elif isinstance(column, np.ndarray) and column.dtype != object:
+        return "array", [column], None
+
+    return "object", [column], None
+
+
+def _release_columns(columns):
+    """Unlinks the shared memory buffers of the shared columns of a dict of
+    columns (such as a result of run_dynamic that isn't concatenated)"""
+    for column in columns.values():
+        if isinstance(column, SharedColumn):
+            buffers = []
+            try:
+                _attach_column(column, buffers)
+            finally:
+                for buffer in buffers:
+                    buffer.close()
+                    buffer.unlink()
+
+
+def _is_concatenated(column):
+    """Returns whether a column of a single part is already in the form that
+    concat_columns would return it in"""
+    if isinstance(column, SharedColumn):
+        return False
+    elif isinstance(column, pd.Categorical):
+        return column.categories.is_monotonic_increasing
+
+    return isinstance(column, np.ndarray) or _is_masked(column)
+
+
+def _is_masked(column):
+    """Returns whether a column is a nullable pandas array (such as an Int64
+    array), which stores its values and missing values in two arrays"""
+    return isinstance(column, pd.api.extensions.ExtensionArray) and hasattr(
+        column, "_mask"
+    )
+
+
+def _concat_column(parts):
+    """Concatenates the (kind, arrays, extra) parts of a column into a
+    single column"""
+    kind = parts[0][0]
+
+    if kind == "object" or any(part[0] != kind for part in parts):
+        return np.concatenate(
+            [np.asarray(_detach_column(part), dtype=object) for part in parts]
+        )
+
+    if kind == "categorical":
+        categories = parts[0][2].append([part[2] for part in parts[1:]])
+        categories = categories.unique().sort_values()
+
+        # map the codes of each part to the merged categories (with the -1
+        # code of missing values mapped to -1)
+        codes = []
+        for _, (part_codes,), part_categories in parts:
+            mapping = np.append(categories.get_indexer(part_categories), -1)
+            codes.append(mapping[part_codes])
+
+        return pd.Categorical.from_codes(
+            _concat_arrays(codes), dtype=pd.CategoricalDtype(categories)
+        )
+
+    arrays = [_concat_arrays(list(arrays)) for arrays in zip(*[p[1] for p in parts])]
+    if kind == "masked":
+        return parts[0][2](*arrays)
+
+    return arrays[0]
+
+
+def _concat_arrays(arrays):
+    """Copies arrays into a single newly allocated array"""
+    result = np.empty(
+        sum(len(array) for array in arrays),
+        dtype=np.result_type(*[array.dtype for array in arrays]),
+    )
+
+    start = 0
+    for array in arrays:
+        result[start : start + len(array)] = array
+        start += len(array)
+
+    return result
+
+
+def _detach_column(part):
+    """Returns a copy of the (kind, arrays, extra) part of a column that
+    doesn't use its shared memory buffers"""
+    kind, arrays, extra = part
+
+    if kind == "categorical":
+        return np.asarray(pd.Categorical.from_codes(arrays[0].copy(), extra))
+    elif kind == "masked":
+        return np.asarray(extra(arrays[0].copy(), arrays[1].copy()), dtype=object)
+
+    return arrays[0]
+
+
+def run_sharded(kernel, sharded, shared, outputs, shards, num_processes=1):
+    """
+    Runs kernel(sharded_slices, shared, outputs) for each shard, across a
+    process pool if num_processes > 1.
+
+    Arguments:
+    kernel: a module-level function, so that it can be sent to the workers
+    sharded: dict of arrays, which are sliced by the row range of each shard
+    shared: dict of arrays, which are passed as a whole to every shard
+    outputs: dict of arrays, which the kernel writes into in place (the
+    shards must write to disjoint elements)
+    shards: list of (start, end) row ranges, see split_shards
+    num_processes: number of processes to use
+
+    The arrays are passed to the workers through shared memory buffers,
+    so that only their names, dtypes and shapes are pickled.
+    """
+
+    if num_processes <= 1 or len(shards) <= 1 or shared_memory is None:
+        for start, end in shards:
+            kernel(
+                {name: array[start:end] for name, array in sharded.items()},
+                shared,
+                outputs,
+            )
+        return
+
+    buffers = []
+    try:
+        descriptors = [
+            {name: _to_shared_memory(array, buffers) for name, array in arrays.items()}
+            for arrays in (sharded, shared, outputs)
+        ]
+
+        # the workers are stopped (and waited for) before the buffers that
+        # they map are unlinked, even if a shard raises
+        pool = mp.Pool(min(num_processes, len(shards)))
+        try:
+            pool.map(
+                _run_shard,
+                [(kernel, descriptors, start, end) for start, end in shards],
+            )
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        # copy the results back from the shared memory buffers
+        buffers_by_name = {buffer.name: buffer for buffer in buffers}
+        for name, array in outputs.items():
+            buffer_name, dtype, shape = descriptors[2][name]
+            np.copyto(
+                array,
+                np.ndarray(shape, dtype=dtype, buffer=buffers_by_name[buffer_name].buf),
+            )
+    finally:
+        for buffer in buffers:
+            buffer.close()
+            buffer.unlink()
+
+
+def _to_shared_memory(array, buffers):
+    """Copies an array into a new shared memory buffer and returns a
+    (name, dtype, shape) descriptor that can be used to attach to it."""
+    array = np.ascontiguousarray(array)
+
+    # shared memory buffers can't be empty
+    buffer = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    buffers.append(buffer)
+
+    np.ndarray(array.shape, dtype=array.dtype, buffer=buffer.buf)[...] = array
+
+    return (buffer.name, array.dtype.str, array.shape)
+
+
+def _from_shared_memory(descriptor):
+    """Attaches to the shared memory buffer of a descriptor created by
+    _to_shared_memory, and returns the buffer and an array backed by it."""
+    name, dtype, shape = descriptor
+    buffer = shared_memory.SharedMemory(name=name)
+
+    return buffer, np.ndarray(shape, dtype=dtype, buffer=buffer.buf)
+
+
+# the (key, function) that the tasks of run_dynamic are run with in a worker
+# process
+_task_function = (None, None)
+
+
+def _start_resource_tracker():
+    """Starts the resource tracker of this process before worker processes
+    are started, so that they share it"""
+    if shared_memory is not None:
+        from multiprocessing import resource_tracker
+
+        resource_tracker.ensure_running()
+
+
+def _init_task_worker(function):
+    """Sets the function to run the tasks of run_dynamic with when a worker
+    process starts."""
+    global _task_function
+    _task_function = (None, function)
+
+
+def _init_executor_worker():
+    """Imports the readers (and so numpy, pandas and otf2) when a worker
+    process of an Executor starts."""
+    import pipit.trace  # noqa: F401
+    import pipit.readers.hpctoolkit_reader  # noqa: F401
+    import pipit.readers.projections_reader  # noqa: F401
+
+    try:
+        import pipit.readers.otf2_reader  # noqa: F401
+    except ImportError:
+        # otf2 is only needed to read OTF2 traces
+        pass
+
+
+def _run_task(args):
+    """Runs a single task of run_dynamic inside a worker process."""
+    global _task_function
+    key, payload, share_results, index, task = args
+
+    if key is not None and _task_function[0] != key:
+        _task_function = (key, pickle.loads(payload))
+
+    result = _task_function[1](task)
+    if share_results:
+        result = share_columns(result)
+
+    return index, result
+
+
+def _run_shard(args):
+    """Runs the kernel on a single shard inside a worker process."""
+    kernel, descriptors, start, end = args
+
+    buffers, arrays = [], []
+    for shard_descriptors in descriptors:
+        shard_arrays = {}
+        for name, descriptor in shard_descriptors.items():
+            buffer, shard_arrays[name] = _from_shared_memory(descriptor)
+            buffers.append(buffer)
+        arrays.append(shard_arrays)
+
+    sharded, shared, outputs = arrays
+    kernel({name: array[start:end] for name, array in sharded.items()}, shared, outputs)
+
+    # release the arrays before detaching from the buffers
+    del sharded, shared, outputs, arrays, shard_arrays
+    for buffer in buffers:
+        buffer.close()
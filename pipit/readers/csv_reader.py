@@ -0,0 +1,151 @@
+# Copyright 2022-2023 Parallel Software and Systems Group, University of
+# Maryland. See the top-level LICENSE file for details.
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import multiprocessing as mp
+import pandas as pd
+import pipit.trace
+from pipit.parallel import concat_columns, run_dynamic, schedule_items, sort_columns
+
+
+class CSVReader:
+    """Reader for CSV files of events, or directories of them (such as a file
+    per rank)"""
+
+    # the columns that are parsed straight into their final dtypes, instead
+    # of being inferred and converted afterwards
+    dtypes = {"Event Type": "category", "Name": "category", "Process": "int32"}
+
+    def __init__(
+        self, path, num_processes=None, executor=None, read_filter=None, engine=None
+    ):
+        if os.path.isdir(path):
+            self.file_names = sorted(
+                os.path.join(path, file)
+                for file in os.listdir(path)
+                if file.endswith(".csv")
+            )
+            if len(self.file_names) == 0:
+                raise ValueError("Invalid directory for csv - no csv files found.")
+        else:
+            self.file_names = [path]
+
+        # the pandas parser engine, where "pyarrow" reads each file at once
+        # with multiple threads
+        self.engine = engine
+
+        # a shared Executor to read the files with (see run_dynamic)
+        self.executor = executor
+
+        # the events to read (see pipit.trace.ReadFilter)
+        self.read_filter = read_filter or pipit.trace.ReadFilter()
+
+        num_cpus = mp.cpu_count()
+        if executor is not None:
+            # the workers of a shared executor are all used by default
+            num_cpus = executor.num_processes
+
+        if num_processes is None or num_processes < 1 or num_processes > num_cpus:
+            # uses all processes to parallelize reading by default
+            self.num_processes = num_cpus
+        else:
+            self.num_processes = num_processes
+
+        # files are read by one process each at most
+        self.num_processes = min(self.num_processes, len(self.file_names))
+
+    def read(self):
+        # Read the files in ranges, which are balanced by their sizes, whose
+        # columns are sent back from the processes through shared memory (and
+        # aren't referenced here, so that they are freed once they are sorted)
+        file_sizes = [os.path.getsize(file_name) for file_name in self.file_names]
+        tasks, task_sizes = schedule_items(file_sizes, self.num_processes)
+        events_dataframe = self._build_events_dataframe(
+            concat_columns(
+                run_dynamic(
+                    self._read_files,
+                    tasks,
+                    self.num_processes,
+                    task_sizes,
+                    self.executor,
+                    share_results=True,
+                )
+            )
+        )
+
+        return pipit.trace.Trace(None, events_dataframe)
+
+    def iter_events(self, chunk_size):
+        """
+        Yields the events of the files as DataFrames of at most chunk_size
+        events, one file at a time (and in time order within each chunk), so
+        that traces that don't fit in memory can be summarized one chunk at
+        a time
+        """
+        for file_name in self.file_names:
+            for columns in self._read_chunks(file_name, chunk_size):
+                if len(columns["Timestamp (ns)"]) > 0:
+                    yield self._build_events_dataframe(columns)
+
+    def _read_files(self, file_range):
+        """Reads a range of the files into a dict of columns"""
+        begin_int, end_int = file_range
+
+        return concat_columns(
+            [
+                columns
+                for file_name in self.file_names[begin_int:end_int]
+                for columns in self._read_chunks(file_name, pipit.trace.CHUNK_SIZE)
+            ]
+        )
+
+    def _read_chunks(self, file_name, chunk_size):
+        """Yields the events of a file as dicts of columns, in chunks of
+        chunk_size rows (before they are filtered)"""
+        if self.engine == "pyarrow":
+            # the pyarrow engine can't read in chunks (or skip the spaces
+            # after the delimiters)
+            chunks = [pd.read_csv(file_name, engine="pyarrow", dtype=self.dtypes)]
+        else:
+            chunks = pd.read_csv(
+                file_name,
+                skipinitialspace=True,
+                dtype=self.dtypes,
+                engine=self.engine,
+                chunksize=chunk_size,
+            )
+
+        for chunk in chunks:
+            chunk = self.read_filter.apply(self._timestamps_to_ns(chunk))
+            yield {column: chunk[column].values for column in chunk.columns}
+
+    def _timestamps_to_ns(self, events):
+        """Converts the timestamps of the events from seconds to nanoseconds,
+        if they are in seconds"""
+        if "Timestamp (s)" in events.columns:
+            events["Timestamp (s)"] *= 10**9
+            events.rename(columns={"Timestamp (s)": "Timestamp (ns)"}, inplace=True)
+
+        return events
+
+    def _build_events_dataframe(self, columns):
+        # sort the events by Timestamp (a stable sort keeps events with the
+        # same timestamp in the order of the files, and merges the runs of
+        # events that are already sorted, such as the events of each file)
+        columns = sort_columns(columns, "Timestamp (ns)")
+
+        events_dataframe = pd.DataFrame(columns, copy=False)
+        del columns
+
+        # the categories of the events that were filtered out are dropped
+        for column in ["Event Type", "Name"]:
+            categories = events_dataframe[column].cat
+            events_dataframe[column] = categories.remove_unused_categories()
+
+        # ranks are parsed as ints, and then made categorical like the ranks
+        # of the other readers (without copying the other columns)
+        events_dataframe["Process"] = events_dataframe["Process"].astype("category")
+
+        return events_dataframe
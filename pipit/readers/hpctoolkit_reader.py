@@ -4,17 +4,79 @@
 # SPDX-License-Identifier: MIT
 
 
+import mmap
+import multiprocessing as mp
+import numpy as np
 import pandas as pd
 import pipit.trace
-from pipit.graph import Graph, Node
+from pipit.parallel import run_dynamic, sort_columns, split_weighted
+from pipit.graph import Graph, Node, get_ancestors, get_lowest_common_ancestors
 
 
-class MetaReader:
-    # adds new context id and return new nid
-    def _add_context_id(self, context_id) -> int:
-        self.nid_to_ctx[self.current_nid] = context_id
-        self.current_nid += 1
-        return self.current_nid - 1
+class LazySectionReader:
+    """
+    Base class of the readers of the .db files, which only read the header of
+    the file up front, and read each section the first time that one of the
+    attributes that the section sets is accessed
+    """
+
+    def _init_sections(self, header_map, reader_map, section_attributes):
+        """
+        Sets up the lazy reading of the sections, given the maps of the section
+        names to their index in the header and to their reader functions, and
+        a map of the section names to the attributes that they set
+        """
+        self._header_map = header_map
+        self._reader_map = reader_map
+        self._loaded_sections = set()
+        self._attribute_sections = {
+            attribute: section_name
+            for section_name, attributes in section_attributes.items()
+            for attribute in attributes
+        }
+
+    def load_section(self, section_name: str) -> None:
+        """
+        Reads a section of the file, if it hasn't been read yet
+        """
+        if section_name in self._loaded_sections:
+            return
+
+        section_index = self._header_map[section_name]
+        section_pointer = self.section_pointer[section_index]
+        section_size = self.section_size[section_index]
+
+        # a section can be read while another section is being read (when it
+        # uses the attributes of the other section), so we go back to the
+        # position in the file that we were at afterwards
+        position = self.file.tell()
+        self._reader_map[section_name](section_pointer, section_size)
+        self.file.seek(position)
+
+        # the section is only marked as loaded once it has been read, so that
+        # a section that fails to be read raises its error again when it is
+        # next used
+        self._loaded_sections.add(section_name)
+
+    def __getattr__(self, name):
+        # this is only called for attributes that haven't been set, so we
+        # read the section that sets the attribute, if it hasn't been read yet
+        section_name = self.__dict__.get("_attribute_sections", {}).get(name)
+        if section_name is not None and section_name not in self._loaded_sections:
+            self.load_section(section_name)
+            return getattr(self, name)
+
+        raise AttributeError(
+            "'{}' object has no attribute '{}'".format(type(self).__name__, name)
+        )
+
+
+class MetaReader(LazySectionReader):
+    # adds a new node for a context id to the CCT and returns it
+    def _add_context_id(self, context_id, parent_node) -> Node:
+        node = self.cct.add_node(parent_node)
+        self.nid_to_ctx[node._pipit_nid] = context_id
+        return node
 
     def __init__(self, file_location):
         # open the file to ready in binary mode (rb)
@@ -24,9 +86,6 @@ class MetaReader:
         self.byte_order = "little"
         self.signed = False
         self.encoding = "ASCII"
-        self.current_nid = 0
-        self.nid_to_ctx = {}
-        self.node_map = {}
 
         # The meta.db header consists of the common .db header and n sections.
         # We're going to do a little set up work, so that's easy to change if
@@ -101,13 +160,39 @@ class MetaReader:
         # reading the meta.db header
         self.__read_common_header()
 
-        # now let's read all the sections
-        for section_name in self.read_order:
-            section_index = header_map[section_name]
-            section_pointer = self.section_pointer[section_index]
-            section_size = self.section_size[section_index]
-            section_reader = reader_map[section_name]
-            section_reader(section_pointer, section_size)
+        # The sections are read lazily (in the above order of references),
+        # when one of the attributes they set is first accessed
+        self._init_sections(
+            header_map,
+            reader_map,
+            {
+                "General Properties": ["database_title", "database_description"],
+                "Common String Table": ["common_strings", "common_string_index_map"],
+                "Source Files": [
+                    "source_files_pointer",
+                    "source_file_size",
+                    "source_files_list",
+                ],
+                "Load Modules": [
+                    "load_modules_pointer",
+                    "load_module_size",
+                    "load_modules_list",
+                ],
+                "Functions": [
+                    "functions_array_pointer",
+                    "function_size",
+                    "functions_list",
+                ],
+                "Context Tree": [
+                    "cct",
+                    "context_map",
+                    "node_map",
+                    "nid_to_ctx",
+                ],
+                "Identifier Names": ["identifier_names"],
+                "Performance Metrics": [],
+            },
+        )
 
     def get_information_from_context_id(self, context_id: int):
         context: dict = self.context_map[context_id]
@@ -531,6 +616,8 @@ class MetaReader:
 
         self.cct = Graph()
         self.context_map: dict[int, dict] = {}
+        self.nid_to_ctx = {}
+        self.node_map = {}
 
         # Reading "Context Tree" section header
 
@@ -604,7 +691,7 @@ class MetaReader:
         # context = {"string_index": string_index}
         self.context_map[context_id] = context
         # Create Node for this context
-        node: Node = Node(self._add_context_id(context_id), None)
+        node: Node = self._add_context_id(context_id, None)
         # Adding the Node to the CCT
         self.cct.add_root(node)
         self.node_map[context_id] = node
@@ -737,11 +824,8 @@ class MetaReader:
 
             else:
                 # otherwise we do want to create a node
-                # Creating Node for this context
-                node = Node(self._add_context_id(context_id), parent_node)
-
-                # Connecting this node to the parent node
-                parent_node.add_child(node)
+                # Creating Node for this context under the parent node
+                node = self._add_context_id(context_id, parent_node)
 
                 # Adding this node to the graph
                 self.node_map[context_id] = node
@@ -800,7 +884,7 @@ class MetaReader:
             self.file.seek(return_address)
 
 
-class ProfileReader:
+class ProfileReader(LazySectionReader):
     # class to read self.data from profile.db file
 
     def __init__(self, file_location, meta_reader):
@@ -855,13 +939,16 @@ class ProfileReader:
         # reading the profile.db header
         self.__read_common_header()
 
-        # now let's read all the sections
-        for section_name in self.read_order:
-            section_index = header_map[section_name]
-            section_pointer = self.section_pointer[section_index]
-            section_size = self.section_size[section_index]
-            section_reader = reader_map[section_name]
-            section_reader(section_pointer, section_size)
+        # The sections are read lazily (in the above order of references),
+        # when one of the attributes they set is first accessed
+        self._init_sections(
+            header_map,
+            reader_map,
+            {
+                "Hierarchical Identifier Tuples": ["hit_map"],
+                "Profiles Information": ["profile_info_list", "summary_profile_index"],
+            },
+        )
 
     def __read_profiles_information_section(
         self, section_pointer: int, section_size: int
@@ -1008,15 +1095,33 @@ class ProfileReader:
             )
 
 
-class TraceReader:
+class TraceReader(LazySectionReader):
     def __init__(
-        self, file_location: str, meta_reader: MetaReader, profile_reader: ProfileReader
+        self,
+        file_location: str,
+        meta_reader: MetaReader,
+        profile_reader: ProfileReader,
+        num_processes: int = 1,
+        executor=None,
+        read_filter=None,
     ) -> None:
         # open file
+        self.file_location = file_location
         self.file = open(file_location, "rb")
         self.meta_reader = meta_reader
         self.profile_reader = profile_reader
 
+        # number of processes that decode the trace lines, and a shared
+        # Executor to decode them with (see run_dynamic)
+        self.num_processes = num_processes
+        self.executor = executor
+
+        # the events to read (see pipit.trace.ReadFilter)
+        self.read_filter = read_filter or pipit.trace.ReadFilter()
+
+        # the columns of the events, see data
+        self._data = None
+
         # setting necessary read options
         self.byte_order = "little"
         self.signed = False
@@ -1055,13 +1160,70 @@ class TraceReader:
         # reading the trace.db header
         self.__read_common_header()
 
-        # now let's read all the sections
-        for section_name in self.read_order:
-            section_index = header_map[section_name]
-            section_pointer = self.section_pointer[section_index]
-            section_size = self.section_size[section_index]
-            section_reader = reader_map[section_name]
-            section_reader(section_pointer, section_size)
+        # The trace lines are read lazily, when the data is first accessed
+        self._init_sections(
+            header_map,
+            reader_map,
+            {
+                "Context Trace Headers": [
+                    "min_time_stamp",
+                    "max_time_stamp",
+                    "hits",
+                    "trace_lines",
+                    "contexts",
+                ]
+            },
+        )
+
+    def __build_node_arrays(self) -> None:
+        """
+        Builds arrays describing the nodes of the CCT, indexed by their nid, so
+        that the events of a whole trace line can be created at once
+        """
+        nodes = {node._pipit_nid: node for node in self.meta_reader.node_map.values()}
+        num_nodes = len(nodes)
+
+        # level of each node, and the table of their ancestors for finding
+        # the lowest common ancestors of nodes
+        cct_arrays = self.meta_reader.cct.get_arrays()
+        self.node_levels = cct_arrays["level"]
+        self.node_ancestors = cct_arrays["ancestor_table"]
+
+        # the node objects and the information of their contexts
+        self.node_objects = np.empty(num_nodes, dtype=object)
+        self.node_context_ids = np.zeros(num_nodes, dtype=np.int64)
+        self.node_is_loop = np.zeros(num_nodes, dtype=bool)
+        self.node_names = np.empty(num_nodes, dtype=object)
+        self.node_files = np.empty(num_nodes, dtype=object)
+        self.node_lines = np.empty(num_nodes, dtype=object)
+
+        for nid in range(num_nodes):
+            node = nodes[nid]
+            self.node_objects[nid] = node
+
+            context_id = self.meta_reader.nid_to_ctx[nid]
+            context_information = self.meta_reader.get_information_from_context_id(
+                context_id
+            )
+            self.node_context_ids[nid] = context_id
+            self.node_is_loop[nid] = context_information["loop_type"]
+            self.node_names[nid] = str(context_information["function"])
+            self.node_files[nid] = context_information["file"]
+            self.node_lines[nid] = context_information["line"]
+
+        # The names and files of the events are categorical columns, which
+        # are built from the codes of the names and files of their nodes
+        self.node_names = pd.Categorical(self.node_names)
+        self.node_files = pd.Categorical(self.node_files)
+
+        # node of each context id (-1 for the idle context 0)
+        context_map = self.meta_reader.node_map
+        self.context_nodes = np.full(
+            max(context_map, default=0) + 1, -1, dtype=np.int64
+        )
+        for context_id, node in context_map.items():
+            self.context_nodes[context_id] = node._pipit_nid
+        self.context_nodes[0] = -1
 
     def __read_common_header(self) -> None:
         """
@@ -1110,6 +1272,9 @@ class TraceReader:
         Reader Context Trace Headers section of trace.db
         """
 
+        # the events are created from arrays describing the nodes of the CCT
+        self.__build_node_arrays()
+
         # get to the right place in the file
         self.file.seek(section_pointer)
 
@@ -1138,26 +1303,136 @@ class TraceReader:
             self.file.read(8), byteorder=self.byte_order, signed=self.signed
         )
 
-        self.data = {
-            "Timestamp (ns)": [],
-            "Event Type": [],
-            "Name": [],
-            "Thread": [],
-            "Process": [],
-            "Host": [],
-            "Node": [],
-            "Source File Name": [],
-            "Source File Line Number": [],
-            "Calling Context ID": [],
-        }
-
+        # read the hit and the range of the trace elements of every trace line
+        self.hits, self.trace_lines = [], []
         for i in range(num_trace_headers):
             header_pointer = trace_headers_pointer + (i * trace_header_size)
-            self.__read_single_trace_header(header_pointer)
+            hit, start_pointer, end_pointer = self.__read_single_trace_header(
+                header_pointer
+            )
+
+            # skip the trace lines of the processes that aren't read
+            if self.read_filter.keeps_process(hit[1][1]):
+                self.hits.append(hit)
+                self.trace_lines.append((start_pointer, end_pointer))
+
+        # table of the node and the information of each calling context
+        self.contexts = pd.DataFrame(
+            {
+                "Node": self.node_objects,
+                "Name": self.node_names,
+                "Source File Name": self.node_files,
+                "Source File Line Number": self.node_lines,
+            },
+            index=pd.Index(self.node_context_ids, name="Calling Context ID"),
+        )
+
+    @property
+    def data(self):
+        """
+        The columns of the events of all the trace lines, which are decoded
+        the first time that they are used
+        """
+        if self._data is None:
+            self._data = self.decode_trace_lines(
+                range(len(self.trace_lines)), self.num_processes
+            )
+        return self._data
+
+    def decode_trace_lines(self, lines, num_processes):
+        """
+        Decodes the events of some of the trace lines into a dict of columns
+
+        Arguments:
+        lines: the indices of the trace lines to decode
+        num_processes: the number of processes that decode the lines
+        """
+        hits = [self.hits[line] for line in lines]
+        trace_lines = [self.trace_lines[line] for line in lines]
+
+        # the time range of the read filter, in the timestamps of the trace
+        # lines (before they are converted to start at 0)
+        time_range = tuple(
+            None if time is None else time + self.min_time_stamp
+            for time in (self.read_filter.start, self.read_filter.end)
+        )
 
-    def __read_single_trace_header(self, header_pointer: int) -> None:
+        # The trace lines are independent, so we split them into contiguous
+        # chunks of roughly equal sizes, and decode each chunk in a separate
+        # process. Each process is sent the node of each context id, and the
+        # binary-lifting ancestor table and level of the nodes, which it
+        # finds the lowest common ancestor of consecutive samples with (to
+        # tell which nodes are left and entered between them). It returns the
+        # node, type and timestamp of each event.
+        line_sizes = [end - start for start, end in trace_lines]
+
+        args = [
+            (
+                self.file_location,
+                trace_lines[start:end],
+                self.context_nodes,
+                self.node_ancestors,
+                self.node_levels,
+                self.min_time_stamp,
+                self.max_time_stamp,
+                time_range,
+            )
+            for start, end in split_weighted(line_sizes, num_processes)
+        ]
+
+        chunks = run_dynamic(
+            _read_trace_lines, args, num_processes, executor=self.executor
+        )
+
+        # concatenate the events of all the trace lines (in order)
+        num_events, event_nodes, is_leave, timestamps = (
+            np.concatenate([empty] + [chunk[i] for chunk in chunks])
+            for i, empty in enumerate(_empty_trace_lines())
+        )
+
+        # the trace line of each event
+        event_lines = np.repeat(np.arange(len(hits)), num_events)
+
+        # only keep the events that match the read filter (the trace lines
+        # were cut down to the time range, but still start with the sample
+        # that the first events in the time range come from)
+        if self.read_filter:
+            mask = self.read_filter.mask(
+                len(timestamps),
+                timestamps,
+                None,
+                _take_categorical(self.node_names, event_nodes),
+            )
+            event_nodes, is_leave, timestamps, event_lines = (
+                array[mask]
+                for array in (event_nodes, is_leave, timestamps, event_lines)
+            )
+
+        # HPCViewer only puts loops in CCT, but not trace view, so
+        # we use a special Loop Enter/Leave event type
+        event_types = pd.Categorical.from_codes(
+            is_leave + 2 * self.node_is_loop[event_nodes],
+            ["Enter", "Leave", "Loop Enter", "Loop Leave"],
+        )
+
+        # The node of each event can be looked up in the contexts table
+        # (see HPCToolkitReader.read) by its calling context id
+        return {
+            "Timestamp (ns)": timestamps,
+            "Event Type": event_types.remove_unused_categories(),
+            "Name": _take_categorical(self.node_names, event_nodes),
+            "Thread": np.array([hit[2][1] for hit in hits])[event_lines],
+            "Process": np.array([hit[1][1] for hit in hits])[event_lines],
+            "Host": np.array([hit[0][1] for hit in hits])[event_lines],
+            "Source File Name": _take_categorical(self.node_files, event_nodes),
+            "Source File Line Number": self.node_lines[event_nodes],
+            "Calling Context ID": self.node_context_ids[event_nodes],
+        }
+
+    def __read_single_trace_header(self, header_pointer: int):
         """
-        Reads a single trace header and all trace elements associated with it
+        Reads a single trace header, and returns its hit and the pointers to
+        the first and after-end elements of its trace line
         """
         self.file.seek(header_pointer)
 
@@ -1178,173 +1453,74 @@ class TraceReader:
             self.file.read(8), byteorder=self.byte_order, signed=self.signed
         )
 
-        self.file.seek(start_pointer)
-
-        # setting up some variables
-        last_id = -1  # refers to the previous context id
-        last_node: Node = None  # refers to the node associated with the last context
-        context_id: int = -1  # refers to the current context id
-        current_node: Node = (
-            None  # refers to the current node associated with the current context id
-        )
-
-        # refers to the least common ancestor between common_node and last_node
-        # as in finding the node that is the parent of both common_node and last_node
-        common_node: Node = None
-
-        while self.file.tell() < end_pointer:
-            # Timestamp (nanoseconds since epoch)
-            timestamp = (
-                int.from_bytes(
-                    self.file.read(8), byteorder=self.byte_order, signed=self.signed
-                )
-                - self.min_time_stamp
-            )
-
-            # Sample calling context id (in meta.db)
-            # can use this to get name of function from meta.db
-            # Procedure tab
-            context_id = int.from_bytes(
-                self.file.read(4), byteorder=self.byte_order, signed=self.signed
-            )
-
-            if context_id == last_id:
-                # nothing changed between samples.
-                # means we don't have to do anything
-                continue
-            elif context_id == 0:
-                # process is idling
-                current_node = None
-            else:
-                # at a new non-idle context
-                current_node = self.meta_reader.node_map[context_id]
-
-            # First we want to close all the "enter" events from the last sample
-            # that aren't still running
-            if last_node is not None:
-                if current_node is None:
-                    common_node: Node = None
-                else:
-                    common_node: Node = current_node.get_intersection(last_node)
-
-                # closing each "enter" column until we reach the common_node
-                while last_node != common_node:
-                    curr_ctx_id = self.meta_reader.nid_to_ctx[last_node._pipit_nid]
-                    context_information = (
-                        self.meta_reader.get_information_from_context_id(curr_ctx_id)
-                    )
-
-                    self.data["Name"].append(str(context_information["function"]))
-                    if context_information["loop_type"]:
-                        # HPCViewer only puts loops in CCT, but not trace view, so
-                        # we use a special Loop Enter/Leave event type
-                        self.data["Event Type"].append("Loop Leave")
-                    else:
-                        self.data["Event Type"].append("Leave")
-                    self.data["Timestamp (ns)"].append(timestamp)
-                    self.data["Process"].append(hit[1][1])
-                    self.data["Thread"].append(hit[2][1])
-                    self.data["Host"].append(hit[0][1])
-                    self.data["Node"].append(last_node)
-                    self.data["Source File Name"].append(context_information["file"])
-                    self.data["Source File Line Number"].append(
-                        context_information["line"]
-                    )
-                    self.data["Calling Context ID"].append(curr_ctx_id)
-
-                    last_node = last_node.parent
-            # Now we want to add all the new "enter" events after
-            # the common_node event
-            if current_node is not None:
-                if common_node is None:
-                    intersect_level = -1
-                else:
-                    intersect_level = common_node.get_level()
-                entry_nodes = current_node.get_node_list(intersect_level)
-                for i in range(len(entry_nodes)):
-                    entry_node = entry_nodes[-1 * i - 1]
-                    curr_ctx_id = self.meta_reader.nid_to_ctx[entry_node._pipit_nid]
-                    context_information = (
-                        self.meta_reader.get_information_from_context_id(curr_ctx_id)
-                    )
-
-                    self.data["Name"].append(str(context_information["function"]))
-                    if context_information["loop_type"]:
-                        # HPCViewer only puts loops in CCT, but not trace view, so
-                        # we use a special Loop Enter/Leave event type
-                        self.data["Event Type"].append("Loop Enter")
-                    else:
-                        self.data["Event Type"].append("Enter")
-                    self.data["Timestamp (ns)"].append(timestamp)
-                    self.data["Process"].append(hit[1][1])
-                    self.data["Thread"].append(hit[2][1])
-                    self.data["Host"].append(hit[0][1])
-                    self.data["Node"].append(entry_node)
-                    self.data["Source File Name"].append(context_information["file"])
-                    self.data["Source File Line Number"].append(
-                        context_information["line"]
-                    )
-                    self.data["Calling Context ID"].append(curr_ctx_id)
-
-            last_node = current_node
-            last_id = context_id
-
-        # Now we want to close all the "enter" events from the last sample
-        current_node = None
-        timestamp = self.max_time_stamp - self.min_time_stamp
-        if last_node is not None:
-            if current_node is None:
-                common_node: Node = None
-            else:
-                common_node: Node = current_node.get_intersection(last_node)
-
-            # closing each "enter" column until we reach the common_node
-            while last_node != common_node:
-                curr_ctx_id = self.meta_reader.nid_to_ctx[last_node._pipit_nid]
-                context_information = self.meta_reader.get_information_from_context_id(
-                    curr_ctx_id
-                )
-
-                self.data["Name"].append(str(context_information["function"]))
-                if context_information["loop_type"]:
-                    self.data["Event Type"].append("Loop Leave")
-                else:
-                    self.data["Event Type"].append("Leave")
-                self.data["Timestamp (ns)"].append(timestamp)
-                self.data["Process"].append(hit[1][1])
-                self.data["Thread"].append(hit[2][1])
-                self.data["Host"].append(hit[0][1])
-                self.data["Node"].append(last_node)
-                self.data["Source File Name"].append(context_information["file"])
-                self.data["Source File Line Number"].append(context_information["line"])
-                self.data["Calling Context ID"].append(curr_ctx_id)
-                last_node = last_node.parent
+        return hit, start_pointer, end_pointer
 
 
 class HPCToolkitReader:
-    def __init__(self, directory: str) -> None:
+    def __init__(
+        self,
+        directory: str,
+        num_processes=None,
+        executor=None,
+        read_filter=None,
+        order="time",
+    ) -> None:
+        # order of the events, "time" or "location" (grouped by trace line,
+        # and in time order within each trace line)
+        self.order = order
+
+        num_cpus = mp.cpu_count()
+        if executor is not None:
+            # the workers of a shared executor are all used by default
+            num_cpus = executor.num_processes
+
+        if num_processes is None or num_processes < 1 or num_processes > num_cpus:
+            # uses all processes to parallelize reading by default
+            self.num_processes = num_cpus
+        else:
+            self.num_processes = num_processes
+
         self.meta_reader: MetaReader = MetaReader(directory + "/meta.db")
         self.profile_reader = ProfileReader(directory + "/profile.db", self.meta_reader)
         self.trace_reader = TraceReader(
-            directory + "/trace.db", self.meta_reader, self.profile_reader
+            directory + "/trace.db",
+            self.meta_reader,
+            self.profile_reader,
+            self.num_processes,
+            executor,
+            read_filter,
         )
 
     def read(self) -> pipit.trace.Trace:
-        trace_df = pd.DataFrame(self.trace_reader.data)
-        # Need to sort df by timestamp then index
-        # (since many events occur at the same timestamp)
-
-        # rename the index axis, so we can sort with it
-        trace_df.rename_axis("index", inplace=True)
-
-        # sort by timestamp then index
-        trace_df.sort_values(
-            by=["Timestamp (ns)", "index"],
-            axis=0,
-            ascending=True,
-            inplace=True,
-            ignore_index=True,
-        )
+        self.trace_df = self._build_events_dataframe(self.trace_reader.data)
+
+        # The definitions are the contexts of the events, which hold the Node
+        # of each calling context id
+        return pipit.trace.Trace(self.trace_reader.contexts, self.trace_df)
+
+    def iter_events(self, chunk_size):
+        """
+        Yields the events of the trace as DataFrames of at most chunk_size
+        events, one trace line (location) at a time, so that traces that
+        don't fit in memory can be summarized one chunk at a time (a trace
+        line is decoded at once)
+        """
+        for line in range(len(self.trace_reader.trace_lines)):
+            trace_df = self._build_events_dataframe(
+                self.trace_reader.decode_trace_lines([line], 1)
+            )
+
+            for start in range(0, len(trace_df), chunk_size):
+                yield trace_df.iloc[start : start + chunk_size].reset_index(drop=True)
+
+    def _build_events_dataframe(self, data):
+        # Need to sort by timestamp then index (since many events occur at
+        # the same timestamp), which merges the time-ordered events of each
+        # trace line
+        if self.order == "time":
+            data = sort_columns(data, "Timestamp (ns)")
+
+        trace_df = pd.DataFrame(data)
 
         trace_df = trace_df.astype(
             {
@@ -1356,5 +1532,177 @@ class HPCToolkitReader:
             }
         )
 
-        self.trace_df = trace_df
-        return pipit.trace.Trace(None, trace_df)
+        return trace_df
+
+
+# Each trace element is a u64 timestamp followed by a u32 context id
+_trace_element_dtype = np.dtype([("timestamp", "<u8"), ("context_id", "<u4")])
+
+
+def _read_trace_lines(args):
+    """
+    Decodes a chunk of trace lines of a trace.db file into events (in a
+    separate process when reading in parallel)
+
+    Arguments:
+    args: a tuple of the trace.db file location, the list of the (start, end)
+    pointers of the trace lines, the node of each context id, the ancestor
+    table and level of each node, the smallest and largest timestamps of the
+    trace, and the (start, end) time range to read, whose ends can be None
+
+    Returns:
+    the number of events of each trace line, and the node, whether it is a
+    leave, and the timestamp of each event
+    """
+    (
+        file_location,
+        trace_lines,
+        context_nodes,
+        node_ancestors,
+        node_levels,
+        min_time_stamp,
+        max_time_stamp,
+        time_range,
+    ) = args
+
+    # lists of the arrays of each trace line
+    num_events, event_nodes, is_leave, timestamps = (
+        [empty] for empty in _empty_trace_lines()
+    )
+
+    with open(file_location, "rb") as file:
+        # the trace lines are read directly from a memory map of the file
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        for start_pointer, end_pointer in trace_lines:
+            line_events = _read_trace_line(
+                file_map,
+                start_pointer,
+                end_pointer,
+                context_nodes,
+                node_ancestors,
+                node_levels,
+                min_time_stamp,
+                max_time_stamp,
+                time_range,
+            )
+            num_events.append([len(line_events[0])])
+            event_nodes.append(line_events[0])
+            is_leave.append(line_events[1])
+            timestamps.append(line_events[2])
+
+        file_map.close()
+
+    return (
+        np.concatenate(num_events),
+        np.concatenate(event_nodes),
+        np.concatenate(is_leave),
+        np.concatenate(timestamps),
+    )
+
+
+def _empty_trace_lines():
+    """Returns the (empty) arrays returned by _read_trace_lines for no lines"""
+    return (
+        np.zeros(0, dtype=np.int64),
+        np.zeros(0, dtype=np.int64),
+        np.zeros(0, dtype=bool),
+        np.zeros(0, dtype=np.int64),
+    )
+
+
+def _read_trace_line(
+    file_map,
+    start_pointer,
+    end_pointer,
+    context_nodes,
+    node_ancestors,
+    node_levels,
+    min_time_stamp,
+    max_time_stamp,
+    time_range=(None, None),
+):
+    """
+    Decodes the trace elements of a single trace line, and returns the node,
+    whether it is a leave, and the timestamp of each of its events
+
+    Only the samples in the (start, end) time range are decoded, along with
+    the last sample before it, so that the events of the first sample in the
+    range are the same as when the whole line is decoded. The events before
+    the start of the range still have to be dropped.
+    """
+
+    # View the whole trace line as an array of trace elements (without
+    # copying it out of the memory map)
+    trace_line = np.frombuffer(
+        file_map,
+        dtype=_trace_element_dtype,
+        count=(end_pointer - start_pointer) // _trace_element_dtype.itemsize,
+        offset=start_pointer,
+    )
+
+    # The samples are in time order, so the samples in the time range are
+    # found with a binary search
+    start, end = time_range
+    if start is not None:
+        first = np.searchsorted(trace_line["timestamp"], start)
+        trace_line = trace_line[max(first - 1, 0) :]
+    if end is not None:
+        trace_line = trace_line[: np.searchsorted(trace_line["timestamp"], end)]
+
+    # Only the samples where the context changes produce events, so we
+    # skip the consecutive samples of the same context
+    context_ids = trace_line["context_id"]
+    is_change = np.ones(len(context_ids), dtype=bool)
+    is_change[1:] = context_ids[1:] != context_ids[:-1]
+
+    # Timestamps are converted to nanoseconds since the start of the trace
+    timestamps = trace_line["timestamp"][is_change].astype(np.int64) - min_time_stamp
+
+    # Node of each sample (-1 when the process is idling), with a final
+    # idle sample to close all the "enter" events at the end of the trace
+    nodes = np.append(context_nodes[context_ids[is_change]], -1)
+    timestamps = np.append(timestamps, max_time_stamp - min_time_stamp)
+    last_nodes = np.append(-1, nodes[:-1])
+    del trace_line, context_ids
+
+    # At each sample, we close the "enter" events from the last sample
+    # that aren't still running (from the last node up to, but excluding,
+    # its common ancestor with the current node), and then add the new
+    # "enter" events below the common ancestor (down to the current node)
+    common_ancestors = get_lowest_common_ancestors(
+        node_ancestors, node_levels, last_nodes, nodes
+    )
+    common_levels = np.where(
+        common_ancestors >= 0, node_levels[common_ancestors] + 1, 0
+    )
+    num_leaves = np.where(
+        last_nodes >= 0, node_levels[last_nodes] + 1 - common_levels, 0
+    )
+    num_enters = np.where(nodes >= 0, node_levels[nodes] + 1 - common_levels, 0)
+
+    # position of each event within the events of its sample
+    num_events = num_leaves + num_enters
+    sample = np.repeat(np.arange(len(nodes)), num_events)
+    position = np.arange(len(sample)) - np.repeat(
+        np.cumsum(num_events) - num_events, num_events
+    )
+
+    # the leave events climb up from the last node, and the enter events
+    # climb down to the current node
+    is_leave = position < num_leaves[sample]
+    event_nodes = get_ancestors(
+        node_ancestors,
+        np.where(is_leave, last_nodes[sample], nodes[sample]),
+        np.where(is_leave, position, num_events[sample] - 1 - position),
+    )
+
+    return event_nodes, is_leave, timestamps[sample]
+
+
+def _take_categorical(categorical, indices):
+    """Returns the values of a categorical at the given indices as a new
+    categorical, from their codes, and without any unused categories"""
+    return pd.Categorical.from_codes(
+        categorical.codes[indices], categorical.categories
+    ).remove_unused_categories()
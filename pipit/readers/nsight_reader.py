@@ -3,6 +3,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+import numpy as np
 import pandas as pd
 import pipit.trace
 
@@ -10,97 +11,114 @@ import pipit.trace
 class NsightReader:
     """Reader for Nsight trace files"""
 
-    def __init__(self, file_name) -> None:
+    # the columns of the report that the events are created from
+    event_columns = ["Name", "Start (ns)", "End (ns)", "PID", "TID"]
+
+    def __init__(self, file_name, read_filter=None, columns=None) -> None:
         self.file_name = file_name
         self.df = None
 
+        # the events to read (see pipit.trace.ReadFilter)
+        self.read_filter = read_filter or pipit.trace.ReadFilter()
+
+        # the other columns of the report to read (all of them by default)
+        self.columns = columns
+
     def read(self):
         """
         This read function directly takes in a csv of the trace report and
         utilizes pandas to convert it from a csv into a dataframe.
         """
 
-        # Read in csv
-        self.df = pd.read_csv(self.file_name)
+        # Read in csv, with the names parsed straight into a categorical
+        usecols = None
+        if self.columns is not None:
+            usecols = self.event_columns + [
+                column for column in self.columns if column not in self.event_columns
+            ]
+        df = pd.read_csv(self.file_name, usecols=usecols, dtype={"Name": "category"})
+
+        # The processes and the threads of each process are numbered from 0,
+        # in sorted order of their PIDs and TIDs
+        pid_codes, pids = pd.factorize(df["PID"], sort=True)
+        location_codes = df.groupby(["PID", "TID"], sort=True).ngroup().values
 
-        # Grab the set of the column PID columns to see if
-        # mutliprocess and convert to a list
-        pid = set(self.df["PID"])
+        # row columns of the events, which are shared by the enter and leave
+        # event of each row
+        rows = {}
 
         # check if PID and TID are NOT the same. singlethreaded or multithreaded
-        if self.df["PID"].equals(self.df["TID"]) is False:
-            # Group the pids together and give each process it's own set of threads
-            for i in pid:
-                # Seeing where the rows of the PIDs match. Grabbing the rows in mask
-                mask = self.df["PID"] == i
-                # Creating a set from the matching PID rows dataframe of the TIDs
-                tid = set(self.df[mask]["TID"])
-                # Getting the TID set, creating a dictionary,
-                # and increment the values (0,1,2,...)
-                tid_dict = dict(zip(tid, range(0, len(tid))))
-                # Grabbing the rows with mask and setting the thread column by
-                # mapping the tids with the tid_dict
-                self.df.loc[mask, "Thread"] = self.df["TID"].map(tid_dict)
-            # Converting Thread from float to int
-            self.df["Thread"] = self.df["Thread"].astype(int)
+        if df["PID"].equals(df["TID"]) is False:
+            # The locations of each process are numbered contiguously, so the
+            # threads of a process are numbered from its first location
+            first_locations = np.full(len(pids), len(df), dtype=np.int64)
+            np.minimum.at(first_locations, pid_codes, location_codes)
+            rows["Thread"] = location_codes - first_locations[pid_codes]
 
         # check if PID set is > 1, if so multiprocess or single process
-        if len(pid) > 1:
-            # Set Process column to PID
-            self.df["Process"] = self.df["PID"]
-            # Getting the PID set, creating a dictionary,
-            # and increment the values (0,1,2,...)
-            pid_dict = dict(zip(pid, range(0, len(pid))))
-            # Using the dictionary to replace the Process values
-            self.df["Process"].replace(pid_dict, inplace=True)
-
-        # Copy self.df to create enter and leave rows
-        df2 = self.df.copy()
-
-        # Create new columns for self.df with start time to create enter rows
-        self.df["Event Type"] = "Enter"
-        self.df["Timestamp (ns)"] = self.df["Start (ns)"]
-
-        # Create new columns for df2 with end time to create leave rows
-        df2["Event Type"] = "Leave"
-        df2["Timestamp (ns)"] = df2["End (ns)"]
-
-        # Combine dataframes together
-        self.df = pd.concat([self.df, df2])
-
-        # Tidy Dataframe
-        self.df.drop(["Start (ns)", "End (ns)"], axis=1, inplace=True)
-
-        self.df.sort_values(by="Timestamp (ns)", ascending=True, inplace=True)
-
-        self.df.reset_index(drop=True, inplace=True)
-
-        self.df = self.df.astype(
-            {
-                "Event Type": "category",
-                "Name": "category",
-                "PID": "category",
-                "TID": "category",
-            }
-        )
-
-        # Grabbing the list of columns and rearranging them to put
-        # Timestamp, Event Types, Name, Thread (potentially),
-        # Process(potentially) in the front of the dataframe
-        cols = list(self.df)
-        cols.insert(0, cols.pop(cols.index("Timestamp (ns)")))
-        cols.insert(1, cols.pop(cols.index("Event Type")))
-        cols.insert(2, cols.pop(cols.index("Name")))
-
-        if "Process" in self.df.columns:
-            cols.insert(3, cols.pop(cols.index("Process")))
-            if "Thread" in self.df.columns:
-                cols.insert(3, cols.pop(cols.index("Thread")))
-
-        elif "Thread" in self.df.columns:
-            cols.insert(3, cols.pop(cols.index("Thread")))
-
-        # Applying the column list to the dataframe to rearrange
-        self.df = self.df.loc[:, cols]
+        if len(pids) > 1:
+            rows["Process"] = pid_codes.astype(np.int64)
+
+        # Only keep the rows that match the read filter, and that start or
+        # end in its time range, before creating the enter and leave rows
+        # (which are then filtered by their own timestamps). The processes are
+        # matched by their numbers even if there is no Process column, where
+        # the only process is 0.
+        starts, ends = df["Start (ns)"].values, df["End (ns)"].values
+        row_mask = None
+        if self.read_filter:
+            row_mask = self.read_filter.mask(
+                len(df), None, pid_codes, df["Name"].values
+            )
+            in_time_range = self.read_filter.mask(len(df), starts)
+            in_time_range |= self.read_filter.mask(len(df), ends)
+            row_mask &= in_time_range
+
+        # Interleave the enter and leave rows (the enter row of each event
+        # is right before its leave row), and sort them by time with a stable
+        # sort, which keeps them in that order for events with the same
+        # timestamps
+        timestamps = np.empty(2 * len(df), dtype=np.result_type(starts, ends))
+        timestamps[0::2], timestamps[1::2] = starts, ends
+        event_rows = np.repeat(np.arange(len(df)), 2)
+        is_leave = np.tile(np.array([0, 1], dtype=np.int8), len(df))
+
+        if row_mask is not None:
+            event_mask = np.repeat(row_mask, 2) & self.read_filter.mask(
+                len(timestamps), timestamps
+            )
+            timestamps = timestamps[event_mask]
+            event_rows, is_leave = event_rows[event_mask], is_leave[event_mask]
+
+        order = np.argsort(timestamps, kind="stable")
+        timestamps = timestamps[order]
+        event_rows, is_leave = event_rows[order], is_leave[order]
+
+        # The columns of the events are gathered from the columns of their
+        # rows, once each (with the categoricals gathered as codes)
+        events = {
+            "Timestamp (ns)": timestamps,
+            "Event Type": pd.Categorical.from_codes(is_leave, ["Enter", "Leave"]),
+            "Name": df["Name"].values[event_rows],
+        }
+        for column, values in rows.items():
+            events[column] = values[event_rows]
+
+        # The other columns of the report follow, in their order
+        for column in df.columns:
+            if column in ["PID", "TID"]:
+                codes, categories = pd.factorize(df[column], sort=True)
+                events[column] = pd.Categorical.from_codes(
+                    codes[event_rows], categories
+                )
+            elif column not in ["Name", "Start (ns)", "End (ns)"]:
+                events[column] = df[column].values[event_rows]
+
+        # the categories of the events that were filtered out are dropped
+        if row_mask is not None:
+            for column in ["Event Type", "Name", "PID", "TID"]:
+                events[column] = events[column].remove_unused_categories()
+
+        self.df = pd.DataFrame(events, copy=False)
 
         return pipit.trace.Trace(None, self.df)
@@ -8,16 +8,57 @@ import numpy as np
 import pandas as pd
 import multiprocessing as mp
 import pipit.trace
+from pipit.parallel import concat_columns, run_dynamic, schedule_items, sort_columns
 
 
 class OTF2Reader:
     """Reader for OTF2 trace files"""
 
-    def __init__(self, dir_name, num_processes=None):
+    # attributes of the MPI message events that can be read into typed
+    # columns (of the attribute key and dtype of each column)
+    message_columns = {
+        "Sender": ("sender", "Int32"),
+        "Receiver": ("receiver", "Int32"),
+        "Msg Length": ("msg_length", "Int64"),
+        "Tag": ("msg_tag", "Int64"),
+        "Communicator": ("communicator", "category"),
+    }
+
+    def __init__(
+        self,
+        dir_name,
+        num_processes=None,
+        message_columns=False,
+        schedule="dynamic",
+        executor=None,
+        read_filter=None,
+        order="time",
+    ):
         self.dir_name = dir_name  # directory of otf2 file being read
         self.file_name = self.dir_name + "/traces.otf2"
 
+        # whether to read message attributes into typed columns
+        # (if "only", the Attributes column isn't created)
+        self.promote_message_columns = message_columns
+
+        # how to split the locations among the processes (see schedule_items)
+        self.schedule = schedule
+
+        # a shared Executor to read the events with (see run_dynamic)
+        self.executor = executor
+
+        # the events to read (see pipit.trace.ReadFilter)
+        self.read_filter = read_filter or pipit.trace.ReadFilter()
+
+        # order of the events, "time" or "location" (grouped by location, and
+        # in time order within each location)
+        self.order = order
+
         num_cpus = mp.cpu_count()
+        if executor is not None:
+            # the workers of a shared executor are all used by default
+            num_cpus = executor.num_processes
+
         if num_processes is None or num_processes < 1 or num_processes > num_cpus:
             # uses all processes to parallelize reading by default
             self.num_processes = num_cpus
@@ -140,90 +181,82 @@ class OTF2Reader:
         else:
             return fields_dict
 
-    def events_reader(self, rank_size):
+    def events_reader(self, location_range):
         """
         Serial events reader that reads a subset of the trace
 
         Arguments:
-        rank_size: a tuple containing the rank of the process
-        and the size/total number of processors that are being used
+        location_range: a tuple of the first and (one past the) last index of
+        the locations to read, in the locations that are selected by the
+        read filter
 
         Returns:
         a dictionary with a subset of the trace events that can be converted
         to a dataframe
         """
+        return next(self.iter_event_columns(location_range))
 
-        with otf2.reader.open(self.file_name) as trace:
-            # extracts the rank and size
-            # and gets all the locations
-            # of the trace
-            rank, size = rank_size[0], rank_size[1]
-            locations = list(trace.definitions._locations)
-            num_locations = len(locations)
+    def iter_event_columns(self, location_range, chunk_size=None):
+        """
+        Yields the events of a subset of the trace (see events_reader) in
+        chunks of chunk_size events, in time order (or grouped by location if
+        the order of the reader is "location"), or all of them at once if
+        chunk_size is None
+        """
 
-            # base number of locations read by each process
-            per_process = int(num_locations // size)
+        # the message attributes are read straight into typed columns, and
+        # the Attributes dicts aren't built at all if they would be dropped
+        message_columns = self.message_columns if self.promote_message_columns else {}
+        keep_attributes = self.promote_message_columns != "only"
+
+        def event_columns():
+            # the typed columns of the events, which are sent back to the
+            # parent process through shared memory (the attributes are
+            # pickled)
+            columns = {
+                "Timestamp (ns)": np.array(timestamps, dtype=np.int64),
+                "Event Type": pd.Categorical(event_types),
+                "Name": pd.Categorical(names),
+                "Thread": np.array(thread_ids, dtype=np.int64),
+                "Process": np.array(process_ids, dtype=np.int64),
+            }
 
-            # remainder number of locations to be split evenly
-            remainder = int(num_locations % size)
+            if keep_attributes:
+                columns["Attributes"] = np.array(event_attributes, dtype=object)
 
-            if rank < remainder:
-                """
-                Example:
-                For the reading of 30 locations split over 14 processes,
-                first 2 processes will read 3 locations each since the remainder
-                is 2.
-                """
-                begin_int = rank * (per_process + 1)
-                end_int = (rank + 1) * (per_process + 1)
-            else:
-                """
-                Example:
-                For the reading of 30 locations split over 14 processes,
-                last 12 processes will read 2 locations each. The starting index
-                accounts for the fact that the first two will read 3 locations each.
-                """
-                begin_int = (rank * per_process) + remainder
-                end_int = ((rank + 1) * per_process) + remainder
+            for column, (_, dtype) in message_columns.items():
+                columns[column] = pd.array(message_values[column], dtype=dtype)
+
+            # metrics that are defined but don't appear in the trace are
+            # dropped once the events of all the locations are read
+            for metric, metric_values in metrics_dict.items():
+                columns[metric] = np.array(metric_values, dtype=np.float64)
 
-            # select the locations to read based on above calculations
-            loc_events = list(trace.events(locations[begin_int:end_int]).__iter__())
+            return columns
+
+        with otf2.reader.open(self.file_name) as trace:
+            # gets all the locations of the trace
+            begin_int, end_int = location_range
+            locations = list(trace.definitions._locations)
+
+            # select the locations of the range to read
+            locations = [locations[i] for i in self.read_locations[begin_int:end_int]]
+            if self.order == "location":
+                # the events of each location are read one after the other,
+                # so that they are grouped by location without being sorted
+                location_groups = [[location] for location in locations]
+            else:
+                location_groups = [locations] if len(locations) else []
 
             # columns of the DataFrame
             timestamps, event_types, event_attributes, names = [], [], [], []
+            message_values = {column: [] for column in message_columns}
 
             # note: the below lists are for storing logical ids
             process_ids, thread_ids = [], []
 
-            """
-            Relevant Documentation for Metrics:
-            https://scorepci.pages.jsc.fz-juelich.de/otf2-pipelines/doc.r4707/python/basics.html#metrics
-            """
-
-            # get members of metric class
-            metric_members = (
-                self.definitions.loc[
-                    self.definitions["Definition Type"] == "MetricClass"
-                ]["Attributes"]
-                .map(lambda attr: attr["members"])
-                .values
-            )
-            metric_members = [] if len(metric_members) == 0 else metric_members[0]
-
-            # ids of metric members
-            metric_ids = list(
-                map(lambda metric_member: int(metric_member[-1]), metric_members)
-            )
-
             # names of metrics
-            metric_names = (
-                self.definitions.loc[
-                    (self.definitions["Definition Type"] == "MetricMember")
-                    & (self.definitions["ID"].isin(metric_ids))
-                ]["Attributes"]
-                .map(lambda attr: attr["name"])
-                .values
-            )
+            metric_names = self.get_metric_names()
 
             # maps each metric to a list of its values
             metrics_dict = {metric_name: [] for metric_name in metric_names}
@@ -232,120 +265,169 @@ class OTF2Reader:
             # most recent metrics that were read at
             prev_metric_time = -1
 
-            # iterates through the events and processes them
-            for loc_event in loc_events:
-                # extracts the location and event
-                # location could be thread, process, etc
-                loc, event = loc_event[0], loc_event[1]
-
-                # To Do:
-                # Support for GPU events has to be
-                # added and unified across readers.
-                if str(loc.type)[13:] == "CPU_THREAD":
-                    # don't add metric events as a separate row,
-                    # and add their values into columns instead
-                    if isinstance(event, otf2.events.Metric):
-                        # Since the location is a cpu thread, we know
-                        # that the metric event is of type MetricClass,
-                        # which has a list of MetricMembers.
-                        metrics = list(
-                            map(lambda metric: metric.name, event.metric.members)
-                        )
-                        metric_values = event.values
-
-                        # append the values for the metrics
-                        # to their appropriate lists
-                        for i in range(len(metrics)):
-                            metrics_dict[metrics[i]].append(metric_values[i])
-
-                        # store the metrics and their timestamp
-                        prev_metric_time = event.time
-                    else:
-                        # MetricClass metric events are synchronous
-                        # and coupled with an enter or leave event that
-                        # has the same timestamp
-                        if event.time != prev_metric_time:
-                            # if the event is not paired with any metric, then
-                            # add placeholders for all the metric lists
-                            for metric in metric_names:
-                                metrics_dict[metric].append(float("nan"))
-
-                        # reset this as a metric event was not read
-                        prev_metric_time = -1
-
-                        """
-                        Below is code to read the primary information about the
-                        non-metric event, such as location, attributes, etc.
-                        """
-
-                        process_id = loc.group._ref
-                        process_ids.append(process_id)
-
-                        # subtract the minimum location number of a process
-                        # from the location number to get threads numbered
-                        # 0 to (num_threads per process - 1) for each process.
-                        thread_ids.append(
-                            loc._ref - self.process_threads_map[process_id]
-                        )
-
-                        # type of event - enter, leave, or other types
-                        event_type = str(type(event))[20:-2]
-                        if event_type == "Enter" or event_type == "Leave":
-                            event_types.append(event_type)
-                        else:
-                            event_types.append("Instant")
-
-                        if event_type in ["Enter", "Leave"]:
-                            names.append(event.region.name)
+            # the time range of the read filter, in the clock ticks of the
+            # events
+            read_filter = self.read_filter
+            offset, resolution = self.get_clock_properties()
+
+            for location_group in location_groups:
+                # iterates through the events and processes them
+                for loc_event in trace.events(location_group):
+                    # extracts the location and event
+                    # location could be thread, process, etc
+                    loc, event = loc_event[0], loc_event[1]
+
+                    # To Do:
+                    # Support for GPU events has to be
+                    # added and unified across readers.
+                    if str(loc.type)[13:] == "CPU_THREAD":
+                        # don't add metric events as a separate row,
+                        # and add their values into columns instead
+                        if isinstance(event, otf2.events.Metric):
+                            # Since the location is a cpu thread, we know
+                            # that the metric event is of type MetricClass,
+                            # which has a list of MetricMembers.
+                            metrics = list(
+                                map(lambda metric: metric.name, event.metric.members)
+                            )
+                            metric_values = event.values
+
+                            # append the values for the metrics
+                            # to their appropriate lists
+                            for i in range(len(metrics)):
+                                metrics_dict[metrics[i]].append(metric_values[i])
+
+                            # store the metrics and their timestamp
+                            prev_metric_time = event.time
                         else:
-                            names.append(event_type)
-
-                        timestamps.append(event.time)
-
-                        # only add attributes for non-leave rows so that
-                        # there aren't duplicate attributes for a single event
-                        if event_type != "Leave":
-                            attributes_dict = {}
-
-                            # iterates through the event's attributes
-                            # (ex: region, bytes sent, etc)
-                            for key, value in vars(event).items():
-                                # only adds non-empty attributes
-                                # and ignores time so there isn't a duplicate time
-                                if value is not None and key != "time":
-                                    # uses field_to_val to convert all data types
-                                    # and ensure that there are no pickling errors
-                                    attributes_dict[
-                                        self.field_to_val(key)
-                                    ] = self.handle_data(value)
-                            event_attributes.append(attributes_dict)
-                        else:
-                            # nan attributes for leave rows
-                            # attributes column is of object dtype
-                            event_attributes.append(None)
+                            # MetricClass metric events are synchronous
+                            # and coupled with an enter or leave event that
+                            # has the same timestamp
+                            if event.time != prev_metric_time:
+                                # if the event is not paired with any metric, then
+                                # add placeholders for all the metric lists
+                                for metric in metric_names:
+                                    metrics_dict[metric].append(float("nan"))
+
+                            # reset this as a metric event was not read
+                            prev_metric_time = -1
+
+                            # type of event - enter, leave, or other types
+                            event_type = str(type(event))[20:-2]
+                            if event_type in ["Enter", "Leave"]:
+                                name = event.region.name
+                            else:
+                                name = event_type
+
+                            if read_filter:
+                                timestamp = (event.time - offset) * (
+                                    (10**9) / resolution
+                                )
+                                if not (
+                                    read_filter.keeps_time(timestamp)
+                                    and read_filter.keeps_name(name)
+                                ):
+                                    # drop the metrics of the skipped event
+                                    for values in metrics_dict.values():
+                                        del values[len(timestamps) :]
+
+                                    # the events are read in time order, so
+                                    # the events of the locations after the
+                                    # time range are all skipped
+                                    if read_filter.end is not None and (
+                                        timestamp >= read_filter.end
+                                    ):
+                                        break
+                                    continue
+
+                            """
+                            Below is code to read the primary information about the
+                            non-metric event, such as location, attributes, etc.
+                            """
+
+                            process_id = loc.group._ref
+                            process_ids.append(process_id)
+
+                            # subtract the minimum location number of a process
+                            # from the location number to get threads numbered
+                            # 0 to (num_threads per process - 1) for each process.
+                            thread_ids.append(
+                                loc._ref - self.process_threads_map[process_id]
+                            )
+
+                            if event_type == "Enter" or event_type == "Leave":
+                                event_types.append(event_type)
+                            else:
+                                event_types.append("Instant")
+
+                            names.append(name)
+
+                            timestamps.append(event.time)
+
+                            # only add attributes for non-leave rows so that
+                            # there aren't duplicate attributes for a single event
+                            if event_type != "Leave":
+                                if keep_attributes:
+                                    attributes_dict = {}
+
+                                    # iterates through the event's attributes
+                                    # (ex: region, bytes sent, etc)
+                                    for key, value in vars(event).items():
+                                        # only adds non-empty attributes and
+                                        # ignores time so there isn't a
+                                        # duplicate time
+                                        if value is not None and key != "time":
+                                            # uses field_to_val to convert all
+                                            # data types and ensure that there
+                                            # are no pickling errors
+                                            attributes_dict[
+                                                self.field_to_val(key)
+                                            ] = self.handle_data(value)
+                                    event_attributes.append(attributes_dict)
+
+                                # the message attributes of the event (null
+                                # if it doesn't have them)
+                                for column, (key, _) in message_columns.items():
+                                    value = getattr(event, key, None)
+                                    if value is not None:
+                                        value = self.handle_data(value)
+                                    message_values[column].append(value)
+                            else:
+                                # nan attributes for leave rows
+                                # attributes column is of object dtype
+                                if keep_attributes:
+                                    event_attributes.append(None)
+                                for values in message_values.values():
+                                    values.append(None)
+
+                            if len(timestamps) == chunk_size:
+                                yield event_columns()
+
+                                timestamps, event_types, event_attributes = [], [], []
+                                names, process_ids, thread_ids = [], [], []
+                                metrics_dict = {metric: [] for metric in metric_names}
+                                message_values = {
+                                    column: [] for column in message_columns
+                                }
+
+            if chunk_size is None or len(timestamps) > 0:
+                yield event_columns()
 
             trace.close()  # close event files
 
-        # returns dataframe with all events and their fields
-        trace_df = pd.DataFrame(
-            {
-                "Timestamp (ns)": timestamps,
-                "Event Type": event_types,
-                "Name": names,
-                "Thread": thread_ids,
-                "Process": process_ids,
-                "Attributes": event_attributes,
-            }
-        )
-
-        for metric, metric_values in metrics_dict.items():
-            # only add columns of metrics which are populated with
-            # some values (sometimes a metric could be defined but not
-            # appear in the trace itself)
-            if not np.isnan(metric_values).all():
-                trace_df[metric] = metric_values
+    def iter_events(self, chunk_size):
+        """
+        Yields the events of the trace as DataFrames of at most chunk_size
+        events in the order of the reader, so that traces that don't fit in
+        memory can be summarized one chunk at a time (all the defined metrics
+        are columns of every chunk)
+        """
 
-        return trace_df
+        self.read_header()
+        for columns in self.iter_event_columns(
+            (0, len(self.read_locations)), chunk_size
+        ):
+            yield self.build_events_dataframe(columns)
 
     def read_definitions(self, trace):
         """
@@ -432,48 +514,119 @@ class OTF2Reader:
 
         return definitions_dataframe
 
-    def read_events(self):
+    def get_metric_names(self):
         """
-        Writes the events to a Pandas DataFrame
-        using the multiprocessing library and the events_reader
-        function
+        Returns the names of the metrics defined in the trace, which are read
+        into a column each
+
+        Relevant Documentation for Metrics:
+        https://scorepci.pages.jsc.fz-juelich.de/otf2-pipelines/doc.r4707/python/basics.html#metrics
         """
 
-        # parallelizes the reading of events
-        # using the multiprocessing library
-        pool_size, pool = self.num_processes, mp.Pool(self.num_processes)
+        # get members of metric class
+        metric_members = (
+            self.definitions.loc[self.definitions["Definition Type"] == "MetricClass"][
+                "Attributes"
+            ]
+            .map(lambda attr: attr["members"])
+            .values
+        )
+        metric_members = [] if len(metric_members) == 0 else metric_members[0]
+
+        # ids of metric members
+        metric_ids = list(
+            map(lambda metric_member: int(metric_member[-1]), metric_members)
+        )
 
-        # list of dataframes returned by the processes pool
-        events_dataframes = pool.map(
-            self.events_reader, [(rank, pool_size) for rank in range(pool_size)]
+        # names of metrics
+        metric_names = (
+            self.definitions.loc[
+                (self.definitions["Definition Type"] == "MetricMember")
+                & (self.definitions["ID"].isin(metric_ids))
+            ]["Attributes"]
+            .map(lambda attr: attr["name"])
+            .values
         )
 
-        pool.close()
+        return list(metric_names)
 
-        # merges the dataframe into one events dataframe
-        events_dataframe = pd.concat(events_dataframes)
-        del events_dataframes
+    def get_clock_properties(self):
+        """
+        Returns the global offset and timer resolution of the trace, which
+        convert the timestamps of the events to nanoseconds
+        """
 
         # accessing the clock properties of the trace using the definitions
         clock_properties = self.definitions.loc[
             self.definitions["Definition Type"] == "ClockProperties"
         ]["Attributes"].values[0]
-        offset, resolution = (
+
+        return (
             clock_properties["global_offset"],
             clock_properties["timer_resolution"],
         )
 
+    def read_events(self):
+        """
+        Writes the events to a Pandas DataFrame
+        using the multiprocessing library and the events_reader
+        function
+        """
+
+        # parallelizes the reading of events using the multiprocessing
+        # library, over ranges of locations that are balanced by their
+        # numbers of events
+        tasks, task_events = schedule_items(
+            self.location_events, self.num_processes, self.schedule
+        )
+        if len(tasks) == 0:
+            # no locations are selected, which gives no events
+            tasks, task_events = [(0, 0)], [0]
+
+        # columns of the events returned by the processes pool
+        columns = concat_columns(
+            run_dynamic(
+                self.events_reader,
+                tasks,
+                self.num_processes,
+                task_events,
+                self.executor,
+                share_results=True,
+            )
+        )
+
+        # only add columns of metrics which are populated with some values
+        # (sometimes a metric could be defined but not appear in the trace
+        # itself)
+        for metric in self.get_metric_names():
+            if metric in columns and np.isnan(columns[metric]).all():
+                del columns[metric]
+
+        return self.build_events_dataframe(columns)
+
+    def build_events_dataframe(self, columns):
+        """
+        Creates the events DataFrame from the columns of the events read by
+        events_reader
+        """
+
+        # ensures the events are in order of increasing timestamp, by merging
+        # the time-ordered events of the tasks
+        if self.order == "time":
+            columns = sort_columns(columns, "Timestamp (ns)")
+
+        # merges the columns into one events dataframe, without copying them
+        events_dataframe = pd.DataFrame(columns, copy=False)
+        del columns
+
+        offset, resolution = self.get_clock_properties()
+
         # shifting the timestamps by the global offset
         # and dividing by the resolution to convert to nanoseconds
         # as per OTF2's website
         events_dataframe["Timestamp (ns)"] -= offset
         events_dataframe["Timestamp (ns)"] *= (10**9) / resolution
 
-        # ensures the DataFrame is in order of increasing timestamp
-        events_dataframe.sort_values(
-            by="Timestamp (ns)", axis=0, ascending=True, inplace=True, ignore_index=True
-        )
-
         # convert these to ints
         # (sometimes they get converted to floats
         #  while concatenating dataframes)
@@ -494,26 +647,47 @@ class OTF2Reader:
 
         return events_dataframe
 
-    def read(self):
+    def read_header(self):
         """
-        Returns a Trace object for the otf2 file
-        that has one definitions DataFrame and another
-        events DataFrame as its primary attributes
+        Reads the definitions of the trace, and the locations whose events
+        are read
         """
 
         with otf2.reader.open(self.file_name) as trace:  # noqa: F821
             self.definitions = self.read_definitions(trace)  # definitions
 
+            # the locations of the processes selected by the read filter
+            # (all of them by default), whose events are read
+            locations = list(trace.definitions._locations)
+            self.read_locations = [
+                i
+                for i, location in enumerate(locations)
+                if self.read_filter.keeps_process(location.group._ref)
+            ]
+
             # if a trace has n locations, we should only parallelize
             # the reading of events over a number of processes
             # equal to n at a maximum
-            num_locations = len(trace.definitions._locations)
+            num_locations = len(self.read_locations)
             if self.num_processes > num_locations:
-                self.num_processes = num_locations
+                self.num_processes = max(num_locations, 1)
+
+            # the number of events of each location, to balance the reading
+            self.location_events = [
+                locations[i].number_of_events for i in self.read_locations
+            ]
 
             # close the trace and open it later per process
             trace.close()
 
+    def read(self):
+        """
+        Returns a Trace object for the otf2 file
+        that has one definitions DataFrame and another
+        events DataFrame as its primary attributes
+        """
+
+        self.read_header()
         self.events = self.read_events()  # events
 
         return pipit.trace.Trace(self.definitions, self.events)
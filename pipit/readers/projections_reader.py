@@ -7,6 +7,8 @@
 import os
 import gzip
 import pipit.trace
+from pipit.parallel import concat_columns, run_dynamic, schedule_items, sort_columns
+import numpy as np
 import pandas as pd
 import multiprocessing as mp
 
@@ -82,10 +84,237 @@ class ProjectionsConstants:
     # INIT_BARRIER_PHASE_2     = 19;
 
 
+# The format of each type of log record that is read, as a tuple of:
+#   - how to get the name of its events, as a (kind, argument) field
+#   - the event type of each of its events, with how to get its timestamp
+#   - the (attribute name, kind, argument) fields of its attributes
+# The argument of a field is usually the index of the token that it is read
+# from (token 0 is the record type), see _convert_field for the kinds of fields
+_record_formats = {
+    ProjectionsConstants.BEGIN_IDLE: (
+        ("value", "Idle"),
+        [("Enter", ("time", 1))],
+        [("From PE", "int", 2)],
+    ),
+    ProjectionsConstants.END_IDLE: (
+        ("value", "Idle"),
+        [("Leave", ("time", 1))],
+        [("From PE", "int", 2)],
+    ),
+    # Pack message to be sent
+    ProjectionsConstants.BEGIN_PACK: (
+        ("value", "Pack"),
+        [("Enter", ("time", 1))],
+        [("From PE", "int", 2)],
+    ),
+    ProjectionsConstants.END_PACK: (
+        ("value", "Pack"),
+        [("Leave", ("time", 1))],
+        [("From PE", "int", 2)],
+    ),
+    # Unpacking a received message
+    ProjectionsConstants.BEGIN_UNPACK: (
+        ("value", "Unpack"),
+        [("Enter", ("time", 1))],
+        [("From PE", "int", 2)],
+    ),
+    ProjectionsConstants.END_UNPACK: (
+        ("value", "Unpack"),
+        [("Leave", ("time", 1))],
+        [("From PE", "int", 2)],
+    ),
+    ProjectionsConstants.USER_SUPPLIED: (
+        ("value", "User Supplied"),
+        [("Instant", ("value", -1))],
+        [("User Supplied", "str", 1)],
+    ),
+    ProjectionsConstants.USER_SUPPLIED_NOTE: (
+        ("value", "User Supplied Note"),
+        [("Instant", ("time", 1))],
+        [("Note", "note", (2, ""))],
+    ),
+    # Not sure if this should be instant or enter/leave
+    ProjectionsConstants.USER_SUPPLIED_BRACKETED_NOTE: (
+        ("value", "User Supplied Bracketed Note"),
+        [("Enter", ("time", 1)), ("Leave", ("time", 2))],
+        [
+            ("Event ID", "int", 3),
+            ("Event Name", "user event", 3),
+            ("Note", "note", (4, '"')),
+        ],
+    ),
+    # Memory Usage at timestamp
+    ProjectionsConstants.MEMORY_USAGE: (
+        ("value", "Memory Usage"),
+        [("Instant", ("time", 2))],
+        [("Memory Usage", "int", 1)],
+    ),
+    # New chare create message being sent
+    ProjectionsConstants.CREATION: (
+        ("entry", 2),
+        [("Instant", ("time", 3))],
+        [
+            ("From PE", "int", 5),
+            ("MType", "int", 1),
+            ("Entry Type", "value", "Create"),
+            ("Message Length", "int", 6),
+            ("Event ID", "int", 4),
+            ("Send Time", "time", 7),
+        ],
+    ),
+    ProjectionsConstants.CREATION_MULTICAST: (
+        ("entry", 2),
+        [("Instant", ("time", 3))],
+        [
+            ("From PE", "int", 5),
+            ("Message Type", "int", 1),
+            ("Entry Type", "value", "Multicast"),
+            ("Message Length", "int", 6),
+            ("Event ID", "int", 4),
+            ("Send Time", "time", 7),
+            ("Destination PEs", "int list", 9),
+        ],
+    ),
+    # Processing of chare (i.e. execution) ?
+    ProjectionsConstants.BEGIN_PROCESSING: (
+        ("entry", 2),
+        [("Enter", ("time", 3))],
+        [
+            ("From PE", "int", 5),
+            ("Message Type", "int", 1),
+            ("Entry Type", "value", "Processing"),
+            ("Event ID", "int", 4),
+            ("Message Length", "int", 6),
+            ("Recieve Time", "int", 7),
+            ("ID List", "ids", 8),
+            ("CPU Start Time", "int after ids", 8),
+            ("perf counts list", "perf counts", 9),
+        ],
+    ),
+    ProjectionsConstants.END_PROCESSING: (
+        ("entry", 2),
+        [("Leave", ("time", 3))],
+        [],
+    ),
+    # For selective tracing - when trace is called inside code
+    ProjectionsConstants.BEGIN_TRACE: (
+        ("value", "Trace"),
+        [("Enter", ("time", 1))],
+        [],
+    ),
+    ProjectionsConstants.END_TRACE: (
+        ("value", "Trace"),
+        [("Leave", ("time", 1))],
+        [],
+    ),
+    # Message Receive ?
+    ProjectionsConstants.MESSAGE_RECV: (
+        ("value", "Message Receive"),
+        [("Instant", ("time", 2))],
+        [
+            ("From PE", "int", 4),
+            ("Message Type", "int", 1),
+            ("Event ID", "int", 3),
+            ("Message Length", "int", 5),
+        ],
+    ),
+    # queueing creation ?
+    ProjectionsConstants.ENQUEUE: (
+        ("value", "Enque"),
+        [("Instant", ("time", 2))],
+        [("From PE", "int", 4), ("Message Type", "int", 1), ("Event ID", "int", 3)],
+    ),
+    ProjectionsConstants.DEQUEUE: (
+        ("value", "Deque"),
+        [("Instant", ("time", 2))],
+        [("From PE", "int", 4), ("Message Type", "int", 1), ("Event ID", "int", 3)],
+    ),
+    # Interrupt from different chare ?
+    ProjectionsConstants.BEGIN_INTERRUPT: (
+        ("value", "Interrupt"),
+        [("Enter", ("time", 1))],
+        [("From PE", "int", 3), ("Event ID", "int", 2)],
+    ),
+    ProjectionsConstants.END_INTERRUPT: (
+        ("value", "Interrupt"),
+        [("Leave", ("time", 1))],
+        [("From PE", "int", 3), ("Event ID", "int", 2)],
+    ),
+    # Very start of the program - encapsulates every other event
+    ProjectionsConstants.BEGIN_COMPUTATION: (
+        ("value", "Computation"),
+        [("Enter", ("time", 1))],
+        [],
+    ),
+    ProjectionsConstants.END_COMPUTATION: (
+        ("value", "Computation"),
+        [("Leave", ("time", 1))],
+        [],
+    ),
+    # User event (in code)
+    ProjectionsConstants.USER_EVENT: (
+        ("user event", 1),
+        [("Instant", ("time", 2))],
+        [
+            ("From PE", "int", 4),
+            ("Event ID", "int", 3),
+            ("Event Type", "value", "User Event"),
+        ],
+    ),
+    ProjectionsConstants.USER_EVENT_PAIR: (
+        ("user event", 1),
+        [("Instant", ("time", 2))],
+        [
+            ("From PE", "int", 4),
+            ("Event ID", "int", 3),
+            ("Nested ID", "int", 5),
+            ("Event Type", "value", "User Event Pair"),
+        ],
+    ),
+    ProjectionsConstants.BEGIN_USER_EVENT_PAIR: (
+        ("value", "User Event Pair"),
+        [("Enter", ("time", 2))],
+        [
+            ("From PE", "int", 4),
+            ("Event ID", "int", 3),
+            ("Nested ID", "int", 5),
+            ("User Event Name", "user event", 1),
+        ],
+    ),
+    ProjectionsConstants.END_USER_EVENT_PAIR: (
+        ("value", "User Event Pair"),
+        [("Leave", ("time", 2))],
+        [
+            ("From PE", "int", 4),
+            ("Event ID", "int", 3),
+            ("Nested ID", "int", 5),
+            ("User Event Name", "user event", 1),
+        ],
+    ),
+    # User stat (in code)
+    ProjectionsConstants.USER_STAT: (
+        ("user stat", 5),
+        [("Instant", ("time", 1))],
+        [
+            ("From PE", "int", 4),
+            ("User Time", "time", 2),
+            ("Stat", "float", 3),
+            ("Event Type", "value", "User Stat"),
+        ],
+    ),
+}
+
+# the event types of the records, which are read as codes into this list
+_event_types = ["Enter", "Instant", "Leave"]
+
+
+# the bytes that bytes.split() splits on
+_is_whitespace = np.zeros(256, dtype=bool)
+_is_whitespace[list(b" \t\n\r\x0b\x0c")] = True
+
+
 class STSReader:
     def __init__(self, file_location):
-        self.sts_file = open(file_location, "r")  # self.chares = {}
-
         # In 'self.entries', each entry stores (entry_name: str, chare_id: int)
         self.entries = {}
 
@@ -95,7 +324,10 @@ class STSReader:
         # Stores user stat names: {user_event_id: user stat name}
         self.user_stats = {}
 
-        self.read_sts_file()
+        with open(file_location, "r") as sts_file:
+            self.read_sts_file(sts_file)
+
+        self.build_name_codes()
 
     # to get name of entry print <name of chare + :: + name of entry>>
     def get_entry_name(self, entry_id):
@@ -133,8 +365,8 @@ class STSReader:
     def get_event_name(self, event_id):
         return self.user_events[event_id]
 
-    def read_sts_file(self):
-        for line in self.sts_file:
+    def read_sts_file(self, sts_file):
+        for line in sts_file:
             line_arr = line.split()
 
             # Note: I'm disregarding TOTAL_STATS and TOTAL_EVENTS, because
@@ -221,11 +453,61 @@ class STSReader:
                 papi_event = line_arr[2]
                 self.papi_event_names[id] = papi_event
 
-        self.sts_file.close()
+    def build_name_codes(self):
+        """
+        Builds the table of all the names that events can have (the names of
+        the entries, user events and user stats, and the names of the other
+        record types), so that the log files can be read with integer codes
+        for the names of their events, which index into self.names
+        """
+        self.names = []
+        self.name_codes = {}
+
+        def add_name(name):
+            if name not in self.name_codes:
+                self.name_codes[name] = len(self.names)
+                self.names.append(name)
+            return self.name_codes[name]
+
+        for (name_kind, name), _, _ in _record_formats.values():
+            if name_kind == "value":
+                add_name(name)
+
+        # codes of the entries by their id (unknown entries have no name)
+        num_entries = max(self.entries, default=-1) + 1
+        self.entry_codes = np.full(num_entries, add_name(""), dtype=np.int64)
+        for entry_id in self.entries:
+            self.entry_codes[entry_id] = add_name(self.get_entry_name(entry_id))
+
+        self.user_event_codes = {
+            user_event_id: add_name(name)
+            for user_event_id, name in self.user_events.items()
+        }
+        self.user_stat_codes = {
+            user_event_id: add_name(name)
+            for user_event_id, name in self.user_stats.items()
+        }
 
 
 class ProjectionsReader:
-    def __init__(self, projections_directory: str, num_processes=None) -> None:
+    # attributes of the message events that can be promoted to typed
+    # columns, see Trace.promote_attributes
+    message_columns = {
+        "Sender": ("From PE", "Int32"),
+        "Msg Length": ("Message Length", "Int64"),
+        "Event ID": ("Event ID", "Int64"),
+    }
+
+    def __init__(
+        self,
+        projections_directory: str,
+        num_processes=None,
+        message_columns=False,
+        schedule="dynamic",
+        executor=None,
+        read_filter=None,
+        order="time",
+    ) -> None:
         if not os.path.isdir(projections_directory):
             raise ValueError("Not a valid directory.")
 
@@ -246,7 +528,9 @@ class ProjectionsReader:
         if not hasattr(self, "executable_location"):
             raise ValueError("Invalid directory for projections - no sts files found.")
 
-        self.num_pes = STSReader(self.executable_location + ".sts").num_pes
+        # the sts file is only read once, and shared with all the processes
+        self.sts_reader = STSReader(self.executable_location + ".sts")
+        self.num_pes = self.sts_reader.num_pes
 
         # make sure all the log files exist
         for i in range(self.num_pes):
@@ -264,540 +548,417 @@ class ProjectionsReader:
                 )
 
         num_cpus = mp.cpu_count()
+        if executor is not None:
+            # the workers of a shared executor are all used by default
+            num_cpus = executor.num_processes
+
         if num_processes is None or num_processes < 1 or num_processes > num_cpus:
             # uses all processes to parallelize reading by default
             self.num_processes = num_cpus
         else:
             self.num_processes = num_processes
 
-    # Returns an empty dict, used for reading log file into dataframe
-    @staticmethod
-    def _create_empty_dict() -> dict:
-        return {
-            "Name": [],
-            "Event Type": [],
-            "Timestamp (ns)": [],
-            "Process": [],
-            "Attributes": [],
-        }
+        # whether to promote message attributes to typed columns
+        # (if "only", the Attributes column is dropped afterwards)
+        self.promote_message_columns = message_columns
+
+        # how to split the PEs among the processes (see schedule_items)
+        self.schedule = schedule
+
+        # a shared Executor to read the log files with (see run_dynamic)
+        self.executor = executor
+
+        # the events to read (see pipit.trace.ReadFilter), where only the log
+        # files of the selected PEs are read
+        self.read_filter = read_filter or pipit.trace.ReadFilter()
+
+        # order of the events, "time" or "location" (grouped by PE, and in
+        # time order within each PE)
+        self.order = order
+        self.read_pes = [
+            pe for pe in range(self.num_pes) if self.read_filter.keeps_process(pe)
+        ]
 
     def read(self):
         if self.num_pes < 1:
             return None
 
-        if self.num_processes > self.num_pes:
-            self.num_processes = self.num_pes
-
-        pool_size, pool = self.num_processes, mp.Pool(self.num_processes)
+        if self.num_processes > len(self.read_pes):
+            self.num_processes = max(len(self.read_pes), 1)
 
-        # Read each log file and store as list of dataframes
-        dataframes_list = pool.map(
-            self._read_log_file, [(rank, pool_size) for rank in range(pool_size)]
+        # Read the log files in ranges of PEs, which are balanced by the sizes
+        # of their log files, whose columns are sent back from the processes
+        # through shared memory
+        log_sizes = [
+            os.path.getsize(self.executable_location + "." + str(pe) + ".log.gz")
+            for pe in self.read_pes
+        ]
+        tasks, task_sizes = schedule_items(log_sizes, self.num_processes, self.schedule)
+        if len(tasks) == 0:
+            # no PEs are selected, which gives no events
+            tasks, task_sizes = [(0, 0)], [0]
+        columns = concat_columns(
+            run_dynamic(
+                self._read_log_file,
+                tasks,
+                self.num_processes,
+                task_sizes,
+                self.executor,
+                share_results=True,
+            )
         )
 
-        pool.close()
-
-        # Concatenate the dataframes list into dataframe containing entire trace
-        trace_df = pd.concat(dataframes_list, ignore_index=True)
-        trace_df.sort_values(
-            by="Timestamp (ns)", axis=0, ascending=True, inplace=True, ignore_index=True
-        )
+        return pipit.trace.Trace(None, self._build_events_dataframe(columns))
+
+    def iter_events(self, chunk_size):
+        """
+        Yields the events of the trace as DataFrames of at most chunk_size
+        events, one PE at a time (and in time order within each PE), so that
+        traces that don't fit in memory can be summarized one chunk at a time
+        (the log file of a PE is read at once)
+        """
+        for i in range(len(self.read_pes)):
+            trace_df = self._build_events_dataframe(self._read_log_file((i, i + 1)))
+
+            for start in range(0, len(trace_df), chunk_size):
+                yield trace_df.iloc[start : start + chunk_size].reset_index(drop=True)
+
+    def _build_events_dataframe(self, columns):
+        # The events of each PE are in time order, and are merged into the
+        # order of the entire trace
+        if self.order == "time":
+            columns = sort_columns(columns, "Timestamp (ns)")
+
+        # Concatenate the columns into dataframe containing entire trace
+        trace_df = pd.DataFrame(columns, copy=False)
+        del columns
+
+        # the names are read as codes into the names of the sts file, which
+        # are resolved into a categorical (with the categories sorted, like
+        # astype("category") would)
+        names = pd.Categorical.from_codes(
+            trace_df["Name"].values, self.sts_reader.names
+        ).remove_unused_categories()
+        trace_df["Name"] = names.reorder_categories(sorted(names.categories))
 
         # categorical for memory savings
-        trace_df = trace_df.astype(
-            {
-                "Name": "category",
-                "Event Type": "category",
-                "Process": "category",
-            }
-        )
+        trace_df["Event Type"] = trace_df["Event Type"].cat.remove_unused_categories()
+        trace_df = trace_df.astype({"Process": "category"})
 
         # re-order columns
-        trace_df = trace_df[
-            ["Timestamp (ns)", "Event Type", "Name", "Process", "Attributes"]
-        ]
-
-        return pipit.trace.Trace(None, trace_df)
-
-    def _read_log_file(self, rank_size) -> pd.DataFrame:
+        columns = ["Timestamp (ns)", "Event Type", "Name", "Process"]
+        if self.promote_message_columns != "only":
+            columns.append("Attributes")
+        if self.promote_message_columns:
+            columns.extend(self.message_columns)
+        return trace_df[columns]
+
+    def _read_log_file(self, pe_range) -> dict:
         # has information needed in sts file
-        sts_reader = STSReader(self.executable_location + ".sts")
+        sts_reader = self.sts_reader
 
-        rank, size = rank_size[0], rank_size[1]
-        per_process = int(self.num_pes // size)
-        remainder = int(self.num_pes % size)
+        begin_int, end_int = pe_range
 
-        if rank < remainder:
-            begin_int = rank * (per_process + 1)
-            end_int = (rank + 1) * (per_process + 1)
-        else:
-            begin_int = (rank * per_process) + remainder
-            end_int = ((rank + 1) * per_process) + remainder
+        # the message attributes are read straight into typed columns, and
+        # the Attributes dicts aren't built at all if they would be dropped
+        message_columns = self.message_columns if self.promote_message_columns else {}
+        keep_attributes = self.promote_message_columns != "only"
 
-        dfs = []
-        for pe_num in range(begin_int, end_int, 1):
-            # create an empty dict to append to
-            data = self._create_empty_dict()
+        pe_columns = []
+        for pe_num in self.read_pes[begin_int:end_int]:
+            # reading the whole log file we need at once
+            with gzip.open(
+                self.executable_location + "." + str(pe_num) + ".log.gz", "rb"
+            ) as log_file:
+                log_data = log_file.read()
 
-            # opening the log file we need to read
-            log_file = gzip.open(
-                self.executable_location + "." + str(pe_num) + ".log.gz", "rt"
+            columns = _read_log_records(
+                log_data, pe_num, sts_reader, message_columns, keep_attributes
             )
 
-            # Basing read on projections log reader and log entry viewer
-            # Iterated through every line in the file and adds to dict
-            for line in log_file:
-                line_arr = line.split()
-
-                if not line_arr[0].isnumeric():
-                    pass
-
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_IDLE:
-                    time = int(line_arr[1]) * 1000
-                    pe = int(line_arr[2])
-
-                    details = {"From PE": pe}
-
-                    _add_to_trace_dict(data, "Idle", "Enter", time, pe_num, details)
-
-                elif int(line_arr[0]) == ProjectionsConstants.END_IDLE:
-                    time = int(line_arr[1]) * 1000
-                    pe = int(line_arr[2])
-
-                    details = {"From PE": pe}
-
-                    _add_to_trace_dict(data, "Idle", "Leave", time, pe_num, details)
-
-                # Pack message to be sent
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_PACK:
-                    time = int(line_arr[1]) * 1000
-                    pe = int(line_arr[2])
-
-                    details = {"From PE": pe}
-
-                    _add_to_trace_dict(data, "Pack", "Enter", time, pe_num, details)
-
-                elif int(line_arr[0]) == ProjectionsConstants.END_PACK:
-                    time = int(line_arr[1]) * 1000
-                    pe = int(line_arr[2])
-
-                    details = {"From PE": pe}
-
-                    _add_to_trace_dict(data, "Pack", "Leave", time, pe_num, details)
-
-                # Unpacking a received message
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_UNPACK:
-                    time = int(line_arr[1]) * 1000
-                    pe = int(line_arr[2])
-
-                    details = {"From PE": pe}
-
-                    _add_to_trace_dict(data, "Unpack", "Enter", time, pe_num, details)
-
-                elif int(line_arr[0]) == ProjectionsConstants.END_UNPACK:
-                    time = int(line_arr[1]) * 1000
-                    pe = int(line_arr[2])
-
-                    details = {"From PE": pe}
-
-                    _add_to_trace_dict(data, "Unpack", "Leave", time, pe_num, details)
-
-                elif int(line_arr[0]) == ProjectionsConstants.USER_SUPPLIED:
-                    user_supplied = line_arr[1]
-                    details = {"User Supplied": user_supplied}
-
-                    _add_to_trace_dict(
-                        data, "User Supplied", "Instant", -1, pe_num, details
-                    )
-
-                elif int(line_arr[0]) == ProjectionsConstants.USER_SUPPLIED_NOTE:
-                    time = line_arr[1] * 1000
-                    note = ""
-                    for i in range(2, len(line_arr)):
-                        note = note + line_arr[i] + " "
-
-                    details = {"Note": note}
-
-                    _add_to_trace_dict(
-                        data, "User Supplied Note", "Instant", time, pe_num, details
-                    )
-
-                # Not sure if this should be instant or enter/leave
-                elif (
-                    int(line_arr[0])
-                    == ProjectionsConstants.USER_SUPPLIED_BRACKETED_NOTE
-                ):
-                    time = line_arr[1] * 1000
-                    end_time = line_arr[2] * 1000
-                    user_event_id = line_arr[3]
-                    note = ""
-                    for i in range(4, len(line_arr)):
-                        note = note + line_arr[i] + " "
-                    note = note + '"'
-
-                    details = {
-                        "Event ID": user_event_id,
-                        "Event Name": sts_reader.get_event_name(user_event_id),
-                        "Note": note,
-                    }
-
-                    _add_to_trace_dict(
-                        data,
-                        "User Supplied Bracketed Note",
-                        "Enter",
-                        time,
-                        pe_num,
-                        details,
-                    )
-
-                    _add_to_trace_dict(
-                        data,
-                        "User Supplied Bracketed Note",
-                        "Leave",
-                        end_time,
-                        pe_num,
-                        details,
-                    )
-
-                # Memory Usage at timestamp
-                elif int(line_arr[0]) == ProjectionsConstants.MEMORY_USAGE:
-                    memory_usage = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-
-                    details = {"Memory Usage": memory_usage}
-
-                    _add_to_trace_dict(
-                        data, "Memory Usage", "Instant", time, pe_num, details
-                    )
-
-                # New chare create message being sent
-                elif int(line_arr[0]) == ProjectionsConstants.CREATION:
-                    mtype = int(line_arr[1])
-                    entry = int(line_arr[2])
-                    time = int(line_arr[3]) * 1000
-                    event = int(line_arr[4])
-                    pe = int(line_arr[5])
-                    msglen = int(line_arr[6])
-                    send_time = int(line_arr[7]) * 1000
-
-                    details = {
-                        "From PE": pe,
-                        "MType": mtype,
-                        "Entry Type": "Create",
-                        "Message Length": msglen,
-                        "Event ID": event,
-                        "Send Time": send_time,
-                    }
-
-                    _add_to_trace_dict(
-                        data,
-                        sts_reader.get_entry_name(entry),
-                        "Instant",
-                        time,
-                        pe_num,
-                        details,
-                    )
-
-                elif int(line_arr[0]) == ProjectionsConstants.CREATION_MULTICAST:
-                    mtype = int(line_arr[1])
-                    entry = int(line_arr[2])
-                    time = int(line_arr[3]) * 1000
-                    event = int(line_arr[4])
-                    pe = int(line_arr[5])
-                    msglen = int(line_arr[6])
-                    send_time = int(line_arr[7]) * 1000
-                    numPEs = int(line_arr[8])
-                    destPEs = []
-                    for i in (0, numPEs):
-                        destPEs.append(int(line_arr[9 + i]))
-
-                    details = {
-                        "From PE": pe,
-                        "Message Type": mtype,
-                        "Entry Type": "Multicast",
-                        "Message Length": msglen,
-                        "Event ID": event,
-                        "Send Time": send_time,
-                        "Destinatopn PEs": destPEs,
-                    }
-
-                    _add_to_trace_dict(
-                        data,
-                        sts_reader.get_entry_name(entry),
-                        "Instant",
-                        time,
-                        pe_num,
-                        "To " + str(numPEs) + "processors",
-                    )
+            # only keep the events that match the read filter
+            if self.read_filter:
+                names = pd.Categorical.from_codes(columns["Name"], sts_reader.names)
+                mask = self.read_filter.mask(
+                    len(names), columns["Timestamp (ns)"], None, names
+                )
+                columns = {name: column[mask] for name, column in columns.items()}
 
-                # Processing of chare (i.e. execution) ?
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_PROCESSING:
-                    mtype = int(line_arr[1])
-                    entry = int(line_arr[2])
-                    time = int(line_arr[3]) * 1000
-                    event = int(line_arr[4])
-                    pe = int(line_arr[5])
-                    msglen = int(line_arr[6])
-                    recv_time = int(line_arr[7])
-                    dimensions = sts_reader.get_dimension(entry)
-                    id = []
-                    for i in range(8, 8 + dimensions):
-                        id.append(int(line_arr[i]))
-                    cpu_start_time = int(line_arr[8 + dimensions])
-
-                    num_perf_counts = sts_reader.get_num_perf_counts()
-                    perf_counts = []
-                    for i in range(9 + dimensions, 9 + dimensions + num_perf_counts):
-                        perf_counts.append(int(line_arr[i]))
-
-                    details = {
-                        "From PE": pe,
-                        "Message Type": mtype,
-                        "Entry Type": "Processing",
-                        "Event ID": event,
-                        "Message Length": msglen,
-                        "Recieve Time": recv_time,
-                        "ID List": id,
-                        "CPU Start Time": cpu_start_time,
-                        "perf counts list": perf_counts,
-                    }
-
-                    _add_to_trace_dict(
-                        data,
-                        sts_reader.get_entry_name(entry),
-                        "Enter",
-                        time,
-                        pe_num,
-                        details,
-                    )
+            pe_columns.append(columns)
 
-                elif int(line_arr[0]) == ProjectionsConstants.END_PROCESSING:
-                    mtype = int(line_arr[1])
-                    entry = int(line_arr[2])
-                    time = int(line_arr[3]) * 1000
-                    event = int(line_arr[4])
-                    pe = int(line_arr[5])
-                    msglen = int(line_arr[6])
-                    cpu_end_time = int(line_arr[7])
-                    num_perf_counts = sts_reader.get_num_perf_counts()
-                    perf_counts = []
-                    for i in range(num_perf_counts):
-                        perf_counts.append(int(line_arr[8 + i]))
-
-                    details = {
-                        "From PE": pe,
-                        "Message Type": mtype,
-                        "Entry Name": "Processing",
-                        "Event ID": event,
-                        "Message Length": msglen,
-                        "CPU End Time": cpu_end_time,
-                        "perf counts list": perf_counts,
-                    }
-
-                    _add_to_trace_dict(
-                        data,
-                        sts_reader.get_entry_name(entry),
-                        "Leave",
-                        time,
-                        pe_num,
-                        None,
-                    )
+        if len(pe_columns) == 0:
+            # no PEs are selected, which gives no events
+            pe_columns.append(
+                _read_log_records(b"", 0, sts_reader, message_columns, keep_attributes)
+            )
 
-                # For selective tracing - when trace is called inside code
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_TRACE:
-                    time = int(line_arr[1]) * 1000
+        return concat_columns(pe_columns)
 
-                    _add_to_trace_dict(data, "Trace", "Enter", time, pe_num, None)
 
-                elif int(line_arr[0]) == ProjectionsConstants.END_TRACE:
-                    time = int(line_arr[1]) * 1000
+def _read_log_records(log_data, pe_num, sts_reader, message_columns, keep_attributes):
+    """
+    Reads the records of a log file into a dict of the columns of its events,
+    by grouping the records by their type and converting each type into typed
+    columns in bulk (see _record_formats)
+
+    Arguments:
+    log_data: the (decompressed) contents of the log file, as bytes
+    pe_num: the PE of the log file
+    sts_reader: the STSReader of the trace
+    message_columns: dict of the typed columns to read message attributes
+    into, see ProjectionsReader.message_columns
+    keep_attributes: whether to create the Attributes column
+    """
 
-                    _add_to_trace_dict(data, "Trace", "Leave", time, pe_num, None)
+    # Basing read on projections log reader and log entry viewer
+    # The whole log is split into tokens at once, and the line of each token
+    # is found from the positions of the whitespace and newlines in the log
+    tokens = np.array(log_data.split(), dtype=object)
+    chars = np.frombuffer(log_data, dtype=np.uint8)
+    is_space = _is_whitespace[chars]
+    token_starts = np.flatnonzero(~is_space & np.append(True, is_space[:-1]))
+    token_lines = np.searchsorted(np.flatnonzero(chars == ord("\n")), token_starts)
+    del chars, is_space, token_starts
+
+    # first token and number of tokens of each (non-empty) line
+    line_starts = np.flatnonzero(np.diff(token_lines, prepend=-1))
+    line_lengths = np.diff(line_starts, append=len(tokens))
+
+    # the record type of each line (-1 for lines that aren't read, such as
+    # the header), and the number of events it creates
+    first_tokens, record_types = np.unique(
+        tokens[line_starts].astype(bytes), return_inverse=True
+    )
+    record_types = np.array(
+        [
+            int(token) if token.isdigit() and int(token) in _record_formats else -1
+            for token in first_tokens.tolist()
+        ],
+        dtype=np.int64,
+    )[record_types]
+    num_events = np.zeros(len(record_types), dtype=np.int64)
+    for record_type, record_format in _record_formats.items():
+        num_events[record_types == record_type] = len(record_format[1])
+
+    # the row of the first event of each line (some records create more than
+    # one event)
+    first_rows = np.cumsum(num_events) - num_events
+    num_rows = int(num_events.sum())
+
+    # The lines are grouped by their record type and number of tokens, so
+    # that the tokens of each group can be viewed as a table with a row per
+    # record
+    is_read = record_types >= 0
+    groups = (
+        pd.DataFrame({"type": record_types[is_read], "length": line_lengths[is_read]})
+        .groupby(["type", "length"], sort=False)
+        .indices
+    )
+    read_lines = np.flatnonzero(is_read)
+
+    # The columns of the events are preallocated, and filled in with the
+    # events of each group at their rows
+    timestamps = np.zeros(num_rows, dtype=np.int64)
+    names = np.zeros(num_rows, dtype=np.int64)
+    event_types = np.zeros(num_rows, dtype=np.int8)
+    attributes = np.full(num_rows, None, dtype=object)
+    message_values = {
+        column: (np.zeros(num_rows, dtype=np.int64), np.zeros(num_rows, dtype=bool))
+        for column in message_columns
+    }
+
+    for (record_type, num_tokens), group_lines in groups.items():
+        (name_kind, name_argument), events, fields = _record_formats[record_type]
+
+        lines = read_lines[group_lines]
+        records = tokens[line_starts[lines][:, np.newaxis] + np.arange(num_tokens)]
+        record_rows = first_rows[lines]
+
+        record_names = _convert_name(name_kind, name_argument, records, sts_reader)
+        keys = [key for key, _, _ in fields]
+        values = [
+            _convert_field(kind, argument, records, sts_reader)
+            for _, kind, argument in fields
+        ]
 
-                # Message Receive ?
-                elif int(line_arr[0]) == ProjectionsConstants.MESSAGE_RECV:
-                    mtype = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-                    event = int(line_arr[3])
-                    pe = int(line_arr[4])
-                    message_length = int(line_arr[5])
+        record_attributes = None
+        if keep_attributes and fields:
+            record_attributes = np.empty(len(records), dtype=object)
+            record_attributes[:] = [
+                dict(zip(keys, row))
+                for row in zip(
+                    *[
+                        value.tolist() if isinstance(value, np.ndarray) else value
+                        for value in values
+                    ]
+                )
+            ]
 
-                    details = {
-                        "From PE": pe,
-                        "Message Type": mtype,
-                        "Event ID": event,
-                        "Message Length": message_length,
-                    }
+        for offset, (event_type, (time_kind, time_argument)) in enumerate(events):
+            rows = record_rows + offset
 
-                    _add_to_trace_dict(
-                        data, "Message Receive", "Instant", time, pe_num, details
-                    )
+            timestamps[rows] = _convert_field(
+                time_kind, time_argument, records, sts_reader
+            )
+            names[rows] = record_names
+            event_types[rows] = _event_types.index(event_type)
+
+            if record_attributes is not None:
+                attributes[rows] = record_attributes
+
+            for column, (key, _) in message_columns.items():
+                if key in keys:
+                    column_values, is_valid = message_values[column]
+                    column_values[rows] = values[keys.index(key)]
+                    is_valid[rows] = True
+
+    # Making sure that the log file ends with END_COMPUTATION
+    computation = sts_reader.name_codes["Computation"]
+    if num_rows > 0 and names[-1] != computation:
+        timestamps = np.append(timestamps, timestamps[-1])
+        names = np.append(names, computation)
+        event_types = np.append(event_types, _event_types.index("Leave"))
+        attributes = np.append(attributes, None)
+        message_values = {
+            column: (np.append(column_values, 0), np.append(is_valid, False))
+            for column, (column_values, is_valid) in message_values.items()
+        }
 
-                # queueing creation ?
-                elif int(line_arr[0]) == ProjectionsConstants.ENQUEUE:
-                    mtype = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-                    event = int(line_arr[3])
-                    pe = int(line_arr[4])
+    data = {
+        "Name": names,
+        "Event Type": pd.Categorical.from_codes(event_types, _event_types),
+        "Timestamp (ns)": timestamps,
+        "Process": np.full(len(timestamps), pe_num, dtype=np.int64),
+    }
 
-                    details = {"From PE": pe, "Message Type": mtype, "Event ID": event}
+    if keep_attributes:
+        data["Attributes"] = attributes
 
-                    _add_to_trace_dict(data, "Enque", "Instant", time, pe_num, details)
+    for column, (_, dtype) in message_columns.items():
+        column_values, is_valid = message_values[column]
+        data[column] = pd.array(column_values, dtype=dtype)
+        data[column][~is_valid] = pd.NA
 
-                elif int(line_arr[0]) == ProjectionsConstants.DEQUEUE:
-                    mtype = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-                    event = int(line_arr[3])
-                    pe = int(line_arr[4])
+    return data
 
-                    details = {"From PE": pe, "Message Type": mtype, "Event ID": event}
 
-                    _add_to_trace_dict(data, "Deque", "Instant", time, pe_num, details)
+def _convert_field(kind, argument, records, sts_reader):
+    """
+    Converts a field of a table of records (see _record_formats) into a numpy
+    array, or a list for the fields that aren't numbers
+    """
+    if kind == "value":
+        return [argument] * len(records)
 
-                # Interrupt from different chare ?
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_INTERRUPT:
-                    time = int(line_arr[1]) * 1000
-                    event = int(line_arr[2])
-                    pe = int(line_arr[3])
+    elif kind == "int":
+        return records[:, argument].astype(np.int64)
 
-                    details = {"From PE": pe, "Event ID": event}
+    # timestamps are converted from microseconds to nanoseconds
+    elif kind == "time":
+        return records[:, argument].astype(np.int64) * 1000
 
-                    _add_to_trace_dict(
-                        data, "Interrupt", "Enter", time, pe_num, details
-                    )
+    elif kind == "float":
+        return records[:, argument].astype(np.float64)
 
-                elif int(line_arr[0]) == ProjectionsConstants.END_INTERRUPT:
-                    time = int(line_arr[1]) * 1000
-                    event = int(line_arr[2])
-                    pe = int(line_arr[3])
+    elif kind == "str":
+        return [token.decode() for token in records[:, argument]]
 
-                    details = {"From PE": pe, "Event ID": event}
+    # the rest of the line, from the token at the argument onwards
+    elif kind == "note":
+        start, suffix = argument
+        return [
+            "".join(token.decode() + " " for token in record[start:]) + suffix
+            for record in records.tolist()
+        ]
 
-                    _add_to_trace_dict(
-                        data, "Interrupt", "Leave", time, pe_num, details
-                    )
+    # a list of ints, whose length is given by the token before it
+    elif kind == "int list":
+        return [
+            [
+                int(token)
+                for token in record[argument : argument + int(record[argument - 1])]
+            ]
+            for record in records.tolist()
+        ]
 
-                # Very start of the program - encapsulates every other event
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_COMPUTATION:
-                    time = int(line_arr[1]) * 1000
+    elif kind == "user event":
+        return _lookup_ids(
+            records[:, argument].astype(np.int64), sts_reader.get_user_event
+        )
 
-                    _add_to_trace_dict(data, "Computation", "Enter", time, pe_num, None)
+    elif kind in ("ids", "int after ids", "perf counts"):
+        # The processing records have a list of ids (as many as the dimension
+        # of their entry, which is token 2) followed by the CPU start time and
+        # the performance counts, so the argument is their index with no ids.
+        # The records are converted together for each dimension.
+        dimensions = _lookup_ids(
+            records[:, 2].astype(np.int64), sts_reader.get_dimension
+        ).astype(np.int64)
+        num_perf_counts = sts_reader.get_num_perf_counts()
+
+        if kind == "int after ids":
+            values = np.zeros(len(records), dtype=np.int64)
+        else:
+            values = [None] * len(records)
 
-                elif int(line_arr[0]) == ProjectionsConstants.END_COMPUTATION:
-                    time = int(line_arr[1]) * 1000
+        for dimension in np.unique(dimensions).tolist():
+            rows = np.flatnonzero(dimensions == dimension)
 
-                    _add_to_trace_dict(data, "Computation", "Leave", time, pe_num, None)
+            if kind == "int after ids":
+                values[rows] = records[rows, argument + dimension].astype(np.int64)
+                continue
 
-                # User event (in code)
-                elif int(line_arr[0]) == ProjectionsConstants.USER_EVENT:
-                    user_event_id = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-                    event = int(line_arr[3])
-                    pe = int(line_arr[4])
+            if kind == "ids":
+                start, end = argument, argument + dimension
+            else:
+                start = argument + dimension
+                end = start + num_perf_counts
 
-                    user_event_name = sts_reader.get_user_event(user_event_id)
+            for row, row_values in zip(
+                rows.tolist(), records[rows, start:end].astype(np.int64).tolist()
+            ):
+                values[row] = row_values
 
-                    details = {
-                        "From PE": pe,
-                        "Event ID": event,
-                        "Event Type": "User Event",
-                    }
+        return values
 
-                    _add_to_trace_dict(
-                        data, user_event_name, "Instant", time, pe_num, details
-                    )
+    raise ValueError("Unknown field kind: " + kind)
 
-                elif int(line_arr[0]) == ProjectionsConstants.USER_EVENT_PAIR:
-                    user_event_id = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-                    event = int(line_arr[3])
-                    pe = int(line_arr[4])
-                    nested_id = int(line_arr[5])
 
-                    user_event_name = sts_reader.get_user_event(user_event_id)
+def _convert_name(kind, argument, records, sts_reader):
+    """
+    Converts the name field of a table of records (see _record_formats) into
+    an array of the codes of the names, see STSReader.build_name_codes
+    """
+    if kind == "value":
+        return np.full(len(records), sts_reader.name_codes[argument], dtype=np.int64)
 
-                    details = {
-                        "From PE": pe,
-                        "Event ID": event,
-                        "Nested ID": nested_id,
-                        "Event Type": "User Event Pair",
-                    }
+    ids = records[:, argument].astype(np.int64)
 
-                    _add_to_trace_dict(
-                        data, user_event_name, "Instant", time, pe_num, details
-                    )
+    if kind == "entry":
+        entry_codes = sts_reader.entry_codes
+        codes = np.full(len(ids), sts_reader.name_codes[""], dtype=np.int64)
 
-                elif int(line_arr[0]) == ProjectionsConstants.BEGIN_USER_EVENT_PAIR:
-                    user_event_id = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-                    event = int(line_arr[3])
-                    pe = int(line_arr[4])
-                    nested_id = int(line_arr[5])
-
-                    details = {
-                        "From PE": pe,
-                        "Event ID": event,
-                        "Nested ID": nested_id,
-                        "User Event Name": sts_reader.get_user_event(user_event_id),
-                    }
-
-                    _add_to_trace_dict(
-                        data, "User Event Pair", "Enter", time, pe_num, details
-                    )
+        is_known = (ids >= 0) & (ids < len(entry_codes))
+        codes[is_known] = entry_codes[ids[is_known]]
+        return codes
 
-                elif int(line_arr[0]) == ProjectionsConstants.END_USER_EVENT_PAIR:
-                    user_event_id = int(line_arr[1])
-                    time = int(line_arr[2]) * 1000
-                    event = int(line_arr[3])
-                    pe = int(line_arr[4])
-                    nested_id = int(line_arr[5])
-
-                    details = {
-                        "From PE": pe,
-                        "Event ID": event,
-                        "Nested ID": nested_id,
-                        "User Event Name": sts_reader.get_user_event(user_event_id),
-                    }
-
-                    _add_to_trace_dict(
-                        "User Event Pair", "Leave", time, pe_num, details
-                    )
+    elif kind == "user event":
+        return _lookup_ids(ids, sts_reader.user_event_codes.__getitem__).astype(
+            np.int64
+        )
 
-                # User stat (in code)
-                elif int(line_arr[0]) == ProjectionsConstants.USER_STAT:
-                    time = int(line_arr[1]) * 1000
-                    user_time = int(line_arr[2]) * 1000
-                    stat = float(line_arr[3])
-                    pe = int(line_arr[4])
-                    user_event_id = int(line_arr[5])
-
-                    user_stat_name = sts_reader.get_user_stat(user_event_id)
-
-                    details = {
-                        "From PE": pe,
-                        "User Time": user_time,
-                        "Stat": stat,
-                        "Event Type": "User Stat",
-                    }
-
-                    _add_to_trace_dict(
-                        data, user_stat_name, "Instant", time, pe_num, details
-                    )
+    elif kind == "user stat":
+        return _lookup_ids(ids, sts_reader.user_stat_codes.__getitem__).astype(np.int64)
 
-            # Making sure that the log file ends with END_COMPUTATION
-            if len(data["Name"]) > 0 and data["Name"][-1] != "Computation":
-                time = data["Timestamp (ns)"][-1] * 1000
-                _add_to_trace_dict(data, "Computation", "Leave", time, pe_num, None)
+    raise ValueError("Unknown name kind: " + kind)
 
-            log_file.close()
-            dfs.append(pd.DataFrame(data))
 
-        return pd.concat(dfs)
+def _lookup_ids(ids, lookup):
+    """Returns an object array of lookup(id) for each of the ids, calling
+    lookup only once for each distinct id"""
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
 
+    values = np.empty(len(unique_ids), dtype=object)
+    values[:] = [lookup(id) for id in unique_ids.tolist()]
 
-def _add_to_trace_dict(data, name, evt_type, time, process, attributes):
-    data["Name"].append(name)
-    data["Event Type"].append(evt_type)
-    data["Timestamp (ns)"].append(time)
-    data["Process"].append(process)
-    data["Attributes"].append(attributes)
+    return values[inverse]
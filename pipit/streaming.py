@@ -0,0 +1,254 @@
+# Copyright 2022-2023 Parallel Software and Systems Group, University of
+# Maryland. See the top-level LICENSE file for details.
+#
+# SPDX-License-Identifier: MIT
+
+"""Analyses that fold over the chunks of events of Trace.iter_events, so that
+traces that don't fit in memory can be summarized. Each function gives the same
+result as the Trace method of the same name on the whole trace."""
+
+import numpy as np
+import pandas as pd
+
+from .trace import Trace
+
+
+def flat_profile(chunks, metrics=None, groupby_column="Name", per_process=False):
+    """
+    Arguments:
+    chunks - an iterable of events dataframes, e.g. from Trace.iter_events
+    metrics - a string or list of strings containing the inclusive (".inc") or
+    exclusive (".exc") metrics to be aggregated (time.inc and time.exc by
+    default)
+    groupby_column - a string containing the column to be grouped by
+
+    Returns:
+    A Pandas DataFrame that will have the aggregated metrics
+    for the grouped by column, like Trace.flat_profile.
+
+    The enter events that are still open at the end of a chunk are carried
+    over to the next one, with the inclusive metrics of the children they
+    have had so far, which are subtracted from their exclusive metrics once
+    they are matched. This gives the same profile as the whole trace if its
+    enter and leave events are well nested within each location.
+    """
+    if metrics is None:
+        metrics = ["time.inc", "time.exc"]
+    elif isinstance(metrics, str):
+        metrics = [metrics]
+
+    # the event columns that the metrics are calculated from
+    columns = list(dict.fromkeys(_metric_column(metric) for metric in metrics))
+    inc_metrics = [_metric_name(column, "inc") for column in columns]
+    exc_metrics = [_metric_name(column, "exc") for column in columns]
+
+    keys = [groupby_column, "Process"]
+    totals = None
+
+    # the open enter events of the previous chunks, and the sum of the
+    # inclusive metrics of their children
+    pending = None
+    pending_children = {metric: np.zeros(0) for metric in exc_metrics}
+
+    for chunk in chunks:
+        events = chunk.loc[chunk["Event Type"].isin(["Enter", "Leave"])]
+        event_columns = ["Timestamp (ns)", "Event Type", "Name"] + [
+            column for column in ["Thread", "Process"] if column in chunk.columns
+        ]
+        event_columns = list(dict.fromkeys(event_columns + keys + columns))
+        events = events[event_columns]
+        num_pending = 0 if pending is None else len(pending)
+        events = pd.concat(
+            [events] if pending is None else [pending, events], ignore_index=True
+        )
+
+        trace = Trace(None, events)
+        trace.calc_exc_metrics(columns)
+        events = trace.events
+
+        is_enter = (events["Event Type"] == "Enter").values
+        is_matched = events["_matching_event"].notna().values
+        is_open = is_enter & ~is_matched
+
+        children = {}
+        for metric in exc_metrics:
+            children[metric] = np.zeros(len(events))
+            children[metric][:num_pending] = pending_children[metric]
+
+        # The matched enters without a parent in this chunk are children of
+        # the innermost enter of their location that is still open before
+        # them, if there is one. Rows of a location are in time order, so
+        # that enter is the open row of the location just before them.
+        codes = trace.location_index.codes
+        top_rows = np.flatnonzero(
+            is_enter & is_matched & (trace.call_tree.parent == -1)
+        )
+        open_rows = np.flatnonzero(is_open)
+        open_keys = codes[open_rows] * len(events) + open_rows
+        order = np.argsort(open_keys, kind="stable")
+        open_rows, open_keys = open_rows[order], open_keys[order]
+
+        parents = np.searchsorted(open_keys, codes[top_rows] * len(events) + top_rows)
+        parents -= 1
+        has_parent = parents >= 0
+        has_parent[has_parent] = (
+            open_keys[parents[has_parent]] // len(events) == codes[top_rows[has_parent]]
+        )
+        top_rows, parents = top_rows[has_parent], open_rows[parents[has_parent]]
+
+        for inc_metric, exc_metric in zip(inc_metrics, exc_metrics):
+            np.add.at(
+                children[exc_metric],
+                parents,
+                events[inc_metric].to_numpy(dtype=np.float64)[top_rows],
+            )
+
+            # the carried enters that were matched in this chunk
+            # exclude the children of the previous chunks
+            events[exc_metric] = (
+                events[exc_metric].to_numpy(dtype=np.float64) - children[exc_metric]
+            )
+
+        chunk_totals = (
+            events.loc[is_enter & is_matched]
+            .groupby(keys, observed=True)[metrics]
+            .sum()
+        )
+        totals = (
+            chunk_totals if totals is None else totals.add(chunk_totals, fill_value=0)
+        )
+
+        pending = events.loc[is_open, event_columns]
+        pending_children = {metric: children[metric][is_open] for metric in exc_metrics}
+
+    if totals is None:
+        # no events were read (such as when the filters match none of them)
+        totals = pd.DataFrame(
+            index=pd.MultiIndex.from_arrays([[], []], names=keys),
+            columns=metrics,
+            dtype=np.float64,
+        )
+
+    # functions that are never left still show up in the profile
+    if pending is not None and len(pending) > 0:
+        unmatched = pd.DataFrame(
+            0.0,
+            index=pending.groupby(keys, observed=True).size().index,
+            columns=metrics,
+        )
+        totals = totals.add(unmatched, fill_value=0)
+
+    totals = totals.sort_index()
+
+    if per_process:
+        return totals
+    else:
+        return totals.groupby(groupby_column, observed=True).mean()
+
+
+def comm_matrix(chunks, output="size", sparse=False):
+    """
+    Communication Matrix for Peer-to-Peer (P2P) MPI messages, like
+    Trace.comm_matrix, from an iterable of events dataframes.
+
+    The message volume of each (sender, receiver) pair that communicates is
+    summed over the chunks, so only the pairs (and not the messages) are kept
+    in memory.
+    """
+    processes = set()
+    pairs = np.zeros(0, dtype=np.int64)
+    volumes = np.zeros(0)
+
+    for chunk in chunks:
+        processes.update(pd.unique(chunk["Process"].dropna()))
+
+        trace = Trace(None, chunk)
+        senders = chunk.index[chunk["Name"].isin(["MpiSend", "MpiIsend"])]
+        sender_ranks = chunk["Process"].loc[senders].values.astype(np.int64)
+        receiver_ranks = trace._message_attribute(
+            senders, "Receiver", "receiver", np.int64
+        )
+
+        if output == "size":
+            message_volume = trace._message_attribute(
+                senders, "Msg Length", "msg_length", np.float64
+            )
+        elif output == "count":
+            message_volume = np.ones(len(senders))
+
+        # merge the pairs of the chunk with those of the previous chunks
+        pairs, pair_indices = np.unique(
+            np.concatenate([pairs, (sender_ranks << 32) | receiver_ranks]),
+            return_inverse=True,
+        )
+        volumes = np.bincount(
+            pair_indices,
+            weights=np.concatenate([volumes, message_volume]),
+            minlength=len(pairs),
+        )
+
+    num_ranks = len(processes)
+    sender_ranks, receiver_ranks = pairs >> 32, pairs & 0xFFFFFFFF
+
+    if sparse:
+        from scipy.sparse import coo_matrix
+
+        return coo_matrix(
+            (volumes, (sender_ranks, receiver_ranks)), shape=(num_ranks, num_ranks)
+        )
+
+    communication_matrix = np.zeros((num_ranks, num_ranks))
+    communication_matrix[sender_ranks, receiver_ranks] = volumes
+
+    return communication_matrix
+
+
+def message_histogram(chunks, bins=20, **kwargs):
+    """Generates histogram of message frequency by size, like
+    Trace.message_histogram, from an iterable of events dataframes.
+
+    If the bin edges are known upfront (bins is a sequence of edges, or a
+    range is given), the counts of each chunk are summed up. Otherwise the
+    message sizes are collected, since the edges depend on all of them.
+    """
+    edges = None
+    if not np.isscalar(bins):
+        edges = np.asarray(bins)
+    elif kwargs.get("range") is not None:
+        edges = np.histogram_bin_edges([], bins=bins, range=kwargs["range"])
+
+    # weighted or density histograms are computed from all the sizes
+    if edges is not None and set(kwargs) <= {"range"}:
+        counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        for chunk in chunks:
+            counts += np.histogram(_message_sizes(chunk), bins=edges)[0]
+
+        return counts, edges
+
+    sizes = [_message_sizes(chunk) for chunk in chunks]
+    sizes = np.concatenate(sizes) if sizes else np.zeros(0, dtype=np.int64)
+
+    return np.histogram(sizes, bins=bins, **kwargs)
+
+
+def _message_sizes(events):
+    """Returns the sizes of the messages sent in an events dataframe"""
+    messages = events.index[events["Name"].isin(["MpiSend", "MpiIsend"])]
+
+    return Trace(None, events)._message_attribute(
+        messages, "Msg Length", "msg_length", np.int64
+    )
+
+
+def _metric_column(metric):
+    """Returns the event column that an inclusive or exclusive metric is
+    calculated from"""
+    if not metric.endswith((".inc", ".exc")):
+        raise ValueError("Not an inclusive or exclusive metric: " + metric)
+
+    return "Timestamp (ns)" if metric[:-4] == "time" else metric[:-4]
+
+
+def _metric_name(column, kind):
+    """Returns the name of the inclusive or exclusive metric of a column"""
+    return ("time" if column == "Timestamp (ns)" else column) + "." + kind
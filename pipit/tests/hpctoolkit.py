@@ -5,6 +5,7 @@
 
 from pipit import Trace
 import numpy as np
+import pytest
 
 
 def test_events(ping_pong_hpct_trace):
@@ -96,3 +97,78 @@ def test_events(ping_pong_hpct_trace):
 
     # Timestamps should be sorted in increasing order
     assert (np.diff(events_df["Timestamp (ns)"]) >= 0).all()
+
+
+def test_parallel_read(ping_pong_hpct_trace):
+    serial_df = Trace.from_hpctoolkit(str(ping_pong_hpct_trace), 1).events
+    parallel_df = Trace.from_hpctoolkit(str(ping_pong_hpct_trace), 2).events
+
+    # decoding the trace lines in parallel gives the same events
+    assert len(parallel_df) == len(serial_df)
+    assert parallel_df.equals(serial_df)
+
+
+def test_lazy_sections(ping_pong_hpct_trace):
+    from pipit.readers.hpctoolkit_reader import HPCToolkitReader
+
+    reader = HPCToolkitReader(str(ping_pong_hpct_trace), 1)
+
+    # only the headers of the files are read up front
+    assert len(reader.meta_reader._loaded_sections) == 0
+    assert len(reader.trace_reader._loaded_sections) == 0
+
+    # sections are read when their attributes are first accessed
+    assert reader.meta_reader.database_title == "ping-pong"
+    assert reader.meta_reader._loaded_sections == {"General Properties"}
+    assert len(reader.trace_reader._loaded_sections) == 0
+
+    assert len(reader.read().events) == len(
+        Trace.from_hpctoolkit(str(ping_pong_hpct_trace), 1).events
+    )
+    assert "Context Tree" in reader.meta_reader._loaded_sections
+
+    # a section that fails to be read raises its error every time it is used
+    reader = HPCToolkitReader(str(ping_pong_hpct_trace), 1)
+
+    def fail(section_pointer, section_size):
+        raise OSError("truncated section")
+
+    reader.meta_reader._reader_map["General Properties"] = fail
+    for _ in range(2):
+        with pytest.raises(OSError, match="truncated section"):
+            reader.meta_reader.database_title
+    assert len(reader.meta_reader._loaded_sections) == 0
+
+
+def test_calling_context_tree(ping_pong_hpct_trace):
+    from pipit.readers.hpctoolkit_reader import HPCToolkitReader
+
+    cct = HPCToolkitReader(str(ping_pong_hpct_trace), 1).meta_reader.cct
+    nodes = np.arange(len(cct))
+    parents = cct.get_arrays()["parent"]
+
+    def ancestors(nid):
+        path = []
+        while nid >= 0:
+            path.append(nid)
+            nid = parents[nid]
+        return path
+
+    # the lowest common ancestors found with binary lifting are the first
+    # nodes that the paths up to the roots have in common
+    nodes1, nodes2 = np.meshgrid(nodes, nodes)
+    common = cct.get_lowest_common_ancestors(nodes1.ravel(), nodes2.ravel())
+    for nid1, nid2, ancestor in zip(nodes1.ravel(), nodes2.ravel(), common):
+        path2 = ancestors(nid2)
+        expected = next((nid for nid in ancestors(nid1) if nid in path2), -1)
+        assert ancestor == expected
+
+    # nodes are built with Graph.add_node instead of the old Node constructor
+    from pipit.graph import Graph, Node
+
+    graph = Graph()
+    root = graph.add_node()
+    child = graph.add_node(root)
+    assert child.parent == root and root.children == [child] and child.level == 1
+    with pytest.raises(TypeError):
+        Node(0, None)
@@ -5,6 +5,8 @@
 
 import numpy as np
 from pipit import Trace
+from pipit.readers.otf2_reader import OTF2Reader
+from pipit.trace import MESSAGE_COLUMNS
 
 
 def test_events(data_dir, ping_pong_otf2_trace):
@@ -65,3 +67,45 @@ def test_definitions(data_dir, ping_pong_otf2_trace):
 
     # communicator should evidently be present in the ping pong trace definitions
     assert "Comm" in set(definitions_df["Definition Type"])
+
+
+def test_message_columns(data_dir, ping_pong_otf2_trace):
+    trace = Trace.from_otf2(str(ping_pong_otf2_trace), message_columns=True)
+    events_df = trace.events
+
+    sends = events_df.loc[events_df["Name"] == "MpiSend"]
+    recvs = events_df.loc[events_df["Name"] == "MpiRecv"]
+
+    # message attributes are stored in typed columns
+    assert events_df["Receiver"].dtype == "Int32"
+    assert events_df["Msg Length"].dtype == "Int64"
+    assert (sends["Receiver"] == 1 - sends["Process"].astype(int)).all()
+    assert (recvs["Sender"] == 1 - recvs["Process"].astype(int)).all()
+    assert (
+        sends["Msg Length"] == sends["Attributes"].map(lambda x: x["msg_length"])
+    ).all()
+    assert (sends["Tag"] == sends["Attributes"].map(lambda x: x["msg_tag"])).all()
+
+    # other events don't have message attributes
+    assert events_df.loc[events_df["Event Type"] != "Instant", "Receiver"].isna().all()
+
+    # analyses give the same results without the Attributes column
+    columns_trace = Trace.from_otf2(str(ping_pong_otf2_trace), message_columns="only")
+    assert "Attributes" not in columns_trace.events.columns
+    assert np.array_equal(columns_trace.comm_matrix(), trace.comm_matrix())
+    assert np.array_equal(
+        columns_trace.message_histogram()[0], trace.message_histogram()[0]
+    )
+
+    # the columns read from the trace are the ones promoted from the
+    # Attributes dicts of a trace that is already loaded
+    promoted_trace = Trace.from_otf2(str(ping_pong_otf2_trace))
+    promoted_trace.promote_attributes(OTF2Reader.message_columns)
+    assert promoted_trace.events.equals(events_df)
+
+    # the message columns aren't metrics
+    assert OTF2Reader.message_columns.keys() <= MESSAGE_COLUMNS
+    trace.calc_inc_metrics()
+    trace.calc_exc_metrics()
+    assert trace.inc_metrics == ["time.inc"]
+    assert trace.exc_metrics == ["time.exc"]
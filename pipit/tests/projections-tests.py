@@ -4,6 +4,8 @@
 # SPDX-License-Identifier: MIT
 
 from pipit import Trace
+from pipit.readers.projections_reader import ProjectionsReader
+from pipit.trace import MESSAGE_COLUMNS
 
 
 def test_events(data_dir, ping_pong_projections_trace):
@@ -80,3 +82,51 @@ def test_events(data_dir, ping_pong_projections_trace):
 
     assert events_df.loc[events_df["Process"] == 0].iloc[0]["Name"] == "Computation"
     assert events_df.loc[events_df["Process"] == 0].iloc[-1]["Name"] == "Computation"
+
+
+def test_message_columns(data_dir, ping_pong_projections_trace):
+    trace = Trace.from_projections(
+        str(ping_pong_projections_trace), message_columns=True
+    )
+    events_df = trace.events
+
+    # the typed columns hold the same values as the Attributes dicts
+    for column, (key, dtype) in {
+        "Sender": ("From PE", "Int32"),
+        "Msg Length": ("Message Length", "Int64"),
+        "Event ID": ("Event ID", "Int64"),
+    }.items():
+        assert events_df[column].dtype == dtype
+        expected = events_df["Attributes"].map(
+            lambda x: x.get(key) if isinstance(x, dict) else None
+        )
+        assert events_df[column].equals(expected.astype(dtype))
+
+    # the columns are the same when the Attributes column isn't read
+    columns_df = Trace.from_projections(
+        str(ping_pong_projections_trace), message_columns="only"
+    ).events
+    assert "Attributes" not in columns_df.columns
+    assert columns_df.equals(events_df.drop(columns="Attributes"))
+
+    # the message columns aren't metrics
+    assert ProjectionsReader.message_columns.keys() <= MESSAGE_COLUMNS
+    trace.calc_inc_metrics()
+    trace.calc_exc_metrics()
+    assert trace.inc_metrics == ["time.inc"]
+    assert trace.exc_metrics == ["time.exc"]
+
+
+def test_schedule(data_dir, ping_pong_projections_trace):
+    from pipit.readers.projections_reader import ProjectionsReader
+
+    # the PEs are read in the same order however they are scheduled
+    static_trace = ProjectionsReader(
+        str(ping_pong_projections_trace), 2, schedule="static"
+    ).read()
+    dynamic_trace = ProjectionsReader(
+        str(ping_pong_projections_trace), 2, schedule="dynamic"
+    ).read()
+    assert static_trace.events.drop(columns="Attributes").equals(
+        dynamic_trace.events.drop(columns="Attributes")
+    )
@@ -3,7 +3,10 @@
 #
 # SPDX-License-Identifier: MIT
 
+import os
 import numpy as np
+import pandas as pd
+import pytest
 from pipit import Trace
 
 
@@ -32,6 +35,19 @@ def test_comm_matrix(data_dir, ping_pong_otf2_trace):
     assert count_comm_matrix[0][1] == count_comm_matrix[1][0] == 8
 
 
+def test_comm_matrix_sparse(data_dir, ping_pong_otf2_trace):
+    pytest.importorskip("scipy")
+
+    trace = Trace.from_otf2(str(ping_pong_otf2_trace))
+
+    for output in ["size", "count"]:
+        sparse_comm_matrix = trace.comm_matrix(output, sparse=True)
+
+        # only the pairs of processes that communicate are stored
+        assert sparse_comm_matrix.nnz == 2
+        assert np.array_equal(sparse_comm_matrix.toarray(), trace.comm_matrix(output))
+
+
 def test_match_events(data_dir, ping_pong_otf2_trace):
     trace = Trace.from_otf2(str(ping_pong_otf2_trace))
     trace._match_events()
@@ -97,6 +113,36 @@ def test_match_events(data_dir, ping_pong_otf2_trace):
     ).all()
 
 
+def test_match_events_unbalanced():
+    # rank 0 is well-nested, while rank 1 is missing the leave event of "bar"
+    events = pd.DataFrame(
+        {
+            "Timestamp (ns)": [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0],
+            "Event Type": [
+                "Enter",
+                "Enter",
+                "Enter",
+                "Enter",
+                "Leave",
+                "Leave",
+                "Instant",
+                "Leave",
+            ],
+            "Name": ["foo", "foo", "bar", "bar", "bar", "foo", "MpiSend", "foo"],
+            "Process": [0, 1, 0, 1, 0, 1, 0, 0],
+        }
+    )
+    trace = Trace(None, events)
+    trace._match_events()
+
+    df = trace.events
+
+    assert df["_matching_event"].to_list() == [7, 5, 4, pd.NA, 2, 1, pd.NA, 0]
+    assert df["_matching_timestamp"].equals(
+        pd.Series([7.0, 5.0, 4.0, np.nan, 2.0, 1.0, np.nan, 0.0])
+    )
+
+
 def test_match_caller_callee(data_dir, ping_pong_otf2_trace):
     trace = Trace.from_otf2(str(ping_pong_otf2_trace))
     trace._match_caller_callee()
@@ -107,7 +153,15 @@ def test_match_caller_callee(data_dir, ping_pong_otf2_trace):
     assert len(df.loc[df["_parent"].notnull()]) == 40
 
     # nodes with children = 2
-    assert len(df.loc[df["_children"].notnull()]) == 2
+    assert (trace.call_tree.num_children() > 0).sum() == 2
+
+    # children of main are the 20 function calls at depth 1 on its rank
+    for main_idx in df.loc[(df["_depth"] == 0) & (df["Event Type"] == "Enter")].index:
+        children = trace.call_tree.get_children(main_idx)
+
+        assert len(children) == 20
+        assert (df["_parent"][children] == main_idx).all()
+        assert (df["_depth"][children] == 1).all()
 
 
 def test_time_profile(data_dir, ping_pong_otf2_trace):
@@ -180,3 +234,389 @@ def test_time_profile(data_dir, ping_pong_otf2_trace):
     assert np.isclose(norm.loc[61]["MPI_Comm_size"], 0.0)
     assert np.isclose(norm.loc[61]["MPI_Comm_rank"], 0.0)
     assert np.isclose(norm.loc[61]["MPI_Finalize"], 0.01614835)
+
+
+def test_time_profile_unnamed():
+    # a function without a name is left out of the profile (but its time is
+    # still subtracted from its parent), and only the processes that enter
+    # functions are counted in the duration of a bin
+    trace = Trace(
+        None,
+        pd.DataFrame(
+            {
+                "Timestamp (ns)": [0.0, 2.0, 5.0, 6.0, 10.0],
+                "Event Type": ["Enter", "Enter", "Instant", "Leave", "Leave"],
+                "Name": ["main", np.nan, "MpiSend", np.nan, "main"],
+                "Process": [0, 0, 1, 0, 0],
+            }
+        ),
+    )
+
+    time_profile = trace.time_profile(num_bins=1)
+    assert list(time_profile.columns) == ["bin_end", "bin_start", "idle_time", "main"]
+    assert time_profile.loc[0, "main"] == 6
+    assert time_profile.loc[0, "idle_time"] == 4
+
+
+def test_calc_exc_metrics(data_dir, ping_pong_otf2_papi_trace):
+    trace = Trace.from_otf2(str(ping_pong_otf2_papi_trace))
+    trace.calc_exc_metrics()
+
+    df = trace.events
+    enter_df = df.loc[df["Event Type"] == "Enter"]
+
+    for metric in ["time", "PAPI_TOT_CYC", "PAPI_L2_TCM", "PAPI_BR_MSP"]:
+        assert metric + ".exc" in trace.exc_metrics
+
+        # exclusive metrics can't be larger than inclusive metrics
+        assert (enter_df[metric + ".exc"] <= enter_df[metric + ".inc"]).all()
+
+        # exclusive metrics of all functions on a rank add up
+        # to the inclusive metric of main
+        assert np.isclose(
+            enter_df.groupby("Process")[metric + ".exc"].sum(),
+            enter_df.loc[enter_df["_depth"] == 0]
+            .groupby("Process")[metric + ".inc"]
+            .sum(),
+        ).all()
+
+
+def test_parallel_analysis(data_dir, ping_pong_otf2_papi_trace):
+    serial_trace = Trace.from_otf2(str(ping_pong_otf2_papi_trace))
+    parallel_trace = Trace(serial_trace.definitions, serial_trace.events.copy(), 2)
+
+    serial_trace.calc_exc_metrics()
+    parallel_trace.calc_exc_metrics()
+
+    # analyzing the two ranks in parallel gives the same results
+    assert serial_trace.events.equals(parallel_trace.events)
+    assert (
+        serial_trace.call_tree.child_indices == parallel_trace.call_tree.child_indices
+    ).all()
+
+
+def test_location_index(data_dir, ping_pong_otf2_trace):
+    trace = Trace.from_otf2(str(ping_pong_otf2_trace))
+    df = trace.events
+
+    location_index = trace.location_index
+
+    # 2 ranks with 1 thread each
+    assert len(location_index) == 2
+    assert location_index.get_processes() == [0, 1]
+
+    # rows of each location are in time order
+    for process in [0, 1]:
+        rows = location_index.get_rows(process, 0)
+
+        assert (rows == df.loc[df["Process"] == process].index).all()
+        assert (location_index.get_rows(process) == rows).all()
+
+    # the index is built once, and rebuilt when the events are replaced
+    assert trace.location_index is location_index
+
+    trace.events = df.loc[df["Process"] == 1].reset_index(drop=True)
+
+    assert trace.location_index.get_processes() == [1]
+
+
+def test_save_load(data_dir, ping_pong_otf2_trace, tmp_path):
+    pytest.importorskip("pyarrow")
+
+    trace = Trace.from_otf2(str(ping_pong_otf2_trace))
+    trace.calc_exc_metrics(["Timestamp (ns)"])
+    trace.save(str(tmp_path / "trace"))
+
+    # the derived columns and metrics are saved with the events
+    loaded = Trace.load(str(tmp_path / "trace"))
+    pd.testing.assert_frame_equal(loaded.events, trace.events)
+    pd.testing.assert_frame_equal(loaded.definitions, trace.definitions)
+    assert loaded.inc_metrics == trace.inc_metrics
+    assert loaded.exc_metrics == trace.exc_metrics
+    assert loaded.numeric_cols == trace.numeric_cols
+    assert np.array_equal(loaded.comm_matrix(), trace.comm_matrix())
+
+    # the timestamps aren't copied out of the memory-mapped file
+    assert not loaded.events["Timestamp (ns)"].values.flags.writeable
+
+    # the second read is loaded from the cache
+    cache = str(tmp_path / "cache")
+    first = Trace.from_otf2(str(ping_pong_otf2_trace), cache=cache)
+    assert len(os.listdir(cache)) == 1
+
+    second = Trace.from_otf2(str(ping_pong_otf2_trace), cache=cache)
+    pd.testing.assert_frame_equal(second.events, first.events)
+    assert len(os.listdir(cache)) == 1
+
+    # different reader options are cached separately
+    Trace.from_otf2(str(ping_pong_otf2_trace), message_columns=True, cache=cache)
+    assert len(os.listdir(cache)) == 2
+
+    # the cache is keyed by the files at the top of the trace directory (and
+    # not those of its subdirectories, which aren't walked)
+    traces = str(ping_pong_otf2_trace)
+    location_file = os.path.join(traces, "traces", os.listdir(traces + "/traces")[0])
+    os.utime(location_file, (0, 10**10))
+    Trace.from_otf2(traces, cache=cache)
+    assert len(os.listdir(cache)) == 2
+
+    os.utime(os.path.join(traces, "traces.def"), (0, 10**10))
+    Trace.from_otf2(traces, cache=cache)
+    assert len(os.listdir(cache)) == 3
+
+
+def test_executor(data_dir, ping_pong_otf2_trace):
+    from pipit import Executor
+
+    projections_dir = os.path.join(data_dir, "ping-pong-projections")
+    hpct_dir = os.path.join(data_dir, "ping-pong-hpctoolkit")
+
+    # the same workers read several traces, with the same results as new ones
+    with Executor(2) as executor:
+        for _ in range(2):
+            otf2_trace = Trace.from_otf2(str(ping_pong_otf2_trace), executor=executor)
+            projections_trace = Trace.from_projections(
+                projections_dir, executor=executor
+            )
+            hpct_trace = Trace.from_hpctoolkit(hpct_dir, executor=executor)
+
+            assert otf2_trace.events.drop(columns="Attributes").equals(
+                Trace.from_otf2(str(ping_pong_otf2_trace), 2).events.drop(
+                    columns="Attributes"
+                )
+            )
+            assert projections_trace.events.drop(columns="Attributes").equals(
+                Trace.from_projections(projections_dir, 2).events.drop(
+                    columns="Attributes"
+                )
+            )
+            assert hpct_trace.events.equals(Trace.from_hpctoolkit(hpct_dir, 2).events)
+
+    with pytest.raises(ValueError):
+        executor.pool
+
+
+def test_shared_columns():
+    from pipit.parallel import concat_columns, share_columns
+
+    parts = [
+        {
+            "Timestamp (ns)": np.arange(3, dtype=np.int64),
+            "Name": pd.Categorical(["b", "a", "b"]),
+            "Sender": pd.array([1, None, 3], dtype="Int32"),
+            "Attributes": np.array([{"a": 1}, None, {}], dtype=object),
+        },
+        {
+            "Timestamp (ns)": np.arange(3, 5, dtype=np.int64),
+            "Name": pd.Categorical(["c", None]),
+            "Sender": pd.array([None, 5], dtype="Int32"),
+            "Attributes": np.array([None, None], dtype=object),
+        },
+    ]
+
+    # the columns are the same whether or not they went through shared memory
+    expected = pd.DataFrame(concat_columns(parts))
+    columns = pd.DataFrame(concat_columns([share_columns(part) for part in parts]))
+
+    assert columns.equals(expected)
+    assert list(columns["Timestamp (ns)"]) == [0, 1, 2, 3, 4]
+    assert list(columns["Name"].cat.categories) == ["a", "b", "c"]
+    assert list(columns["Name"].astype(object).fillna("-")) == list("babc-")
+    assert columns["Sender"].dtype == "Int32"
+    assert list(columns["Sender"].fillna(0)) == [1, 0, 3, 0, 5]
+    assert list(columns["Attributes"]) == [{"a": 1}, None, {}, None, None]
+
+
+def test_read_filter(data_dir, ping_pong_otf2_trace):
+    from pipit.trace import ReadFilter
+
+    readers = [
+        lambda **kwargs: Trace.from_otf2(str(ping_pong_otf2_trace), **kwargs),
+        lambda **kwargs: Trace.from_projections(
+            os.path.join(data_dir, "ping-pong-projections"), **kwargs
+        ),
+        lambda **kwargs: Trace.from_hpctoolkit(
+            os.path.join(data_dir, "ping-pong-hpctoolkit"), **kwargs
+        ),
+    ]
+
+    for read in readers:
+        events = read().events
+        timestamps = events["Timestamp (ns)"].values
+        names = list(events["Name"].unique()[:3])
+
+        for options in [
+            {
+                "time_range": (
+                    timestamps[len(events) // 4],
+                    timestamps[-len(events) // 4],
+                )
+            },
+            {"time_range": (None, timestamps[len(events) // 2])},
+            {"processes": [1]},
+            {"names": names},
+            {"time_range": (timestamps[len(events) // 3], None), "processes": [0]},
+        ]:
+            # the filters pushed down into the reader give the same events as
+            # filtering all of them
+            filtered = read(**options).events
+            expected = ReadFilter(**options).apply(events)
+
+            assert len(filtered) == len(expected) > 0
+            for column in ["Timestamp (ns)", "Process", "Name"]:
+                assert sorted(filtered[column]) == sorted(expected[column])
+
+
+def test_iter_events(data_dir, ping_pong_otf2_trace):
+    from pipit import streaming
+
+    trace = Trace.from_otf2(str(ping_pong_otf2_trace))
+    trace.calc_exc_metrics(["Timestamp (ns)"])
+
+    def chunks():
+        return Trace.iter_events(str(ping_pong_otf2_trace), chunk_size=7)
+
+    assert [len(chunk) for chunk in chunks()][:-1] == [7] * (len(trace.events) // 7)
+    assert sum(len(chunk) for chunk in chunks()) == len(trace.events)
+
+    # the analyses that fold over the chunks give the same results as those
+    # of the whole trace
+    for per_process in [False, True]:
+        profile = streaming.flat_profile(chunks(), per_process=per_process)
+        expected = trace.flat_profile(
+            ["time.inc", "time.exc"], per_process=per_process
+        ).dropna()
+        assert list(profile.index) == list(expected.index)
+        assert np.allclose(profile.values, expected.values)
+
+        # no events give an empty profile
+        profile = streaming.flat_profile(iter([]), per_process=per_process)
+        assert len(profile) == 0
+        assert list(profile.columns) == ["time.inc", "time.exc"]
+        assert profile.index.names == expected.index.names
+
+    for output in ["size", "count"]:
+        assert np.array_equal(
+            streaming.comm_matrix(chunks(), output), trace.comm_matrix(output)
+        )
+
+    for bins, kwargs in [(20, {}), (5, {"range": (0, 10**6)})]:
+        counts, edges = streaming.message_histogram(chunks(), bins, **kwargs)
+        expected_counts, expected_edges = trace.message_histogram(bins, **kwargs)
+        assert np.array_equal(counts, expected_counts)
+        assert np.allclose(edges, expected_edges)
+
+
+def test_event_order(data_dir, ping_pong_otf2_trace):
+    from pipit.parallel import sort_columns
+
+    # sorted runs are merged by a stable sort, and sorted columns are kept
+    columns = {"Key": np.array([1, 3, 3, 0, 3, 5]), "Value": np.arange(6)}
+    merged = sort_columns(columns, "Key")
+    assert list(merged["Key"]) == [0, 1, 3, 3, 3, 5]
+    assert list(merged["Value"]) == [3, 0, 1, 2, 4, 5]
+    assert sort_columns(merged, "Key") is merged
+
+    readers = [
+        lambda **kwargs: Trace.from_otf2(str(ping_pong_otf2_trace), **kwargs),
+        lambda **kwargs: Trace.from_projections(
+            os.path.join(data_dir, "ping-pong-projections"), **kwargs
+        ),
+        lambda **kwargs: Trace.from_hpctoolkit(
+            os.path.join(data_dir, "ping-pong-hpctoolkit"), **kwargs
+        ),
+    ]
+
+    for read in readers:
+        by_time = read().events
+        by_location = read(order="location").events
+        assert by_time["Timestamp (ns)"].is_monotonic_increasing
+
+        # the events of each location are contiguous
+        location_index = Trace(None, by_location).location_index
+        assert np.count_nonzero(np.diff(location_index.codes)) == (
+            len(location_index) - 1
+        )
+
+        # and the events of each location are in the same order
+        location_columns = [
+            column for column in ["Process", "Thread"] if column in by_time.columns
+        ]
+        for events in [by_time, by_location]:
+            events.sort_values(
+                location_columns, kind="stable", inplace=True, ignore_index=True
+            )
+        for column in ["Timestamp (ns)", "Event Type", "Name"]:
+            assert list(by_time[column]) == list(by_location[column])
+
+
+def test_from_csv(data_dir, ping_pong_otf2_trace, tmp_path):
+    events = Trace.from_otf2(str(ping_pong_otf2_trace)).events.drop(
+        columns="Attributes"
+    )
+    events.to_csv(tmp_path / "trace.csv", index=False)
+
+    # a directory of a csv file per rank
+    (tmp_path / "ranks").mkdir()
+    for process, rank_events in events.groupby("Process", observed=True):
+        rank_events.to_csv(tmp_path / "ranks" / f"{process}.csv", index=False)
+
+    trace = Trace.from_csv(str(tmp_path / "trace.csv"))
+    assert trace.events["Event Type"].dtype == "category"
+    assert trace.events["Name"].dtype == "category"
+    assert trace.events["Process"].cat.categories.dtype == np.int32
+
+    ranks_trace = Trace.from_csv(str(tmp_path / "ranks"), num_processes=2)
+    assert ranks_trace.events.equals(trace.events)
+    assert sum(
+        len(chunk) for chunk in Trace.iter_events(str(tmp_path / "ranks"), 7)
+    ) == len(events)
+
+
+def test_from_nsight(tmp_path):
+    pd.DataFrame(
+        {
+            "Name": ["a", "b", "c", "a", "b"],
+            "Start (ns)": [0, 5, 10, 2, 3],
+            "End (ns)": [30, 10, 12, 4, 3],
+            "PID": [70, 70, 70, 8, 8],
+            "TID": [71, 75, 71, 9, 9],
+            "Duration (ns)": [30, 5, 2, 2, 0],
+        }
+    ).to_csv(tmp_path / "report.csv", index=False)
+
+    events = Trace.from_nsight(str(tmp_path / "report.csv")).events
+    assert list(events.columns) == [
+        "Timestamp (ns)",
+        "Event Type",
+        "Name",
+        "Thread",
+        "Process",
+        "PID",
+        "TID",
+        "Duration (ns)",
+    ]
+
+    # each row is an enter and a leave event, in time order (and the enter
+    # event is first if they have the same timestamp)
+    assert list(events["Timestamp (ns)"]) == [0, 2, 3, 3, 4, 5, 10, 10, 12, 30]
+    event_types = ["Enter", "Enter", "Enter", "Leave", "Leave", "Enter"]
+    event_types += ["Leave", "Enter", "Leave", "Leave"]
+    assert list(events["Event Type"]) == event_types
+
+    # processes and the threads of each process are numbered in sorted order
+    assert list(events["Process"]) == [1, 0, 0, 0, 0, 1, 1, 1, 1, 1]
+    assert list(events["Thread"]) == [0, 0, 0, 0, 0, 1, 1, 0, 0, 0]
+
+    events = Trace.from_nsight(str(tmp_path / "report.csv"), columns=[]).events
+    assert "Duration (ns)" not in events.columns
+
+    # the only process of a single process report is process 0
+    report = pd.read_csv(tmp_path / "report.csv")
+    report[report["PID"] == 8].to_csv(tmp_path / "single.csv", index=False)
+    assert (
+        len(Trace.from_nsight(str(tmp_path / "single.csv"), processes=[1]).events) == 0
+    )
+    assert (
+        len(Trace.from_nsight(str(tmp_path / "single.csv"), processes=[0]).events) == 4
+    )
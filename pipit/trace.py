@@ -3,8 +3,13 @@
 #
 # SPDX-License-Identifier: MIT
 
+import hashlib
+import os
+import pickle
+import shutil
 import numpy as np
 import pandas as pd
+from pipit.parallel import run_sharded, split_shards
 
 
 class Trace:
@@ -12,81 +17,425 @@ class Trace:
     or more dataframes.
     """
 
-    def __init__(self, definitions, events):
-        """Create a new Trace object."""
+    def __init__(self, definitions, events, num_processes=1):
+        """Create a new Trace object.
+
+        num_processes is the number of processes used to analyze the events of
+        different locations in parallel (1 analyzes them serially).
+        """
         self.definitions = definitions
+        self.num_processes = num_processes
+
+        # setting the events also resets the location index and call tree
         self.events = events
 
         # list of numeric columns which we can calculate inc/exc metrics with
-        self.numeric_cols = list(
-            self.events.select_dtypes(include=[np.number]).columns.values
-        )
+        # (the message attributes are numbers, but not metrics)
+        self.numeric_cols = [
+            column
+            for column in self.events.select_dtypes(include=[np.number]).columns
+            if column not in MESSAGE_COLUMNS
+        ]
 
         # will store columns names for inc/exc metrics
         self.inc_metrics = []
         self.exc_metrics = []
 
     @staticmethod
-    def from_otf2(dirname, num_processes=None):
-        """Read an OTF2 trace into a new Trace object."""
+    def from_otf2(
+        dirname,
+        num_processes=None,
+        message_columns=False,
+        cache=None,
+        executor=None,
+        time_range=None,
+        processes=None,
+        names=None,
+        order="time",
+    ):
+        """Read an OTF2 trace into a new Trace object.
+
+        If message_columns is True, the attributes of the message events are
+        also read into typed columns (Sender, Receiver, Msg Length, Tag and
+        Communicator), and if it is "only", the Attributes column isn't
+        created.
+
+        If cache is True or a directory, the parsed trace is saved to (or
+        loaded from) a cache in that directory, see _read_cached.
+
+        If executor is an Executor, its (already running) worker processes
+        are used to read the trace, instead of starting new ones.
+
+        Only the events with a timestamp in time_range (a (start, end) tuple
+        of nanoseconds), of the given processes and with the given names are
+        read, see ReadFilter.
+
+        If order is "location", the events are grouped by location (and in
+        time order within each location) instead of merged into time order.
+        """
         # import this lazily to avoid circular dependencies
         from .readers.otf2_reader import OTF2Reader
 
-        return OTF2Reader(dirname, num_processes).read()
+        read_filter = ReadFilter(time_range, processes, names)
+
+        return _read_cached(
+            lambda: OTF2Reader(
+                dirname,
+                num_processes,
+                message_columns,
+                executor=executor,
+                read_filter=read_filter,
+                order=order,
+            ).read(),
+            dirname,
+            cache,
+            ("otf2", message_columns, order) + read_filter.key(),
+        )
 
     @staticmethod
-    def from_hpctoolkit(dirname):
-        """Read an HPCToolkit trace into a new Trace object."""
+    def from_hpctoolkit(
+        dirname,
+        num_processes=None,
+        cache=None,
+        executor=None,
+        time_range=None,
+        processes=None,
+        names=None,
+        order="time",
+    ):
+        """Read an HPCToolkit trace into a new Trace object.
+
+        If cache is True or a directory, the parsed trace is saved to (or
+        loaded from) a cache in that directory, see _read_cached.
+
+        If executor is an Executor, its (already running) worker processes
+        are used to read the trace, instead of starting new ones.
+
+        Only the events with a timestamp in time_range (a (start, end) tuple
+        of nanoseconds), of the given processes and with the given names are
+        read, see ReadFilter.
+
+        If order is "location", the events are grouped by location (and in
+        time order within each location) instead of merged into time order.
+        """
         # import this lazily to avoid circular dependencies
         from .readers.hpctoolkit_reader import HPCToolkitReader
 
-        return HPCToolkitReader(dirname).read()
+        read_filter = ReadFilter(time_range, processes, names)
+
+        return _read_cached(
+            lambda: HPCToolkitReader(
+                dirname, num_processes, executor, read_filter, order
+            ).read(),
+            dirname,
+            cache,
+            ("hpctoolkit", order) + read_filter.key(),
+        )
 
     @staticmethod
-    def from_projections(dirname, num_processes=None):
-        """Read a Projections trace into a new Trace object."""
+    def from_projections(
+        dirname,
+        num_processes=None,
+        message_columns=False,
+        cache=None,
+        executor=None,
+        time_range=None,
+        processes=None,
+        names=None,
+        order="time",
+    ):
+        """Read a Projections trace into a new Trace object.
+
+        If message_columns is True, the attributes of the message events are
+        also stored in typed columns (Sender, Msg Length and Event ID), and if
+        it is "only", the Attributes column is dropped.
+
+        If cache is True or a directory, the parsed trace is saved to (or
+        loaded from) a cache in that directory, see _read_cached.
+
+        If executor is an Executor, its (already running) worker processes
+        are used to read the trace, instead of starting new ones.
+
+        Only the events with a timestamp in time_range (a (start, end) tuple
+        of nanoseconds), of the given processes and with the given names are
+        read, see ReadFilter.
+
+        If order is "location", the events are grouped by location (and in
+        time order within each location) instead of merged into time order.
+        """
         # import this lazily to avoid circular dependencies
         from .readers.projections_reader import ProjectionsReader
 
-        return ProjectionsReader(dirname, num_processes).read()
+        read_filter = ReadFilter(time_range, processes, names)
+
+        return _read_cached(
+            lambda: ProjectionsReader(
+                dirname,
+                num_processes,
+                message_columns,
+                executor=executor,
+                read_filter=read_filter,
+                order=order,
+            ).read(),
+            dirname,
+            cache,
+            ("projections", message_columns, order) + read_filter.key(),
+        )
 
     @staticmethod
-    def from_nsight(filename):
-        """Read an Nsight trace into a new Trace object."""
+    def from_nsight(
+        filename, time_range=None, processes=None, names=None, columns=None
+    ):
+        """Read an Nsight trace into a new Trace object.
+
+        Only the events with a timestamp in time_range (a (start, end) tuple
+        of nanoseconds), of the given processes and with the given names are
+        read, see ReadFilter.
+
+        columns is the list of the other columns of the report to read (all
+        of them by default), besides the ones the events are created from.
+        """
         # import this lazily to avoid circular dependencies
         from .readers.nsight_reader import NsightReader
 
-        return NsightReader(filename).read()
+        return NsightReader(
+            filename, ReadFilter(time_range, processes, names), columns
+        ).read()
+
+    @staticmethod
+    def from_csv(
+        path,
+        time_range=None,
+        processes=None,
+        names=None,
+        num_processes=None,
+        executor=None,
+        engine=None,
+    ):
+        """Read a CSV file of events, or a directory of them (such as a file
+        per rank), into a new Trace object.
+
+        Only the events with a timestamp in time_range (a (start, end) tuple
+        of nanoseconds), of the given processes and with the given names are
+        read, see ReadFilter.
+
+        The files of a directory are read in parallel by num_processes
+        processes (or by the worker processes of executor, see Executor).
+        engine is the pandas parser engine: "pyarrow" reads each file at
+        once with multiple threads, but only for files without spaces after
+        the delimiters.
+        """
+        # import this lazily to avoid circular dependencies
+        from .readers.csv_reader import CSVReader
+
+        return CSVReader(
+            path,
+            num_processes,
+            executor,
+            ReadFilter(time_range, processes, names),
+            engine,
+        ).read()
 
     @staticmethod
-    def from_csv(filename):
-        events_dataframe = pd.read_csv(filename, skipinitialspace=True)
-
-        # if timestamps are in seconds, convert them to nanoseconds
-        if "Timestamp (s)" in events_dataframe.columns:
-            events_dataframe["Timestamp (s)"] *= 10**9
-            events_dataframe.rename(
-                columns={"Timestamp (s)": "Timestamp (ns)"}, inplace=True
+    def iter_events(
+        source, chunk_size=None, time_range=None, processes=None, names=None
+    ):
+        """Reads the events of a trace in chunks of at most chunk_size events
+        (CHUNK_SIZE by default), and returns an iterator of the events
+        DataFrame of each chunk, so that traces that don't fit in memory can
+        be summarized one chunk at a time (see pipit.streaming).
+
+        The source is an OTF2, HPCToolkit or Projections trace directory, or
+        a CSV file of events (or a directory of them). The chunks of OTF2
+        traces are in time order, those of HPCToolkit and Projections traces
+        are read one location at a time (in time order within each location),
+        and those of CSV files are read one file at a time (and sorted within
+        each chunk).
+
+        Only the events with a timestamp in time_range (a (start, end) tuple
+        of nanoseconds), of the given processes and with the given names are
+        read, see ReadFilter.
+        """
+        chunk_size = CHUNK_SIZE if chunk_size is None else chunk_size
+        read_filter = ReadFilter(time_range, processes, names)
+
+        # import these lazily to avoid circular dependencies
+        if os.path.isfile(os.path.join(source, "traces.otf2")):
+            from .readers.otf2_reader import OTF2Reader
+
+            reader = OTF2Reader(source, 1, read_filter=read_filter)
+        elif os.path.isfile(os.path.join(source, "trace.db")):
+            from .readers.hpctoolkit_reader import HPCToolkitReader
+
+            reader = HPCToolkitReader(source, 1, read_filter=read_filter)
+        elif os.path.isdir(source) and any(
+            file.endswith(".sts") for file in os.listdir(source)
+        ):
+            from .readers.projections_reader import ProjectionsReader
+
+            reader = ProjectionsReader(source, 1, read_filter=read_filter)
+        elif os.path.isfile(source) or (
+            os.path.isdir(source)
+            and any(file.endswith(".csv") for file in os.listdir(source))
+        ):
+            from .readers.csv_reader import CSVReader
+
+            reader = CSVReader(source, 1, read_filter=read_filter)
+        else:
+            raise ValueError("Not a trace directory or CSV file: " + str(source))
+
+        return reader.iter_events(chunk_size)
+
+    def save(self, path):
+        """Saves the trace, including any derived columns and metrics, to a
+        directory that can be read back with Trace.load. Requires pyarrow.
+
+        The events are stored in an uncompressed Feather file, which is
+        memory-mapped when it is loaded. Columns of Python objects (like
+        Attributes), the definitions and the lists of metrics are pickled, so
+        saved traces should only be loaded from trusted directories.
+        """
+        from pyarrow import feather
+
+        os.makedirs(path, exist_ok=True)
+
+        object_columns = [
+            column
+            for column in self.events.columns
+            if self.events[column].dtype == object
+        ]
+
+        feather.write_feather(
+            self.events.drop(columns=object_columns),
+            os.path.join(path, "events.feather"),
+            compression="uncompressed",
+        )
+
+        with open(os.path.join(path, "trace.pkl"), "wb") as f:
+            pickle.dump(
+                {
+                    "columns": list(self.events.columns),
+                    "objects": {
+                        column: self.events[column].values for column in object_columns
+                    },
+                    "definitions": self.definitions,
+                    "numeric_cols": self.numeric_cols,
+                    "inc_metrics": self.inc_metrics,
+                    "exc_metrics": self.exc_metrics,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
             )
 
-        # ensure that ranks are ints
-        events_dataframe = events_dataframe.astype({"Process": "int32"})
+    @staticmethod
+    def load(path, num_processes=1):
+        """Loads a trace that was saved with Trace.save. Requires pyarrow.
+
+        The numeric columns of the events without missing values are not
+        copied, and are read-only views of the memory-mapped file (so they
+        are only paged in as they are used). The other columns, such as the
+        categoricals, are converted into memory.
 
-        # make certain columns categorical
-        events_dataframe = events_dataframe.astype(
+        The definitions and the object columns are unpickled, which can run
+        arbitrary code, so only load traces from a directory that is trusted
+        (and not writable by others).
+        """
+        from pyarrow import feather
+
+        # each column is converted into its own block, so that the columns
+        # that can be are not copied out of the memory map, and the arrow
+        # buffers of the other columns are freed as they are converted
+        events = feather.read_table(
+            os.path.join(path, "events.feather"), memory_map=True
+        ).to_pandas(split_blocks=True, self_destruct=True)
+
+        with open(os.path.join(path, "trace.pkl"), "rb") as f:
+            saved = pickle.load(f)
+
+        # the columns are put back in their order (with the object columns)
+        # without copying them
+        events = pd.DataFrame(
             {
-                "Event Type": "category",
-                "Name": "category",
-                "Process": "category",
-            }
+                column: saved["objects"][column]
+                if column in saved["objects"]
+                else events[column].values
+                for column in saved["columns"]
+            },
+            copy=False,
         )
 
-        # sort the dataframe by Timestamp
-        events_dataframe.sort_values(
-            by="Timestamp (ns)", axis=0, ascending=True, inplace=True, ignore_index=True
-        )
+        trace = Trace(saved["definitions"], events, num_processes)
+        trace.numeric_cols = saved["numeric_cols"]
+        trace.inc_metrics = saved["inc_metrics"]
+        trace.exc_metrics = saved["exc_metrics"]
+
+        return trace
 
-        return Trace(None, events_dataframe)
+    @property
+    def events(self):
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events
+
+        # the location index and call tree are built lazily
+        # from the new events
+        self._location_index = None
+        self.call_tree = None
+
+    @property
+    def location_index(self):
+        """Index of the rows of each location of the events dataframe, which
+        is built on first use and reused until the events are replaced.
+        """
+        if self._location_index is None:
+            self._location_index = LocationIndex(self.events)
+
+        return self._location_index
+
+    def _group_by_location(self, mask):
+        """Groups the row positions of the events dataframe selected by a
+        boolean mask by location.
+
+        Returns the rows ordered so that the rows of each location are
+        contiguous (and still in time order), their location codes, and the
+        start offset of each location.
+        """
+        location_index = self.location_index
+
+        rows = location_index.rows[mask[location_index.rows]]
+        loc_codes = location_index.codes[rows]
+        loc_starts = np.flatnonzero(np.diff(loc_codes, prepend=np.nan))
+
+        return rows, loc_codes, loc_starts
+
+    def promote_attributes(self, columns, drop_attributes=False):
+        """Moves values out of the per-row Attributes dicts into typed columns,
+        so that analyses can use them without unpacking the dicts. This is for
+        traces that are already loaded, since the readers create the message
+        columns at read time (see message_columns of Trace.from_otf2).
+
+        Arguments:
+        columns: dict mapping the name of each new column to a tuple of the
+        attribute key and the (nullable) dtype of the column, e.g.
+        {"Receiver": ("receiver", "Int32")}. Rows without the key are null.
+        drop_attributes: whether to drop the Attributes column afterwards to
+        save memory
+        """
+        attributes = self.events["Attributes"].values
+
+        for column, (key, dtype) in columns.items():
+            self.events[column] = pd.array(
+                [
+                    attrs.get(key) if isinstance(attrs, dict) else None
+                    for attrs in attributes
+                ],
+                dtype=dtype,
+            )
+
+        if drop_attributes:
+            self.events.drop(columns="Attributes", inplace=True)
 
     def _match_events(self):
         """Matches corresponding enter/leave events and adds two columns to the
@@ -94,101 +443,56 @@ class Trace:
         """
 
         if "_matching_event" not in self.events.columns:
-            matching_events = [float("nan")] * len(self.events)
-            matching_times = [float("nan")] * len(self.events)
+            num_events = len(self.events)
+            matching_events = np.full(num_events, -1, dtype=np.int64)
+            matching_times = np.full(num_events, np.nan)
 
             # only pairing enter and leave rows
-            enter_leave_df = self.events.loc[
-                self.events["Event Type"].isin(["Enter", "Leave"])
-            ]
-
-            # list of processes and/or threads to iterate over
-            if "Thread" in self.events.columns:
-                exec_locations = set(zip(self.events["Process"], self.events["Thread"]))
-                has_thread = True
-            else:
-                exec_locations = set(self.events["Process"])
-                has_thread = False
-
-            for curr_loc in exec_locations:
-                # only filter by thread if the trace has a thread column
-                if has_thread:
-                    curr_process, curr_thread = curr_loc
-                    filtered_df = enter_leave_df.loc[
-                        (enter_leave_df["Process"] == curr_process)
-                        & (enter_leave_df["Thread"] == curr_thread)
-                    ]
-                else:
-                    filtered_df = enter_leave_df.loc[
-                        (enter_leave_df["Process"] == curr_loc)
-                    ]
-
-                stack = []
-
-                # Note: The reason that we are creating lists that are
-                # copies of the dataframe columns below and iterating over
-                # those instead of using pandas iterrows is due to an
-                # observed improvement in performance when using lists.
-
-                event_types = list(filtered_df["Event Type"])
-                df_indices, timestamps, names = (
-                    list(filtered_df.index),
-                    list(filtered_df["Timestamp (ns)"]),
-                    list(filtered_df.Name),
-                )
+            event_types = self.events["Event Type"]
+            rows, loc_codes, loc_starts = self._group_by_location(
+                event_types.isin(["Enter", "Leave"]).values
+            )
 
-                # Iterate through all events of filtered DataFrame
-                for i in range(len(filtered_df)):
-                    curr_df_index, curr_timestamp, evt_type, curr_name = (
-                        df_indices[i],
-                        timestamps[i],
-                        event_types[i],
-                        names[i],
-                    )
-
-                    if evt_type == "Enter":
-                        # Add current dataframe index and timestamp to stack
-                        stack.append((curr_df_index, curr_timestamp, curr_name))
-                    else:
-                        # we want to iterate through the stack in reverse order
-                        # until we find the corresponding "Enter" Event
-                        enter_name, i = None, len(stack) - 1
-                        while enter_name != curr_name and i > -1:
-                            enter_df_index, enter_timestamp, enter_name = stack[i]
-                            i -= 1
-
-                        if enter_name == curr_name:
-                            # remove matched event from the stack
-                            del stack[i + 1]
-
-                            # Fill in the lists with the matching values if event found
-                            matching_events[enter_df_index] = curr_df_index
-                            matching_events[curr_df_index] = enter_df_index
-
-                            matching_times[enter_df_index] = curr_timestamp
-                            matching_times[curr_df_index] = enter_timestamp
-                        else:
-                            continue
-
-            self.events["_matching_event"] = matching_events
-            self.events["_matching_timestamp"] = matching_times
+            # match the events of each location, in parallel if
+            # num_processes > 1
+            run_sharded(
+                _match_events_kernel,
+                {
+                    "rows": rows,
+                    "loc_codes": loc_codes,
+                    "is_enter": np.asarray(event_types.values[rows] == "Enter"),
+                    "names": _factorize(self.events["Name"])[rows],
+                    "timestamps": self.events["Timestamp (ns)"].values[rows],
+                },
+                {},
+                {
+                    "matching_events": matching_events,
+                    "matching_times": matching_times,
+                },
+                split_shards(loc_starts, len(rows), self.num_processes),
+                self.num_processes,
+            )
 
-            self.events = self.events.astype({"_matching_event": "Int32"})
+            self.events["_matching_event"] = pd.arrays.IntegerArray(
+                matching_events.astype(np.int32), matching_events == -1
+            )
+            self.events["_matching_timestamp"] = matching_times
 
     def _match_caller_callee(self):
-        """Matches callers (parents) to callees (children) and adds three
+        """Matches callers (parents) to callees (children) and adds two
         columns to the dataframe:
-        _depth, _parent, and _children
+        _depth and _parent
         _depth is the depth of the event in the call tree (starting from 0 for root)
-        _parent is the dataframe index of a row's parent event.
-        _children is a list of dataframe indices of a row's children events.
+        _parent is the row position of a row's parent event.
+
+        The call tree is also stored in self.call_tree, which gives the
+        row positions of a row's children events.
         """
 
-        if "_children" not in self.events.columns:
-            children = [None] * len(self.events)
-            depth, parent = [float("nan")] * len(self.events), [float("nan")] * len(
-                self.events
-            )
+        if "_parent" not in self.events.columns:
+            num_events = len(self.events)
+            depth = np.full(num_events, -1, dtype=np.int32)
+            parent = np.full(num_events, -1, dtype=np.int32)
 
             # match events so we can
             # ignore unmatched ones
@@ -196,84 +500,34 @@ class Trace:
 
             # only use enter and leave rows
             # to determine calling relationships
-            enter_leave_df = self.events.loc[
-                (
-                    self.events["Event Type"].isin(["Enter", "Leave"])
-                    & (self.events["_matching_event"].notnull())
-                )
-            ]
-
-            # list of processes and/or threads to iterate over
-            if "Thread" in self.events.columns:
-                exec_locations = set(zip(self.events["Process"], self.events["Thread"]))
-                has_thread = True
-            else:
-                exec_locations = set(self.events["Process"])
-                has_thread = False
-
-            for curr_loc in exec_locations:
-                # only filter by thread if the trace has a thread column
-                if has_thread:
-                    curr_process, curr_thread = curr_loc
-                    filtered_df = enter_leave_df.loc[
-                        (enter_leave_df["Process"] == curr_process)
-                        & (enter_leave_df["Thread"] == curr_thread)
-                    ]
-                else:
-                    filtered_df = enter_leave_df.loc[
-                        (enter_leave_df["Process"] == curr_loc)
-                    ]
-
-                # Depth is the level in the
-                # Call Tree starting from 0
-                curr_depth = 0
-
-                stack = []
-                df_indices, event_types = list(filtered_df.index), list(
-                    filtered_df["Event Type"]
-                )
+            rows, loc_codes, loc_starts = self._group_by_location(
+                self.events["_matching_event"].notnull().values
+            )
 
-                # loop through the events of the filtered dataframe
-                for i in range(len(filtered_df)):
-                    curr_df_index, evt_type = df_indices[i], event_types[i]
-
-                    if evt_type == "Enter":
-                        if curr_depth > 0:  # if event is a child of some other event
-                            parent_df_index = stack[-1]
-
-                            if children[parent_df_index] is None:
-                                # create a new list of children for the
-                                # parent if the current event is the first
-                                # child being added
-                                children[parent_df_index] = [curr_df_index]
-                            else:
-                                children[parent_df_index].append(curr_df_index)
-
-                            parent[curr_df_index] = parent_df_index
-
-                        depth[curr_df_index] = curr_depth
-                        curr_depth += 1
-
-                        # add enter dataframe index to stack
-                        stack.append(curr_df_index)
-                    else:
-                        # pop event off stack once matching leave found
-                        # Note: parent, and children for a leave row
-                        # can be found using the matching index that
-                        # corresponds to the enter row
-                        stack.pop()
-
-                        curr_depth -= 1
-
-            self.events["_depth"], self.events["_parent"], self.events["_children"] = (
-                depth,
-                parent,
-                children,
+            # build the call tree of each location, in parallel if
+            # num_processes > 1
+            run_sharded(
+                _match_caller_callee_kernel,
+                {
+                    "rows": rows,
+                    "loc_codes": loc_codes,
+                    "is_enter": np.asarray(
+                        self.events["Event Type"].values[rows] == "Enter"
+                    ),
+                },
+                {},
+                {"depth": depth, "parent": parent},
+                split_shards(loc_starts, len(rows), self.num_processes),
+                self.num_processes,
             )
 
-            self.events = self.events.astype({"_depth": "Int32", "_parent": "Int32"})
-            self.events = self.events.astype(
-                {"_depth": "category", "_parent": "category"}
+            self.events["_depth"] = pd.arrays.IntegerArray(depth, depth == -1)
+            self.events["_parent"] = pd.arrays.IntegerArray(parent, parent == -1)
+
+        if self.call_tree is None:
+            self.call_tree = CallTree(
+                self.events["_parent"].fillna(-1).values.astype(np.int32),
+                self.events["_depth"].fillna(-1).values.astype(np.int32),
             )
 
     def calc_inc_metrics(self, columns=None):
@@ -318,38 +572,45 @@ class Trace:
         # match caller and callee rows
         self._match_caller_callee()
 
-        # exclusive metrics only change for rows that have children
-        filtered_df = self.events.loc[self.events["_children"].notnull()]
-        parent_df_indices, children = (
-            list(filtered_df.index),
-            filtered_df["_children"].to_list(),
-        )
+        # calculate the corresponding inclusive metrics
+        self.calc_inc_metrics(columns)
 
-        for col in columns:
-            # get the corresponding inclusive column name for this metric
-            inc_col_name = ("time" if col == "Timestamp (ns)" else col) + ".inc"
-            if inc_col_name not in self.events.columns:
-                self.calc_inc_metrics([col])
-
-            # name of column for this exclusive metric
-            metric_col_name = ("time" if col == "Timestamp (ns)" else col) + ".exc"
-
-            if metric_col_name not in self.events.columns:
-                # exc metric starts out as a copy of the inc metric values
-                exc_values = self.events[inc_col_name].to_list()
-                inc_values = self.events[inc_col_name].to_list()
+        # names of the exclusive metrics that have to be calculated
+        metric_cols = [
+            ("time" if col == "Timestamp (ns)" else col) + ".exc" for col in columns
+        ]
+        metric_cols = [col for col in metric_cols if col not in self.events.columns]
 
-                for i in range(len(filtered_df)):
-                    curr_parent_idx, curr_children = parent_df_indices[i], children[i]
-                    for child_idx in curr_children:
-                        # subtract each child's inclusive metric from the total
-                        # to calculate the exclusive metric for the parent
-                        exc_values[curr_parent_idx] -= inc_values[child_idx]
+        # exc metrics start out as a copy of the inc metric values
+        inc_values = {
+            col: self.events[col[:-4] + ".inc"].to_numpy(
+                dtype=np.float64, na_value=np.nan
+            )
+            for col in metric_cols
+        }
+        exc_values = {col: values.copy() for col, values in inc_values.items()}
+
+        # The children of the call tree are grouped by parent, so each
+        # parent's children can be summed with a single reduction over
+        # the children of all parents, in parallel if num_processes > 1
+        children = self.call_tree.child_indices
+        parents = self.call_tree.parent[children]
+        parent_starts = np.flatnonzero(np.diff(parents, prepend=np.nan))
+
+        run_sharded(
+            _exc_metrics_kernel,
+            {"children": children, "parents": parents},
+            inc_values,
+            exc_values,
+            split_shards(parent_starts, len(children), self.num_processes),
+            self.num_processes,
+        )
 
-                self.events[metric_col_name] = exc_values
-                self.exc_metrics.append(metric_col_name)
+        for col in metric_cols:
+            self.events[col] = exc_values[col]
+            self.exc_metrics.append(col)
 
-    def comm_matrix(self, output="size"):
+    def comm_matrix(self, output="size", sparse=False):
         """
         Communication Matrix for Peer-to-Peer (P2P) MPI messages
 
@@ -360,14 +621,19 @@ class Trace:
         by bytes transferred between two processes or the number of messages
         sent (two choices - "size" or "count")
 
+        2) sparse -
+        if True, a scipy.sparse.coo_matrix is returned instead of a dense
+        array, so that the matrix of runs with many processes fits in memory
+        (requires scipy)
+
         Returns:
-        Creates three lists - sender ranks, receiver ranks, and message volume.
-        All of these lists are the length of the number of messages sent in the trace.
-        It then loops through these lists containing individual message pairs
-        and volume for those messages and updates the comm matrix.
+        Creates three arrays - sender ranks, receiver ranks, and message volume.
+        All of these arrays are the length of the number of messages sent in the
+        trace. The sender and receiver ranks are flattened into a single index
+        into the comm matrix, and the message volumes are summed per index.
 
-        Finally, a 2D Numpy Array that represents the communication matrix for all P2P
-        messages of the given trace is returned.
+        Finally, a 2D Numpy Array (or a sparse matrix) that represents the
+        communication matrix for all P2P messages of the given trace is returned.
 
         Note:
         The first dimension of the returned 2d array
@@ -377,55 +643,61 @@ class Trace:
 
         # get the list of ranks/processes
         # (mpi messages are sent between processes)
-        ranks = set(self.events["Process"])
-
-        # create a 2d numpy array that will be returned
-        # at the end of the function
-        communication_matrix = np.zeros(shape=(len(ranks), len(ranks)))
+        ranks = self.location_index.get_processes()
+        num_ranks = len(ranks)
 
         # filter the dataframe by MPI Send and Isend events
         sender_dataframe = self.events.loc[
             self.events["Name"].isin(["MpiSend", "MpiIsend"]),
-            ["Process", "Attributes"],
+            ["Process"],
         ]
 
         # get the mpi ranks of all the sender processes
-        # the length of the list is the total number of messages sent
-        sender_ranks = sender_dataframe["Process"].to_list()
+        # the length of the array is the total number of messages sent
+        sender_ranks = sender_dataframe["Process"].values.astype(np.int64)
 
         # get the corresponding mpi ranks of the receivers
-        # the length of the list is the total number of messages sent
-        receiver_ranks = (
-            sender_dataframe["Attributes"]
-            .apply(lambda attrDict: attrDict["receiver"])
-            .to_list()
+        # the length of the array is the total number of messages sent
+        receiver_ranks = self._message_attribute(
+            sender_dataframe.index, "Receiver", "receiver", np.int64
         )
 
-        # the length of the message_volume list created below
+        # the length of the message_volume array created below
         # is the total number of messages sent
 
         # number of bytes communicated for each message sent
         if output == "size":
             # (1 communication is a single row in the sender dataframe)
-            message_volume = (
-                sender_dataframe["Attributes"]
-                .apply(lambda attrDict: attrDict["msg_length"])
-                .to_list()
+            message_volume = self._message_attribute(
+                sender_dataframe.index, "Msg Length", "msg_length", np.float64
             )
         elif output == "count":
             # 1 message between the pairs of processes
             # for each row in the sender dataframe
-            message_volume = np.full(len(sender_dataframe), 1)
-
-        for i in range(len(sender_ranks)):
-            """
-            loops through all the communication events and adds the
-            message volume to the corresponding entry of the 2d array
-            using the sender and receiver ranks
-            """
-            communication_matrix[sender_ranks[i], receiver_ranks[i]] += message_volume[
-                i
-            ]
+            message_volume = np.ones(len(sender_dataframe))
+
+        # index of each message's (sender, receiver) pair in the flattened matrix
+        flat_indices = sender_ranks * num_ranks + receiver_ranks
+
+        if sparse:
+            from scipy.sparse import coo_matrix
+
+            # only sum up the volumes of the pairs that communicate, so that
+            # the dense matrix is never allocated
+            pairs, pair_indices = np.unique(flat_indices, return_inverse=True)
+            volumes = np.bincount(
+                pair_indices, weights=message_volume, minlength=len(pairs)
+            )
+
+            return coo_matrix(
+                (volumes, (pairs // num_ranks, pairs % num_ranks)),
+                shape=(num_ranks, num_ranks),
+            )
+
+        # sum up the message volumes of each pair of processes
+        communication_matrix = np.bincount(
+            flat_indices, weights=message_volume, minlength=num_ranks * num_ranks
+        ).reshape(num_ranks, num_ranks)
 
         return communication_matrix
 
@@ -433,13 +705,25 @@ class Trace:
         """Generates histogram of message frequency by size."""
 
         # Filter by send events
-        messages = self.events[self.events["Name"].isin(["MpiSend", "MpiIsend"])]
+        messages = self.events.index[self.events["Name"].isin(["MpiSend", "MpiIsend"])]
 
         # Get message sizes
-        sizes = messages["Attributes"].map(lambda x: x["msg_length"])
+        sizes = self._message_attribute(messages, "Msg Length", "msg_length", np.int64)
 
         return np.histogram(sizes, bins=bins, **kwargs)
 
+    def _message_attribute(self, index, column, key, dtype):
+        """Returns an attribute of the given message events as an array, from
+        its typed column (see promote_attributes) if the trace has one, or else
+        from the Attributes dicts."""
+        if column in self.events.columns:
+            return self.events[column].loc[index].to_numpy(dtype=dtype)
+
+        attributes = self.events["Attributes"].loc[index].values
+        return np.fromiter(
+            (attrs[key] for attrs in attributes), dtype=dtype, count=len(attributes)
+        )
+
     def flat_profile(self, metrics=None, groupby_column="Name", per_process=False):
         """
         Arguments:
@@ -485,7 +769,7 @@ class Trace:
         imbalances
         """
 
-        num_ranks = len(set(self.events["Process"]))
+        num_ranks = len(self.location_index.get_processes())
         num_display = num_ranks if num_processes > num_ranks else num_processes
 
         flat_profile = self.flat_profile(metrics=metric, per_process=True)
@@ -520,7 +804,7 @@ class Trace:
         # dict for creating a new dataframe
         idle_times = {"Process": [], "Idle Time": []}
 
-        for process in set(self.events["Process"]):
+        for process in self.location_index.get_processes():
             idle_times["Process"].append(process)
             idle_times["Idle Time"].append(
                 self._calculate_idle_time_for_process(
@@ -537,15 +821,13 @@ class Trace:
             self.calc_inc_metrics()
 
         if MPI_events:
-            idle_functions += ["MPI_Wait", "MPI_Waitall", "MPI_Recv"]
+            idle_functions = idle_functions + ["MPI_Wait", "MPI_Waitall", "MPI_Recv"]
         # filter the dataframe to include only 'Enter' events within the specified
         # process with the specified function names
-        df = self.events
-        filtered_df = (
-            df.loc[df["Event Type"] == "Enter"]
-            .loc[df["Process"] == process]
-            .loc[df["Name"].isin(idle_functions)]
-        )
+        df = self.events.iloc[self.location_index.get_rows(process)]
+        filtered_df = df.loc[
+            (df["Event Type"] == "Enter") & (df["Name"].isin(idle_functions))
+        ]
         # get the sum of the inclusive times of these events
         return filtered_df["time.inc"].sum()
 
@@ -566,9 +848,15 @@ class Trace:
         self._match_caller_callee()
         self.calc_inc_metrics(["Timestamp (ns)"])
 
-        # Filter by Enter rows
-        events = self.events[self.events["Event Type"] == "Enter"].copy(deep=False)
-        names = events["Name"].unique().tolist()
+        # Filter by Enter rows (functions without a name get a code too, so
+        # that their time is subtracted from their parents, and are left out
+        # of the profile)
+        is_enter = (self.events["Event Type"] == "Enter").values
+        name_codes, names = pd.factorize(
+            self.events["Name"].values[is_enter], use_na_sentinel=False
+        )
+        is_named = ~pd.isna(np.asarray(names))
+        names = list(names[is_named])
 
         # Create equal-sized bins
         edges = np.linspace(
@@ -578,93 +866,39 @@ class Trace:
         )
         bin_size = edges[1] - edges[0]
 
-        total_bin_duration = bin_size * len(events["Process"].unique())
-
-        profile = []
-
-        def calc_exc_time_in_bin(events):
-            # TODO: check if the numpy equivalent of the below code is faster
-            dfx_to_idx = {
-                dfx: idx
-                for (dfx, idx) in zip(events.index, [i for i in range(len(events))])
-            }
-
-            # start out with exc times being a copy of inc times
-            exc_times = list(events["inc_time_in_bin"].copy(deep=False))
-
-            # filter to events that have children
-            filtered_df = events.loc[events["_children"].notnull()]
-
-            parent_df_indices, children = (
-                list(filtered_df.index),
-                filtered_df["_children"].to_list(),
-            )
-
-            # Iterate through the events that are parents
-            for i in range(len(filtered_df)):
-                curr_parent_idx, curr_children = (
-                    dfx_to_idx[parent_df_indices[i]],
-                    children[i],
-                )
-
-                # Only consider inc times of children in current bin
-                for child_df_idx in curr_children:
-                    if child_df_idx in dfx_to_idx:
-                        exc_times[curr_parent_idx] -= exc_times[
-                            dfx_to_idx[child_df_idx]
-                        ]
-
-            events["exc_time_in_bin"] = exc_times
-
-        # For each bin, determine each function's time contribution
-        for i in range(num_bins):
-            start = edges[i]
-            end = edges[i + 1]
-
-            # Find functions that belong in this bin
-            in_bin = events[
-                (events["_matching_timestamp"] > start)
-                & (events["Timestamp (ns)"] < end)
-            ].copy(deep=False)
-
-            # Calculate inc_time_in_bin for each function
-            # Case 1 - Function starts in bin
-            in_bin.loc[in_bin["Timestamp (ns)"] >= start, "inc_time_in_bin"] = (
-                end - in_bin["Timestamp (ns)"]
-            )
-
-            # Case 2 - Function ends in bin
-            in_bin.loc[in_bin["_matching_timestamp"] <= end, "inc_time_in_bin"] = (
-                in_bin["_matching_timestamp"] - start
-            )
-
-            # Case 3 - Function spans bin
-            in_bin.loc[
-                (in_bin["Timestamp (ns)"] < start)
-                & (in_bin["_matching_timestamp"] > end),
-                "inc_time_in_bin",
-            ] = (
-                end - start
-            )
-
-            # Case 4 - Function contained in bin
-            in_bin.loc[
-                (in_bin["Timestamp (ns)"] >= start)
-                & (in_bin["_matching_timestamp"] <= end),
-                "inc_time_in_bin",
-            ] = (
-                in_bin["_matching_timestamp"] - in_bin["Timestamp (ns)"]
-            )
+        # (only the processes that enter functions are counted)
+        total_bin_duration = bin_size * len(
+            pd.unique(self.events["Process"].values[is_enter])
+        )
 
-            # Calculate exc_time_in_bin by subtracting inc_time_in_bin for all children
-            calc_exc_time_in_bin(in_bin)
+        # The exclusive time of a function in a bin is its own time in the bin,
+        # minus the time of its children in the bin. We thus add the interval
+        # of every matched enter event to its own function, and subtract the
+        # interval of every child event from its parent's function.
+        row_names = np.full(len(self.events), -1, dtype=np.int64)
+        row_names[is_enter] = name_codes
 
-            # Sum across all processes
-            agg = in_bin.groupby("Name")["exc_time_in_bin"].sum()
-            profile.append(agg.to_dict())
+        rows = np.flatnonzero(
+            is_enter & self.events["_matching_event"].notnull().values
+        )
+        children = self.call_tree.child_indices
+
+        timestamps = self.events["Timestamp (ns)"].values
+        matching_timestamps = self.events["_matching_timestamp"].values
+
+        profile = _intervals_per_bin(
+            np.concatenate([timestamps[rows], timestamps[children]]),
+            np.concatenate([matching_timestamps[rows], matching_timestamps[children]]),
+            np.concatenate(
+                [row_names[rows], row_names[self.call_tree.parent[children]]]
+            ),
+            np.concatenate([np.ones(len(rows)), np.full(len(children), -1.0)]),
+            edges,
+            len(is_named),
+        )
 
         # Convert to DataFrame
-        df = pd.DataFrame(profile, columns=names)
+        df = pd.DataFrame(profile[is_named].T, columns=names)
 
         # Add idle_time column
         df.insert(0, "idle_time", total_bin_duration - df.sum(axis=1))
@@ -681,3 +915,503 @@ class Trace:
         df.insert(0, "bin_end", edges[1:])
 
         return df
+
+
+class LocationIndex:
+    """Index of the rows of each location of an events dataframe. A location is
+    a (Process, Thread) pair, or just a Process if there is no Thread column.
+
+    Locations are numbered in sorted order of their Process and Thread, and
+    the row positions of location i are stored in
+    rows[offsets[i] : offsets[i + 1]], in time order.
+    """
+
+    def __init__(self, events):
+        if "Thread" in events.columns:
+            location_cols = ["Process", "Thread"]
+        else:
+            location_cols = ["Process"]
+
+        # combine the codes of the location columns, so that sorting by the
+        # combined code sorts by Process, then Thread
+        codes = np.zeros(len(events), dtype=np.int64)
+        for col in location_cols:
+            col_codes, col_values = pd.factorize(events[col], sort=True)
+            codes = codes * len(col_values) + col_codes
+
+        # a stable sort keeps the rows of each location in time order
+        self.rows = np.argsort(codes, kind="stable")
+        starts = np.flatnonzero(np.diff(codes[self.rows], prepend=np.nan))
+        self.offsets = np.append(starts, len(events))
+
+        # location code (from 0 to the number of locations - 1) of every row
+        self.codes = np.empty(len(events), dtype=np.int64)
+        self.codes[self.rows] = np.repeat(np.arange(len(starts)), np.diff(self.offsets))
+
+        # Process and Thread of every location
+        self.processes = np.asarray(events["Process"].values[self.rows[starts]])
+        if "Thread" in events.columns:
+            self.threads = np.asarray(events["Thread"].values[self.rows[starts]])
+        else:
+            self.threads = None
+
+        # the locations of a process are contiguous, since they are sorted
+        # by Process first
+        is_process_start = np.ones(len(self.processes), dtype=bool)
+        is_process_start[1:] = self.processes[1:] != self.processes[:-1]
+        process_starts = np.flatnonzero(is_process_start)
+        process_ends = np.append(process_starts[1:], len(starts))
+        self._process_locations = {
+            process: (start, end)
+            for process, start, end in zip(
+                self.processes[process_starts], process_starts, process_ends
+            )
+        }
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_processes(self):
+        """Returns the sorted list of processes."""
+        return list(self._process_locations)
+
+    def get_rows(self, process, thread=None):
+        """Returns the row positions of a location, or of all the locations
+        of a process if no thread is given.
+        """
+        if process not in self._process_locations:
+            return self.rows[:0]
+
+        first_loc, end_loc = self._process_locations[process]
+        if thread is not None and self.threads is not None:
+            locs = np.flatnonzero(self.threads[first_loc:end_loc] == thread)
+            if len(locs) == 0:
+                return self.rows[:0]
+            first_loc += locs[0]
+            end_loc = first_loc + 1
+
+        return self.rows[self.offsets[first_loc] : self.offsets[end_loc]]
+
+
+class CallTree:
+    """Compact (CSR) representation of the calling relationships between the
+    events of a trace. All arrays are indexed by the row position of an event
+    in the dataframe (not its index label, which can differ after filtering),
+    and -1 denotes a missing parent or depth.
+    """
+
+    def __init__(self, parent, depth):
+        # row position of each event's parent event
+        self.parent = parent
+
+        # depth of each event in the call tree (starting from 0 for root)
+        self.depth = depth
+
+        # The children of the event at row position i are stored in
+        # child_indices[child_offsets[i] : child_offsets[i + 1]], in time order.
+        # Children are grouped by parent with a stable sort, since the
+        # dataframe is sorted by time.
+        has_parent = np.flatnonzero(parent != -1)
+        order = np.argsort(parent[has_parent], kind="stable")
+        self.child_indices = has_parent[order].astype(parent.dtype)
+
+        self.child_offsets = np.zeros(len(parent) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(parent[has_parent], minlength=len(parent)),
+            out=self.child_offsets[1:],
+        )
+
+    def get_children(self, index):
+        """Returns the row positions of the children of the event at a row
+        position."""
+        return self.child_indices[
+            self.child_offsets[index] : self.child_offsets[index + 1]
+        ]
+
+    def num_children(self):
+        """Returns the number of children of each event."""
+        return np.diff(self.child_offsets)
+
+
+class ReadFilter:
+    """The events that a reader keeps: those with a timestamp in time_range,
+    one of the processes and one of the names (if each of them is given).
+
+    time_range is a (start, end) tuple of nanoseconds (in the timestamps of
+    the trace), that includes start but not end, and either can be None.
+    Readers skip the parts of a trace that can't have any of the events (such
+    as the files of other processes), and drop the other events as they are
+    read.
+    """
+
+    def __init__(self, time_range=None, processes=None, names=None):
+        self.start, self.end = (None, None) if time_range is None else time_range
+        self.processes = None if processes is None else set(processes)
+        self.names = None if names is None else set(names)
+
+    def __bool__(self):
+        return not (
+            self.start is None
+            and self.end is None
+            and self.processes is None
+            and self.names is None
+        )
+
+    def key(self):
+        """Returns the options of the filter, for the cache of parsed traces
+        (an empty tuple if all the events are kept)"""
+        if not self:
+            return ()
+
+        return (
+            (self.start, self.end),
+            None if self.processes is None else sorted(self.processes),
+            None if self.names is None else sorted(self.names),
+        )
+
+    def keeps_process(self, process):
+        return self.processes is None or process in self.processes
+
+    def keeps_name(self, name):
+        return self.names is None or name in self.names
+
+    def keeps_time(self, timestamp):
+        return (self.start is None or timestamp >= self.start) and (
+            self.end is None or timestamp < self.end
+        )
+
+    def mask(self, num_events, timestamps=None, processes=None, names=None):
+        """Returns whether each of the events is kept, given the arrays of
+        their timestamps, processes and names (or None for those that the
+        reader has already filtered)"""
+        mask = np.ones(num_events, dtype=bool)
+
+        if timestamps is not None:
+            if self.start is not None:
+                mask &= timestamps >= self.start
+            if self.end is not None:
+                mask &= timestamps < self.end
+
+        for values, items in [(processes, self.processes), (names, self.names)]:
+            if values is not None and items is not None:
+                mask &= pd.Series(values, copy=False).isin(list(items)).values
+
+        return mask
+
+    def apply(self, events):
+        """Returns the events of a DataFrame that are kept"""
+        if not self:
+            return events
+
+        mask = self.mask(
+            len(events),
+            events["Timestamp (ns)"].values,
+            events["Process"].values if "Process" in events else None,
+            events["Name"].values,
+        )
+
+        return events[mask].reset_index(drop=True)
+
+
+# number of events in the chunks of Trace.iter_events, and of the rows of a
+# CSV file that are read at a time
+CHUNK_SIZE = 1 << 20
+
+# the typed columns of message attributes that the readers can create (see
+# message_columns of Trace.from_otf2 and Trace.from_projections), which
+# aren't metrics
+MESSAGE_COLUMNS = {
+    "Sender",
+    "Receiver",
+    "Msg Length",
+    "Tag",
+    "Communicator",
+    "Event ID",
+}
+
+
+def _read_cached(read, source, cache, options):
+    """Returns read(), the trace read from source, using a cache of parsed
+    traces if cache is True (which uses the directory in the PIPIT_CACHE_DIR
+    environment variable, or else ~/.cache/pipit) or a directory.
+
+    The cached traces are keyed by the path of the source, the time it was
+    last modified, and the reader options that change the trace. For a trace
+    directory, that is the names and latest modification time of the files
+    directly in it, which include the definition and index files of the
+    formats (such as traces.otf2 and traces.def, meta.db and trace.db, and
+    the sts and log files of Projections). Subdirectories aren't walked, so
+    that a cache hit stays fast on large traces; a trace whose files are only
+    changed in its subdirectories has to be read with cache=False (or removed
+    from the cache) to be read again.
+
+    Cached traces are loaded with Trace.load, which unpickles them, so the
+    cache directory must be trusted and not writable by other users. The
+    default directory is created so that only its owner can access it.
+    """
+    if not cache:
+        return read()
+
+    if cache is True:
+        cache = os.environ.get(
+            "PIPIT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pipit")
+        )
+        os.makedirs(cache, mode=0o700, exist_ok=True)
+
+    # the source is a file or a trace directory, which is modified when any
+    # of the files directly in it are (or are added or removed), and not when
+    # its subdirectories are (such as the cache, if it is inside the source)
+    source, cache = os.path.abspath(source), os.path.abspath(cache)
+    mtime = os.path.getmtime(source) if os.path.isfile(source) else 0
+    files = []
+    if os.path.isdir(source):
+        with os.scandir(source) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files.append(entry.name)
+                    mtime = max(mtime, entry.stat().st_mtime)
+
+    key = hashlib.sha1(
+        repr((source, mtime, sorted(files), options)).encode()
+    ).hexdigest()
+    path = os.path.join(cache, key)
+
+    if os.path.isdir(path):
+        return Trace.load(path)
+
+    trace = read()
+
+    # save to a temporary directory first, so that a partially written
+    # cache is never loaded
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    trace.save(tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process has cached the same trace in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return trace
+
+
+def _intervals_per_bin(starts, ends, groups, weights, edges, num_groups):
+    """Distributes weighted time intervals across the bins given by edges, and
+    sums them up per group (like the function of each interval).
+
+    Returns:
+    A (num_groups, number of bins) array with the sum of the weighted
+    overlaps of every group's intervals with every bin.
+    """
+    num_bins = len(edges) - 1
+    widths = np.diff(edges)
+
+    # bins that each interval starts and ends in
+    first_bins = np.clip(np.searchsorted(edges, starts, "right") - 1, 0, num_bins - 1)
+    last_bins = np.clip(np.searchsorted(edges, ends, "left") - 1, 0, num_bins - 1)
+    is_single_bin = first_bins >= last_bins
+
+    # Intervals within a single bin add their duration to it. Other intervals
+    # add their partial durations to their first and last bins, and the full
+    # width of every bin they span in between, which is accumulated with a
+    # prefix sum over the bins.
+    first_times = np.where(is_single_bin, ends, edges[first_bins + 1]) - starts
+    last_times = np.where(is_single_bin, 0, ends - edges[last_bins])
+
+    groups_offset = groups * num_bins
+    num_cells = num_groups * num_bins
+
+    times = np.bincount(
+        groups_offset + first_bins, weights=weights * first_times, minlength=num_cells
+    )
+    times += np.bincount(
+        groups_offset + last_bins, weights=weights * last_times, minlength=num_cells
+    )
+
+    spans = ~is_single_bin
+    spanned = np.bincount(
+        groups_offset[spans] + first_bins[spans] + 1,
+        weights=weights[spans],
+        minlength=num_cells,
+    )
+    spanned -= np.bincount(
+        groups_offset[spans] + last_bins[spans],
+        weights=weights[spans],
+        minlength=num_cells,
+    )
+
+    return (
+        times.reshape(num_groups, num_bins)
+        + np.cumsum(spanned.reshape(num_groups, num_bins), axis=1) * widths
+    )
+
+
+def _factorize(series):
+    """Returns integer codes for the values of a (possibly categorical) column."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.values
+    else:
+        return pd.factorize(series)[0]
+
+
+def _stack_depth(is_enter, loc_starts, loc_sizes):
+    """Returns the call stack depth of each enter/leave event, relative to the
+    start of its location. Enter events are at the depth of the stack before
+    they are pushed, and leave events at the depth after they are popped.
+    """
+    deltas = np.where(is_enter, 1, -1)
+    depth = np.cumsum(deltas)
+    depth -= np.repeat(depth[loc_starts] - deltas[loc_starts], loc_sizes)
+    depth[is_enter] -= 1
+
+    return depth
+
+
+def _match_events_kernel(sharded, shared, outputs):
+    """Matches the enter/leave events of a range of locations. The events are
+    grouped by location and in time order within each location.
+    """
+    rows, loc_codes = sharded["rows"], sharded["loc_codes"]
+    is_enter, names = sharded["is_enter"], sharded["names"]
+    timestamps = sharded["timestamps"]
+    matching_events, matching_times = (
+        outputs["matching_events"],
+        outputs["matching_times"],
+    )
+
+    loc_starts = np.flatnonzero(np.diff(loc_codes, prepend=np.nan))
+    loc_sizes = np.diff(np.append(loc_starts, len(rows)))
+
+    depth = _stack_depth(is_enter, loc_starts, loc_sizes)
+
+    # In a well-nested location, an enter and its matching leave are
+    # at the same depth, and no other event at that depth occurs in
+    # between them. Ordering the events by (location, depth, time)
+    # thus places every enter right before its matching leave.
+    min_depth, max_depth = depth.min(initial=0), depth.max(initial=0)
+    by_depth = np.argsort(
+        loc_codes * (max_depth - min_depth + 1) + (depth - min_depth),
+        kind="stable",
+    )
+    enters, leaves = by_depth[:-1], by_depth[1:]
+    is_pair = (
+        is_enter[enters]
+        & ~is_enter[leaves]
+        & (loc_codes[enters] == loc_codes[leaves])
+        & (depth[enters] == depth[leaves])
+    )
+    enters, leaves = enters[is_pair], leaves[is_pair]
+
+    # Locations whose events are not well-nested (e.g. leave events
+    # without an enter, or mismatched names) are matched serially by
+    # searching the call stack by name.
+    is_matched = np.zeros(len(rows), dtype=bool)
+    is_matched[leaves] = True
+    bad_locs = np.union1d(
+        loc_codes[enters[names[enters] != names[leaves]]],
+        loc_codes[~is_enter & (~is_matched | (depth < 0))],
+    )
+
+    is_good_pair = ~np.isin(loc_codes[enters], bad_locs)
+    enters, leaves = enters[is_good_pair], leaves[is_good_pair]
+
+    matching_events[rows[enters]] = rows[leaves]
+    matching_events[rows[leaves]] = rows[enters]
+    matching_times[rows[enters]] = timestamps[leaves]
+    matching_times[rows[leaves]] = timestamps[enters]
+
+    for loc in bad_locs:
+        loc_index = np.searchsorted(loc_codes[loc_starts], loc)
+        start = loc_starts[loc_index]
+        end = start + loc_sizes[loc_index]
+        _match_events_serial(
+            rows[start:end],
+            is_enter[start:end],
+            names[start:end],
+            timestamps[start:end],
+            matching_events,
+            matching_times,
+        )
+
+
+def _match_caller_callee_kernel(sharded, shared, outputs):
+    """Computes the depth and parent of the matched enter events of a range of
+    locations. The events are grouped by location and in time order within
+    each location.
+    """
+    rows, loc_codes, is_enter = (
+        sharded["rows"],
+        sharded["loc_codes"],
+        sharded["is_enter"],
+    )
+    depth, parent = outputs["depth"], outputs["parent"]
+
+    loc_starts = np.flatnonzero(np.diff(loc_codes, prepend=np.nan))
+    loc_sizes = np.diff(np.append(loc_starts, len(rows)))
+
+    enter_depth = _stack_depth(is_enter, loc_starts, loc_sizes)[is_enter]
+    enter_rows, enter_locs = rows[is_enter], loc_codes[is_enter]
+    enter_pos = np.arange(len(enter_rows))
+
+    # The parent of an enter event at depth d is the most recent enter
+    # event at depth d - 1 in the same location. Sorting the enter
+    # events by (location, depth, time) lets us find it with a binary
+    # search for each enter event.
+    num_enters = max(len(enter_rows), 1)
+    groups = enter_locs * (enter_depth.max(initial=0) + 2) + enter_depth + 1
+    sorted_keys = np.sort(groups * num_enters + enter_pos)
+
+    candidates = np.searchsorted(sorted_keys, (groups - 1) * num_enters + enter_pos) - 1
+    has_parent = candidates >= 0
+    has_parent[has_parent] = (
+        sorted_keys[candidates[has_parent]] // num_enters == groups[has_parent] - 1
+    )
+
+    depth[enter_rows] = enter_depth
+    parent[enter_rows[has_parent]] = enter_rows[
+        sorted_keys[candidates[has_parent]] % num_enters
+    ]
+
+
+def _exc_metrics_kernel(sharded, shared, outputs):
+    """Subtracts the inclusive metrics of a range of children from the
+    exclusive metrics of their parents. The children are grouped by parent.
+    """
+    children, parents = sharded["children"], sharded["parents"]
+    parent_starts = np.flatnonzero(np.diff(parents, prepend=np.nan))
+
+    for col, exc_values in outputs.items():
+        exc_values[parents[parent_starts]] -= np.add.reduceat(
+            shared[col][children], parent_starts
+        )
+
+
+def _match_events_serial(
+    rows, is_enter, names, timestamps, matching_events, matching_times
+):
+    """Matches the enter/leave events of a single location using a call stack,
+    searching the stack by name for the enter event matching each leave event.
+    Fills in matching_events and matching_times in place.
+    """
+    stack = []
+
+    for i in range(len(rows)):
+        if is_enter[i]:
+            # Add current row, its name and timestamp to stack
+            stack.append((rows[i], names[i], timestamps[i]))
+        else:
+            # we want to iterate through the stack in reverse order
+            # until we find the corresponding "Enter" Event
+            j = len(stack) - 1
+            while j > -1 and stack[j][1] != names[i]:
+                j -= 1
+
+            if j > -1:
+                # remove matched event from the stack
+                enter_row, _, enter_time = stack.pop(j)
+                leave_row, leave_time = rows[i], timestamps[i]
+
+                matching_events[enter_row] = leave_row
+                matching_events[leave_row] = enter_row
+
+                matching_times[enter_row] = leave_time
+                matching_times[leave_row] = enter_time